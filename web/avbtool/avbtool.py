@@ -23,16 +23,23 @@
 #
 """Command-line tool for working with Android Verified Boot images."""
 import argparse
+import array
 import binascii
 import bisect
+import collections
+import concurrent.futures
+import functools
 import hashlib
+import itertools
 import json
 import math
+import mmap
 import os
 import struct
 #import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 import Crypto.PublicKey.RSA
@@ -45,6 +52,10 @@ AVB_VERSION_SUB = 0
 AVB_FOOTER_VERSION_MAJOR = 1
 AVB_FOOTER_VERSION_MINOR = 0
 AVB_VBMETA_IMAGE_FLAGS_HASHTREE_DISABLED = 1
+# Read size used when streaming image data into a hash.
+HASH_CHUNK_SIZE = 1024 * 1024
+# Amount of data each hashtree worker hashes at a time.
+HASHTREE_RANGE_SIZE = 1024 * 1024
 # Configuration for enabling logging of calls to avbtool.
 AVB_INVOCATION_LOGFILE = os.environ.get('AVB_INVOCATION_LOGFILE')
 # Known values for certificate "usage" field. These values must match the
@@ -70,7 +81,8 @@ class Algorithm(object):
   """Contains details about an algorithm.
   See the avb_vbmeta_image.h file for more details about algorithms.
   The constant |ALGORITHMS| is a dictionary from human-readable
-  names (e.g 'SHA256_RSA2048') to instances of this class.
+  names (e.g 'SHA256_RSA2048') to instances of this class and
+  |ALGORITHMS_BY_TYPE| maps |algorithm_type| to (name, instance).
   Attributes:
     algorithm_type: Integer code corresponding to |AvbAlgorithmType|.
     hash_name: Empty or a name from |hashlib.algorithms|.
@@ -78,6 +90,8 @@ class Algorithm(object):
     signature_num_bytes: Number of bytes used to store the signature.
     public_key_num_bytes: Number of bytes used to store the public key.
     padding: Padding used for signature as bytes, if any.
+    hash_constructor: The hashlib constructor for |hash_name| or None.
+    key_num_bits: Size of the RSA key in bits, 0 if not signed.
   """
   def __init__(self, algorithm_type, hash_name, hash_num_bytes,
                signature_num_bytes, public_key_num_bytes, padding):
@@ -87,6 +101,8 @@ class Algorithm(object):
     self.signature_num_bytes = signature_num_bytes
     self.public_key_num_bytes = public_key_num_bytes
     self.padding = padding
+    self.hash_constructor = getattr(hashlib, hash_name) if hash_name else None
+    self.key_num_bits = signature_num_bytes * 8
 # This must be kept in sync with the avb_crypto.h file.
 #
 # The PKC1-v1.5 padding is a blob of binary DER of ASN.1 and is
@@ -184,6 +200,8 @@ ALGORITHMS = {
                 0x00, 0x04, 0x40
             ]))),
 }
+ALGORITHMS_BY_TYPE = {alg.algorithm_type: (name, alg)
+                      for name, alg in ALGORITHMS.items()}
 def get_release_string():
   """Calculates the release string to use in the VBMeta struct."""
   # Keep in sync with libavb/avb_version.c:avb_version_string().
@@ -289,25 +307,94 @@ def parse_number(string):
     ValueError: If the number could not be parsed.
   """
   return int(string, 0)
+class RSAKeyCache(object):
+  """Process-wide LRU cache of parsed RSA keys.
+  Entries are keyed by path and mtime, or by the PEM itself for keys
+  given as bytes, so a key file that changes on disk is parsed again.
+  Attributes:
+    max_entries: Number of keys kept before the least recently used
+      one is evicted.
+  """
+  class Entry(object):
+    """A parsed key along with values derived from it.
+    Attributes:
+      key: The parsed Crypto key.
+      num_bits: The key size.
+      encoded: The |AvbRSAPublicKeyHeader| encoding or None if not
+        computed yet.
+      crt: The (p, q, dP, dQ, pInv) CRT parameters of a private key or
+        None for public keys.
+    """
+    __slots__ = ('key', 'num_bits', 'encoded', 'crt')
+    def __init__(self, key):
+      self.key = key
+      self.num_bits = round_to_pow2(int(math.ceil(math.log(key.n, 2))))
+      self.encoded = None
+      self.crt = None
+      if key.has_private():
+        p, q, d = int(key.p), int(key.q), int(key.d)
+        self.crt = (p, q, d % (p - 1), d % (q - 1), int(key.u))
+  def __init__(self, max_entries=16):
+    self.max_entries = max_entries
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+  def get(self, key_path):
+    """Returns the cache entry for a key, parsing it if needed.
+    Arguments:
+      key_path: The path to a key file, or the key itself as bytes-like PEM.
+    Returns:
+      A |RSAKeyCache.Entry|.
+    """
+    if isinstance(key_path, (bytes, bytearray, memoryview)):
+      pem = bytes(key_path)
+      cache_key = ('pem', pem)
+    else:
+      pem = None
+      st = os.stat(key_path)
+      cache_key = (os.path.abspath(key_path), st.st_mtime_ns, st.st_size)
+    with self._lock:
+      entry = self._entries.get(cache_key)
+      if entry is not None:
+        self._entries.move_to_end(cache_key)
+        return entry
+    if pem is None:
+      with open(key_path) as f:
+        pem = f.read()
+    entry = RSAKeyCache.Entry(Crypto.PublicKey.RSA.importKey(pem))
+    with self._lock:
+      self._entries[cache_key] = entry
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+    return entry
+  def clear(self):
+    """Drops all cached keys."""
+    with self._lock:
+      self._entries.clear()
+RSA_KEY_CACHE = RSAKeyCache()
 class RSAPublicKey(object):
   """Data structure used for a RSA public key.
   Attributes:
     exponent: The key exponent.
     modulus: The key modulus.
     num_bits: The key size.
-    key_path: The path to a key file.
+    key_path: The path to a key file, None if the key was given as bytes.
+    key: The parsed key.
   """
   MODULUS_PREFIX = b'modulus='
   def __init__(self, key_path):
     """Loads and parses an RSA key from either a private or public key file.
     Arguments:
-      key_path: The path to a key file.
+      key_path: The path to a key file, or the key itself as bytes-like PEM.
     Raises:
       AvbError: If RSA key parameters could not be read from file.
     """
     # We used to have something as simple as this:
     #
-    key = Crypto.PublicKey.RSA.importKey(open(key_path).read())
+    self._cached = RSA_KEY_CACHE.get(key_path)
+    if isinstance(key_path, (bytes, bytearray, memoryview)):
+      key_path = None
+    key = self._cached.key
+    self.key = key
     self.exponent = key.e
     self.modulus = key.n
     #self.num_bits = key.size() + 1
@@ -339,7 +426,7 @@ class RSAPublicKey(object):
     # nearest power of 2.
     self.key_path = key_path
     #self.modulus = int(modulus_hexstr, 16)
-    self.num_bits = round_to_pow2(int(math.ceil(math.log(self.modulus, 2))))
+    self.num_bits = self._cached.num_bits
     #self.exponent = 65537
   def encode(self):
     """Encodes the public RSA key in |AvbRSAPublicKeyHeader| format.
@@ -350,6 +437,8 @@ class RSAPublicKey(object):
     Raises:
       AvbError: If given RSA key exponent is not 65537.
     """
+    if self._cached.encoded is not None:
+      return self._cached.encoded
     if self.exponent != 65537:
       raise AvbError('Only RSA keys with exponent 65537 are supported.')
     ret = bytearray()
@@ -362,7 +451,8 @@ class RSAPublicKey(object):
     ret.extend(struct.pack('!II', self.num_bits, n0inv))
     ret.extend(encode_long(self.num_bits, self.modulus))
     ret.extend(encode_long(self.num_bits, rrmodn))
-    return bytes(ret)
+    self._cached.encoded = bytes(ret)
+    return self._cached.encoded
   def sign(self, algorithm_name, data_to_sign, signing_helper=None,
            signing_helper_with_files=None):
     """Sign given data using |signing_helper| or openssl.
@@ -383,13 +473,13 @@ class RSAPublicKey(object):
     if not algorithm:
       raise AvbError('Algorithm with name {} is not supported.'
                      .format(algorithm_name))
-    if self.num_bits != (algorithm.signature_num_bytes * 8):
+    if self.num_bits != algorithm.key_num_bits:
       raise AvbError('Key size of key ({} bits) does not match key size '
                      '({} bits) of given algorithm {}.'
-                     .format(self.num_bits, algorithm.signature_num_bytes * 8,
+                     .format(self.num_bits, algorithm.key_num_bits,
                              algorithm_name))
     # Hashes the data.
-    hasher = hashlib.new(algorithm.hash_name)
+    hasher = algorithm.hash_constructor()
     hasher.update(data_to_sign)
     digest = hasher.digest()
     # Calculates the signature.
@@ -425,14 +515,24 @@ class RSAPublicKey(object):
     #    raise AvbError('Error signing: {}'.format(perr))
     #  signature = pout
 
-    key = Crypto.PublicKey.RSA.import_key(open(self.key_path).read())
+    key = self.key
     if len(padding_and_hash) > key.size_in_bytes():
       raise AvbError("data length more than key")
     
     data_int = int.from_bytes(padding_and_hash, byteorder='big')
     if data_int >= self.modulus:
       raise AvbError("Could not sign")
-    signature_int = pow(data_int, key.d, self.modulus)
+    # Every private key has its CRT parameters cached.
+    if not self._cached.crt:
+      raise AvbError('Key has no private exponent')
+    # Two half-size exponentiations recombined with Garner's formula.
+    p, q, dp, dq, pinv = self._cached.crt
+    m1 = pow(data_int, dp, p)
+    m2 = pow(data_int, dq, q)
+    signature_int = m1 + p * ((pinv * (m2 - m1)) % q)
+    # Guard against faulty results before they end up in an image.
+    if pow(signature_int, self.exponent, self.modulus) != data_int:
+      raise AvbError('Error signing: Signature does not verify')
     signature = signature_int.to_bytes(key.size_in_bytes(), byteorder='big')
  
     if len(signature) != algorithm.signature_num_bytes:
@@ -447,11 +547,10 @@ def lookup_algorithm_by_type(alg_type):
   Raises:
     Exception: If the algorithm cannot be found
   """
-  for alg_name in ALGORITHMS:
-    alg_data = ALGORITHMS[alg_name]
-    if alg_data.algorithm_type == alg_type:
-      return (alg_name, alg_data)
-  raise AvbError('Unknown algorithm type {}'.format(alg_type))
+  try:
+    return ALGORITHMS_BY_TYPE[alg_type]
+  except KeyError as e:
+    raise AvbError('Unknown algorithm type {}'.format(alg_type)) from e
 def lookup_hash_size_by_type(alg_type):
   """Looks up hash size by type.
   Arguments:
@@ -461,17 +560,17 @@ def lookup_hash_size_by_type(alg_type):
   Raises:
     AvbError: If the algorithm cannot be found.
   """
-  for alg_name in ALGORITHMS:
-    alg_data = ALGORITHMS[alg_name]
-    if alg_data.algorithm_type == alg_type:
-      return alg_data.hash_num_bytes
-  raise AvbError('Unsupported algorithm type {}'.format(alg_type))
-def verify_vbmeta_signature(vbmeta_header, vbmeta_blob):
+  try:
+    return ALGORITHMS_BY_TYPE[alg_type][1].hash_num_bytes
+  except KeyError as e:
+    raise AvbError('Unsupported algorithm type {}'.format(alg_type)) from e
+def verify_vbmeta_signature(vbmeta_header, vbmeta_blob, stats=None):
   """Checks that signature in a vbmeta blob was made by the embedded public key.
   Arguments:
     vbmeta_header: A AvbVBMetaHeader.
     vbmeta_blob: The whole vbmeta blob, including the header as bytes or
         bytearray.
+    stats: None or a VerifyStats to add the hashing and RSA time to.
   Returns:
     True if the signature is valid and corresponds to the embedded
     public key. Also returns True if the vbmeta blob is not signed.
@@ -500,10 +599,13 @@ def verify_vbmeta_signature(vbmeta_header, vbmeta_blob):
   # all we need to do is to verify. This is the exactly the same
   # steps as performed in the avb_vbmeta_image_verify() function in
   # libavb/avb_vbmeta_image.c.
-  ha = hashlib.new(alg.hash_name)
+  start = time.perf_counter()
+  ha = alg.hash_constructor()
   ha.update(header_blob)
   ha.update(aux_blob)
   computed_digest = ha.digest()
+  if stats is not None:
+    stats.hash_time += time.perf_counter() - start
   if computed_digest != digest_blob:
     return False
   padding_and_digest = alg.padding + computed_digest
@@ -514,9 +616,13 @@ def verify_vbmeta_signature(vbmeta_header, vbmeta_blob):
   # We used to have this:
   #
   #  import Crypto.PublicKey.RSA
-  key = Crypto.PublicKey.RSA.construct((modulus, exponent))
-  if not key.verify(decode_long(padding_and_digest),
-                    (decode_long(sig_blob), None)):
+  # Crypto.PublicKey.RSA keys no longer have verify() so do the raw RSA
+  # operation ourselves.
+  start = time.perf_counter()
+  signed = pow(decode_long(sig_blob), exponent, modulus)
+  if stats is not None:
+    stats.rsa_time += time.perf_counter() - start
+  if signed != decode_long(padding_and_digest):
     return False
   return True
   #
@@ -580,6 +686,8 @@ class ImageChunk(object):
   TYPE_FILL = 0xcac2
   TYPE_DONT_CARE = 0xcac3
   TYPE_CRC32 = 0xcac4
+  __slots__ = ('chunk_type', 'chunk_offset', 'output_offset', 'output_size',
+               'input_offset', 'fill_data')
   def __init__(self, chunk_type, chunk_offset, output_offset, output_size,
                input_offset, fill_data):
     """Initializes an ImageChunk object.
@@ -617,6 +725,92 @@ class ImageChunk(object):
         raise ValueError('DONT_CARE chunk cannot have input_offset set.')
     else:
       raise ValueError('Invalid chunk type')
+class ImageChunkTable(object):
+  """Compact list of the chunks in an Android sparse file.
+  Sparse images can have hundreds of thousands of chunks, so instead of an
+  ImageChunk per chunk their fields are kept in parallel arrays. Indexing
+  returns an ImageChunk copy of an entry.
+  Attributes:
+    chunk_types: The chunk types as array of integers.
+    chunk_offsets: The offsets of the chunks in the sparse file.
+    output_offsets: The offsets in the de-sparsified file, sorted so it
+      can be bisected.
+    output_sizes: The number of bytes in output.
+    input_offsets: Offsets of the data of TYPE_RAW chunks, 0 for others.
+    fills: Fill data of TYPE_FILL chunks as little-endian integers, 0 for
+      others.
+  """
+  def __init__(self):
+    """Initializes an empty chunk table."""
+    self.chunk_types = array.array('H')
+    self.chunk_offsets = array.array('Q')
+    self.output_offsets = array.array('Q')
+    self.output_sizes = array.array('Q')
+    self.input_offsets = array.array('Q')
+    self.fills = array.array('I')
+  def __len__(self):
+    return len(self.chunk_types)
+  def __getitem__(self, idx):
+    return ImageChunk(self.chunk_types[idx], self.chunk_offsets[idx],
+                      self.output_offsets[idx], self.output_sizes[idx],
+                      self.input_offset(idx), self.fill_data(idx))
+  def append(self, chunk_type, chunk_offset, output_offset, output_size,
+             input_offset, fill_data):
+    """Appends a chunk, the arguments are the same as for ImageChunk."""
+    self.chunk_types.append(chunk_type)
+    self.chunk_offsets.append(chunk_offset)
+    self.output_offsets.append(output_offset)
+    self.output_sizes.append(output_size)
+    self.input_offsets.append(input_offset or 0)
+    self.fills.append(struct.unpack('<I', fill_data)[0] if fill_data else 0)
+  def truncate(self, num_chunks):
+    """Drops all but the first |num_chunks| chunks."""
+    for column in (self.chunk_types, self.chunk_offsets, self.output_offsets,
+                   self.output_sizes, self.input_offsets, self.fills):
+      del column[num_chunks:]
+  def input_offset(self, idx):
+    """Returns the input offset of a TYPE_RAW chunk, otherwise None."""
+    if self.chunk_types[idx] != ImageChunk.TYPE_RAW:
+      return None
+    return self.input_offsets[idx]
+  def fill_data(self, idx):
+    """Returns the fill data of a TYPE_FILL chunk, otherwise None."""
+    if self.chunk_types[idx] != ImageChunk.TYPE_FILL:
+      return None
+    return struct.pack('<I', self.fills[idx])
+def update_hash_from_image(hasher, image, size, chunk_size=HASH_CHUNK_SIZE,
+                           stats=None):
+  """Feeds |size| bytes of |image| from its current position to |hasher|.
+  The data is read through a single |chunk_size| buffer so memory use
+  doesn't depend on the image size.
+  Arguments:
+    hasher: A hashlib hash object.
+    image: An ImageHandler.
+    size: Number of bytes to hash.
+    chunk_size: Size of the read buffer.
+    stats: None or a VerifyStats to add the time and bytes read to.
+  Returns:
+    The number of bytes hashed, less than |size| at end of file.
+  """
+  buf = bytearray(min(chunk_size, size))
+  view = memoryview(buf)
+  hashed = 0
+  io_time = hash_time = 0.0
+  while hashed < size:
+    start = time.perf_counter()
+    num_read = image.readinto(view[:min(len(buf), size - hashed)])
+    read = time.perf_counter()
+    io_time += read - start
+    if not num_read:
+      break
+    hasher.update(view[:num_read])
+    hash_time += time.perf_counter() - read
+    hashed += num_read
+  if stats is not None:
+    stats.io_time += io_time
+    stats.hash_time += hash_time
+    stats.bytes_hashed += hashed
+  return hashed
 class ImageHandler(object):
   """Abstraction for image I/O with support for Android sparse images.
   This class provides an interface for working with image files that
@@ -626,15 +820,18 @@ class ImageHandler(object):
   format, otherwise they will be directly on the file. Either way the
   operations do the same.
   For reading, this interface mimics a file object - it has seek(),
-  tell(), and read() methods. For writing, only truncation
-  (truncate()) and appending is supported (append_raw() and
-  append_dont_care()). Additionally, data can only be written in units
-  of the block size.
+  tell(), read() and readinto() methods. For writing, only truncation
+  (truncate()), appending (append_raw() and append_dont_care()) and
+  overwriting data in place (write_at()) is supported. Additionally,
+  data can only be appended in units of the block size.
   Attributes:
     filename: Name of file.
     is_sparse: Whether the file being operated on is sparse.
+    auto_sparsify: Whether append_raw() emits FILL chunks for sparse files.
     block_size: The block size, typically 4096.
     image_size: The size of the unsparsified file.
+    vbmeta: The ImageVBMeta cached by locate_vbmeta(), None until then and
+      after the image is modified.
   """
   # See system/core/libsparse/sparse_format.h for details.
   MAGIC = 0xed26ff3a
@@ -643,34 +840,44 @@ class ImageHandler(object):
   # |total_blocks| fields.
   NUM_CHUNKS_AND_BLOCKS_FORMAT = '<II'
   NUM_CHUNKS_AND_BLOCKS_OFFSET = 16
-  def __init__(self, image_filename, read_only=False):
+  # A chunk header followed by what would be the fill data of a FILL chunk.
+  CHUNK_HEADER_AND_FILL = struct.Struct('<2H3I')
+  # Size of the cached buffers FILL and DONT_CARE data is copied from.
+  PATTERN_SIZE = 64 * 1024
+  _ZERO_PATTERN = bytes(PATTERN_SIZE)
+  def __init__(self, image_filename, read_only=False, auto_sparsify=False):
     """Initializes an image handler.
     Arguments:
       image_filename: The name of the file to operate on.
       read_only: True if file is only opened for read-only operations.
+      auto_sparsify: If True, append_raw() stores blocks repeating a four
+        byte pattern as FILL chunks when the image is sparse.
     Raises:
       ValueError: If data in the file is invalid.
     """
     self.filename = image_filename
+    self.auto_sparsify = auto_sparsify
+    self.vbmeta = None
     self._num_total_blocks = 0
     self._num_total_chunks = 0
     self._file_pos = 0
     self._read_only = read_only
+    if self._read_only:
+      self._image = open(self.filename, 'rb')
+    else:
+      self._image = open(self.filename, 'r+b')
     self._read_header()
   def _read_header(self):
-    """Initializes internal data structures used for reading file.
-    This may be called multiple times and is typically called after
-    modifying the file (e.g. appending, truncation).
+    """Reads the header of the file.
+    For sparse files the chunk table is only built when it is first
+    needed, see _load_chunks(), so images whose last chunks are all that
+    is needed open quickly.
     Raises:
       ValueError: If data in the file is invalid.
     """
     self.is_sparse = False
     self.block_size = 4096
     self._file_pos = 0
-    if self._read_only:
-      self._image = open(self.filename, 'rb')
-    else:
-      self._image = open(self.filename, 'r+b')
     self._image.seek(0, os.SEEK_END)
     self.image_size = self._image.tell()
     self._image.seek(0, os.SEEK_SET)
@@ -692,76 +899,157 @@ class ImageHandler(object):
       raise ValueError('Unexpected chunk_hdr_sz value {}.'.
                        format(chunk_hdr_sz))
     self.block_size = block_size
-    # Build an list of chunks by parsing the file.
-    self._chunks = []
+    self.image_size = self._num_total_blocks * block_size
+    self._chunks = None
+    self._chunk_output_offsets = None
+    self._sparse_end = None
+    self.is_sparse = True
+  def _load_chunks(self):
+    """Builds the table of chunks of a sparse file if not done yet.
+    Appending and truncation keep the table up to date themselves, so
+    this only has to walk the chunk headers once.
+    Raises:
+      ValueError: If data in the file is invalid.
+    """
+    if self._chunks is not None:
+      return
+    file_hdr_sz = struct.calcsize(self.HEADER_FORMAT)
+    # Build the table of chunks by parsing the file. The chunk headers are
+    # unpacked straight from a memory map of the file where possible,
+    # otherwise they are read one by one.
+    self._image.seek(0, os.SEEK_END)
+    file_size = self._image.tell()
+    chunks = ImageChunkTable()
+    chunk_header = struct.Struct(ImageChunk.FORMAT)
+    try:
+      data = mmap.mmap(self._image.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, AttributeError):
+      # No mmap, e.g. on WebAssembly builds.
+      data = None
+    def read_at(pos, size):
+      self._image.seek(pos)
+      ret = self._image.read(size)
+      if len(ret) != size:
+        raise ValueError('Sparse image is truncated at offset {}.'.format(pos))
+      return ret
+    append_type = chunks.chunk_types.append
+    append_chunk_offset = chunks.chunk_offsets.append
+    append_output_offset = chunks.output_offsets.append
+    append_output_size = chunks.output_sizes.append
+    append_input_offset = chunks.input_offsets.append
+    append_fill = chunks.fills.append
     # Find the smallest offset where only "Don't care" chunks
     # follow. This will be the size of the content in the sparse
     # image.
     offset = 0
     output_offset = 0
-    for _ in range(1, self._num_total_chunks + 1):
-      chunk_offset = self._image.tell()
-      header_bin = self._image.read(struct.calcsize(ImageChunk.FORMAT))
-      (chunk_type, _, chunk_sz, total_sz) = struct.unpack(ImageChunk.FORMAT,
-                                                          header_bin)
-      data_sz = total_sz - struct.calcsize(ImageChunk.FORMAT)
-      if chunk_type == ImageChunk.TYPE_RAW:
-        if data_sz != (chunk_sz * self.block_size):
-          raise ValueError('Raw chunk input size ({}) does not match output '
-                           'size ({})'.
-                           format(data_sz, chunk_sz*self.block_size))
-        self._chunks.append(ImageChunk(ImageChunk.TYPE_RAW,
-                                       chunk_offset,
-                                       output_offset,
-                                       chunk_sz*self.block_size,
-                                       self._image.tell(),
-                                       None))
-        self._image.seek(data_sz, os.SEEK_CUR)
-      elif chunk_type == ImageChunk.TYPE_FILL:
-        if data_sz != 4:
-          raise ValueError('Fill chunk should have 4 bytes of fill, but this '
-                           'has {}'.format(data_sz))
-        fill_data = self._image.read(4)
-        self._chunks.append(ImageChunk(ImageChunk.TYPE_FILL,
-                                       chunk_offset,
-                                       output_offset,
-                                       chunk_sz*self.block_size,
-                                       None,
-                                       fill_data))
-      elif chunk_type == ImageChunk.TYPE_DONT_CARE:
-        if data_sz != 0:
-          raise ValueError('Don\'t care chunk input size is non-zero ({})'.
-                           format(data_sz))
-        self._chunks.append(ImageChunk(ImageChunk.TYPE_DONT_CARE,
-                                       chunk_offset,
-                                       output_offset,
-                                       chunk_sz*self.block_size,
-                                       None,
-                                       None))
-      elif chunk_type == ImageChunk.TYPE_CRC32:
-        if data_sz != 4:
-          raise ValueError('CRC32 chunk should have 4 bytes of CRC, but '
-                           'this has {}'.format(data_sz))
-        self._image.read(4)
-      else:
-        raise ValueError('Unknown chunk type {}'.format(chunk_type))
-      offset += chunk_sz
-      output_offset += chunk_sz*self.block_size
-    # Record where sparse data end.
-    self._sparse_end = self._image.tell()
+    pos = file_hdr_sz
+    try:
+      for _ in range(1, self._num_total_chunks + 1):
+        if data is not None and pos + 16 <= file_size:
+          (chunk_type, _, chunk_sz, total_sz,
+           fill) = self.CHUNK_HEADER_AND_FILL.unpack_from(data, pos)
+        else:
+          (chunk_type, _, chunk_sz, total_sz) = chunk_header.unpack(
+              read_at(pos, chunk_header.size))
+          fill = None
+        chunk_offset = pos
+        pos += chunk_header.size
+        data_sz = total_sz - chunk_header.size
+        output_size = chunk_sz * self.block_size
+        if chunk_type == ImageChunk.TYPE_RAW:
+          if data_sz != output_size:
+            raise ValueError('Raw chunk input size ({}) does not match output '
+                             'size ({})'.
+                             format(data_sz, output_size))
+          fill = 0
+          input_offset = pos
+        elif chunk_type == ImageChunk.TYPE_FILL:
+          if data_sz != 4:
+            raise ValueError('Fill chunk should have 4 bytes of fill, but this '
+                             'has {}'.format(data_sz))
+          if fill is None:
+            (fill,) = struct.unpack('<I', read_at(pos, 4))
+          input_offset = 0
+        elif chunk_type == ImageChunk.TYPE_DONT_CARE:
+          if data_sz != 0:
+            raise ValueError('Don\'t care chunk input size is non-zero ({})'.
+                             format(data_sz))
+          fill = 0
+          input_offset = 0
+        elif chunk_type == ImageChunk.TYPE_CRC32:
+          if data_sz != 4:
+            raise ValueError('CRC32 chunk should have 4 bytes of CRC, but '
+                             'this has {}'.format(data_sz))
+          input_offset = None
+        else:
+          raise ValueError('Unknown chunk type {}'.format(chunk_type))
+        if input_offset is not None:
+          append_type(chunk_type)
+          append_chunk_offset(chunk_offset)
+          append_output_offset(output_offset)
+          append_output_size(output_size)
+          append_input_offset(input_offset)
+          append_fill(fill)
+        pos += data_sz
+        offset += chunk_sz
+        output_offset += output_size
+    finally:
+      if data is not None:
+        data.close()
+    if pos > file_size:
+      raise ValueError('Sparse image is truncated at offset {}.'.format(
+          file_size))
     # Now that we've traversed all chunks, sanity check.
     if self._num_total_blocks != offset:
       raise ValueError('The header said we should have {} output blocks, '
                        'but we saw {}'.format(self._num_total_blocks, offset))
-    junk_len = len(self._image.read())
+    junk_len = file_size - pos
     if junk_len > 0:
       raise ValueError('There were {} bytes of extra data at the end of the '
                        'file.'.format(junk_len))
-    # Assign |image_size|.
-    self.image_size = output_offset
+    self._chunks = chunks
+    # Record where sparse data end.
+    self._sparse_end = pos
     # This is used when bisecting in read() to find the initial slice.
-    self._chunk_output_offsets = [i.output_offset for i in self._chunks]
-    self.is_sparse = True
+    self._chunk_output_offsets = self._chunks.output_offsets
+  def find_chunk_before(self, end_pos, chunk_type, output_size):
+    """Finds a chunk of a sparse file by where it ends.
+    This doesn't need the chunk table, so the last chunks of a huge
+    sparse file, e.g. the AVB footer, can be read without walking all
+    chunk headers. The chunk header is looked for where a chunk of the
+    given type and size ending at |end_pos| would start and is only used
+    if it agrees.
+    Arguments:
+      end_pos: Position in the file where the chunk ends, None for the
+        end of the file.
+      chunk_type: ImageChunk.TYPE_RAW or ImageChunk.TYPE_DONT_CARE.
+      output_size: Number of bytes the chunk covers in the unsparsified
+        file, a multiple of the block size.
+    Returns:
+      A tuple (chunk_pos, data) with the position of the chunk header in
+      the file and the data of a RAW chunk (empty for DONT_CARE), or None
+      if there is no such chunk.
+    """
+    assert self.is_sparse
+    chunk_header = struct.Struct(ImageChunk.FORMAT)
+    data_sz = output_size if chunk_type == ImageChunk.TYPE_RAW else 0
+    if end_pos is None:
+      self._image.seek(0, os.SEEK_END)
+      end_pos = self._image.tell()
+    chunk_pos = end_pos - chunk_header.size - data_sz
+    if (output_size <= 0 or output_size % self.block_size
+        or chunk_pos < struct.calcsize(self.HEADER_FORMAT)):
+      return None
+    self._image.seek(chunk_pos)
+    data = self._image.read(chunk_header.size + data_sz)
+    if len(data) != chunk_header.size + data_sz:
+      return None
+    if chunk_header.unpack_from(data) != (chunk_type, 0,
+                                          output_size // self.block_size,
+                                          chunk_header.size + data_sz):
+      return None
+    return chunk_pos, data[chunk_header.size:]
   def _update_chunks_and_blocks(self):
     """Helper function to update the image header.
     The the |total_chunks| and |total_blocks| fields in the header
@@ -772,6 +1060,45 @@ class ImageHandler(object):
     self._image.write(struct.pack(self.NUM_CHUNKS_AND_BLOCKS_FORMAT,
                                   self._num_total_blocks,
                                   self._num_total_chunks))
+  def _append_chunk(self, chunk_type, output_size, data):
+    """Helper function to append a chunk to the sparse file.
+    The header is updated and the chunk is added to the list of chunks,
+    without parsing the file again.
+    Arguments:
+      chunk_type: One of TYPE_RAW, TYPE_FILL, or TYPE_DONT_CARE.
+      output_size: Number of bytes in output.
+      data: Data following the chunk header: the RAW data, the four bytes
+        of fill data or nothing. None for a RAW chunk of zeros, which
+        grows the file instead of writing them.
+    """
+    self._load_chunks()
+    chunk_header_size = struct.calcsize(ImageChunk.FORMAT)
+    data_size = output_size if data is None else len(data)
+    self._num_total_chunks += 1
+    self._num_total_blocks += output_size // self.block_size
+    self._update_chunks_and_blocks()
+    chunk_offset = self._sparse_end
+    self._image.seek(chunk_offset, os.SEEK_SET)
+    self._image.write(struct.pack(ImageChunk.FORMAT,
+                                  chunk_type,
+                                  0,  # Reserved
+                                  output_size // self.block_size,
+                                  data_size + chunk_header_size))
+    if data is None:
+      # Drop anything past the header first so the chunk reads as zeros.
+      self._image.truncate(chunk_offset + chunk_header_size)
+      self._image.truncate(chunk_offset + chunk_header_size + data_size)
+    else:
+      self._image.write(data)
+    self._image.flush()
+    self._chunks.append(
+        chunk_type, chunk_offset, self.image_size, output_size,
+        chunk_offset + chunk_header_size
+        if chunk_type == ImageChunk.TYPE_RAW else None,
+        bytes(data) if chunk_type == ImageChunk.TYPE_FILL else None)
+    self._sparse_end = chunk_offset + chunk_header_size + data_size
+    self.image_size += output_size
+    self._file_pos = 0
   def append_dont_care(self, num_bytes):
     """Appends a DONT_CARE chunk to the sparse file.
     The given number of bytes must be a multiple of the block size.
@@ -783,28 +1110,46 @@ class ImageHandler(object):
     assert num_bytes % self.block_size == 0
     if self._read_only:
       raise OSError('ImageHandler is in read-only mode.')
+    self.vbmeta = None
     if not self.is_sparse:
       self._image.seek(0, os.SEEK_END)
       # This is more efficient that writing NUL bytes since it'll add
       # a hole on file systems that support sparse files (native
       # sparse, not Android sparse).
-      self._image.truncate(self._image.tell() + num_bytes)
-      self._read_header()
+      self.image_size = self._image.tell() + num_bytes
+      self._image.truncate(self.image_size)
+      self._file_pos = 0
       return
-    self._num_total_chunks += 1
-    self._num_total_blocks += num_bytes // self.block_size
-    self._update_chunks_and_blocks()
-    self._image.seek(self._sparse_end, os.SEEK_SET)
-    self._image.write(struct.pack(ImageChunk.FORMAT,
-                                  ImageChunk.TYPE_DONT_CARE,
-                                  0,  # Reserved
-                                  num_bytes // self.block_size,
-                                  struct.calcsize(ImageChunk.FORMAT)))
-    self._read_header()
+    self._append_chunk(ImageChunk.TYPE_DONT_CARE, num_bytes, b'')
+  def append_zeroed_raw(self, num_bytes):
+    """Appends zeros to be overwritten with write_at() later.
+    Unlike append_raw() the zeros are not passed in, the file is grown
+    instead, so a large region can be reserved without holding it in
+    memory. In sparse files it is a single RAW chunk, even with
+    |auto_sparsify| set.
+    Arguments:
+      num_bytes: Number of bytes to append - must be a multiple of the
+        block size.
+    Raises:
+      OSError: If ImageHandler was initialized in read-only mode.
+    """
+    assert num_bytes % self.block_size == 0
+    if self._read_only:
+      raise OSError('ImageHandler is in read-only mode.')
+    self.vbmeta = None
+    if not self.is_sparse:
+      self._image.seek(0, os.SEEK_END)
+      self.image_size = self._image.tell() + num_bytes
+      self._image.truncate(self.image_size)
+      self._file_pos = 0
+      return
+    self._append_chunk(ImageChunk.TYPE_RAW, num_bytes, None)
   def append_raw(self, data, multiple_block_size=True):
     """Appends a RAW chunk to the sparse file.
     The length of the given data must be a multiple of the block size,
-    unless |multiple_block_size| is False.
+    unless |multiple_block_size| is False. With |auto_sparsify| set, runs
+    of blocks that repeat a four byte pattern, e.g. zero padding, are
+    appended as FILL chunks instead.
     Arguments:
       data: Data to append as bytes.
       multiple_block_size: whether to check the length of the
@@ -816,23 +1161,67 @@ class ImageHandler(object):
       assert len(data) % self.block_size == 0
     if self._read_only:
       raise OSError('ImageHandler is in read-only mode.')
+    self.vbmeta = None
     if not self.is_sparse:
       self._image.seek(0, os.SEEK_END)
       self._image.write(data)
-      self._read_header()
+      self._image.flush()
+      self.image_size = self._image.tell()
+      self._file_pos = 0
       return
-    self._num_total_chunks += 1
-    self._num_total_blocks += len(data) // self.block_size
-    self._update_chunks_and_blocks()
-    self._image.seek(self._sparse_end, os.SEEK_SET)
-    self._image.write(struct.pack(ImageChunk.FORMAT,
-                                  ImageChunk.TYPE_RAW,
-                                  0,  # Reserved
-                                  len(data) // self.block_size,
-                                  len(data) +
-                                  struct.calcsize(ImageChunk.FORMAT)))
-    self._image.write(data)
-    self._read_header()
+    if self.auto_sparsify and len(data) % self.block_size == 0:
+      view = memoryview(data).cast('B')
+      for start, end, fill_data in self._block_runs(view):
+        if fill_data is None:
+          self._append_chunk(ImageChunk.TYPE_RAW, end - start,
+                             view[start:end])
+        else:
+          self._append_chunk(ImageChunk.TYPE_FILL, end - start, fill_data)
+      return
+    self._append_chunk(ImageChunk.TYPE_RAW, len(data), data)
+  def _block_runs(self, data):
+    """Splits data into runs of blocks to store as RAW or FILL chunks.
+    A block can be stored as a FILL chunk if it repeats its first four
+    bytes, that is if it is equal to itself shifted by four bytes. The
+    data is copied to bytes a segment of blocks at a time so the shifted
+    comparisons are plain memcmp() calls; a segment repeating a single
+    pattern takes one comparison, only mixed segments are checked block
+    by block.
+    Arguments:
+      data: A memoryview of the data, a multiple of the block size long.
+    Returns:
+      A list of (start, end, fill_data) tuples covering |data| in order.
+      |fill_data| is the four byte pattern of a run of FILL blocks and
+      None for a run of blocks to store as is.
+    """
+    bs = self.block_size
+    segment_size = bs * 256
+    runs = []
+    def add_run(start, end, fill_data):
+      if runs and runs[-1][2] == fill_data:
+        runs[-1] = (runs[-1][0], end, fill_data)
+      else:
+        runs.append((start, end, fill_data))
+    for seg_pos in range(0, len(data), segment_size):
+      segment = bytes(data[seg_pos:seg_pos + segment_size])
+      if segment[4:] == segment[:-4]:
+        add_run(seg_pos, seg_pos + len(segment), segment[:4])
+        continue
+      raw_start = None
+      for pos in range(0, len(segment), bs):
+        # Most data blocks already differ in their first eight bytes.
+        if (segment[pos:pos + 4] != segment[pos + 4:pos + 8] or
+            segment[pos + 4:pos + bs] != segment[pos:pos + bs - 4]):
+          if raw_start is None:
+            raw_start = pos
+          continue
+        if raw_start is not None:
+          add_run(seg_pos + raw_start, seg_pos + pos, None)
+          raw_start = None
+        add_run(seg_pos + pos, seg_pos + pos + bs, segment[pos:pos + 4])
+      if raw_start is not None:
+        add_run(seg_pos + raw_start, seg_pos + len(segment), None)
+    return runs
   def append_fill(self, fill_data, size):
     """Appends a fill chunk to the sparse file.
     The total length of the fill data must be a multiple of the block size.
@@ -847,22 +1236,15 @@ class ImageHandler(object):
     assert size % self.block_size == 0
     if self._read_only:
       raise OSError('ImageHandler is in read-only mode.')
+    self.vbmeta = None
     if not self.is_sparse:
       self._image.seek(0, os.SEEK_END)
       self._image.write(fill_data * (size//4))
-      self._read_header()
+      self._image.flush()
+      self.image_size = self._image.tell()
+      self._file_pos = 0
       return
-    self._num_total_chunks += 1
-    self._num_total_blocks += size // self.block_size
-    self._update_chunks_and_blocks()
-    self._image.seek(self._sparse_end, os.SEEK_SET)
-    self._image.write(struct.pack(ImageChunk.FORMAT,
-                                  ImageChunk.TYPE_FILL,
-                                  0,  # Reserved
-                                  size // self.block_size,
-                                  4 + struct.calcsize(ImageChunk.FORMAT)))
-    self._image.write(fill_data)
-    self._read_header()
+    self._append_chunk(ImageChunk.TYPE_FILL, size, fill_data)
   def seek(self, offset):
     """Sets the cursor position for reading from unsparsified file.
     Arguments:
@@ -889,32 +1271,147 @@ class ImageHandler(object):
       data = self._image.read(size)
       self._file_pos += len(data)
       return data
+    data = bytearray(size)
+    num_read = self.readinto(data)
+    if num_read < size:
+      del data[num_read:]
+    return bytes(data)
+  def readinto(self, buf):
+    """Reads data from the unsparsified file into |buf|.
+    Like read(), fewer than len(|buf|) bytes are read if the end of the
+    file is encountered and the file cursor is advanced by the number
+    of bytes read. Sparse data is copied straight into |buf|, FILL and
+    DONT_CARE chunks from cached pattern buffers.
+    Arguments:
+      buf: Writable bytes-like object to read into.
+    Returns:
+      The number of bytes read.
+    """
+    view = memoryview(buf).cast('B')
+    if not self.is_sparse:
+      self._image.seek(self._file_pos)
+      num_read = self._image.readinto(view)
+      self._file_pos += num_read
+      return num_read
     # Iterate over all chunks.
+    self._load_chunks()
+    chunks = self._chunks
     chunk_idx = bisect.bisect_right(self._chunk_output_offsets,
                                     self._file_pos) - 1
-    data = bytearray()
-    to_go = size
+    pos = 0
+    to_go = len(view)
     while to_go > 0:
-      chunk = self._chunks[chunk_idx]
-      chunk_pos_offset = self._file_pos - chunk.output_offset
-      chunk_pos_to_go = min(chunk.output_size - chunk_pos_offset, to_go)
-      if chunk.chunk_type == ImageChunk.TYPE_RAW:
-        self._image.seek(chunk.input_offset + chunk_pos_offset)
-        data.extend(self._image.read(chunk_pos_to_go))
-      elif chunk.chunk_type == ImageChunk.TYPE_FILL:
-        all_data = chunk.fill_data*(chunk_pos_to_go // len(chunk.fill_data) + 2)
-        offset_mod = chunk_pos_offset % len(chunk.fill_data)
-        data.extend(all_data[offset_mod:(offset_mod + chunk_pos_to_go)])
+      chunk_type = chunks.chunk_types[chunk_idx]
+      chunk_pos_offset = self._file_pos - chunks.output_offsets[chunk_idx]
+      chunk_pos_to_go = min(chunks.output_sizes[chunk_idx] - chunk_pos_offset,
+                            to_go)
+      out = view[pos:pos + chunk_pos_to_go]
+      if chunk_type == ImageChunk.TYPE_RAW:
+        self._image.seek(chunks.input_offsets[chunk_idx] + chunk_pos_offset)
+        self._image.readinto(out)
       else:
-        assert chunk.chunk_type == ImageChunk.TYPE_DONT_CARE
-        data.extend(b'\0' * chunk_pos_to_go)
+        if chunk_type == ImageChunk.TYPE_FILL:
+          fill_data = chunks.fill_data(chunk_idx)
+          pattern = self._fill_pattern(fill_data)
+          offset_mod = chunk_pos_offset % len(fill_data)
+          # Pieces are a multiple of the fill size so each one starts
+          # at the same offset into the pattern.
+          step = self.PATTERN_SIZE - len(fill_data)
+        else:
+          assert chunk_type == ImageChunk.TYPE_DONT_CARE
+          pattern = self._ZERO_PATTERN
+          offset_mod = 0
+          step = self.PATTERN_SIZE
+        for i in range(0, chunk_pos_to_go, step):
+          n = min(step, chunk_pos_to_go - i)
+          out[i:i + n] = pattern[offset_mod:offset_mod + n]
+      pos += chunk_pos_to_go
       to_go -= chunk_pos_to_go
       self._file_pos += chunk_pos_to_go
       chunk_idx += 1
       # Generate partial read in case of EOF.
-      if chunk_idx >= len(self._chunks):
+      if chunk_idx >= len(chunks):
         break
-    return bytes(data)
+    return pos
+  def write_at(self, offset, data):
+    """Overwrites data of the unsparsified file in place.
+    For sparse images only data stored in RAW chunks can be overwritten.
+    The file cursor for reading is not changed.
+    Arguments:
+      offset: Offset to write at.
+      data: Data to write as bytes-like object.
+    Raises:
+      OSError: If ImageHandler was initialized in read-only mode.
+      ValueError: If the data doesn't fit in the image or would land in a
+        FILL or DONT_CARE chunk.
+    """
+    if self._read_only:
+      raise OSError('ImageHandler is in read-only mode.')
+    self.vbmeta = None
+    data = memoryview(data).cast('B')
+    if offset < 0 or offset + len(data) > self.image_size:
+      raise ValueError('Cannot write past the end of the image.')
+    if not self.is_sparse:
+      self._image.seek(offset)
+      self._image.write(data)
+      self._image.flush()
+      return
+    for extent_offset, _, fill_data in self.extents(offset, len(data)):
+      if fill_data is not None:
+        raise ValueError('Cannot overwrite FILL or DONT_CARE data at offset '
+                         '{}.'.format(extent_offset))
+    pos = 0
+    while pos < len(data):
+      chunk_idx = bisect.bisect_right(self._chunk_output_offsets,
+                                      offset + pos) - 1
+      chunk = self._chunks[chunk_idx]
+      chunk_pos_offset = offset + pos - chunk.output_offset
+      size = min(chunk.output_size - chunk_pos_offset, len(data) - pos)
+      self._image.seek(chunk.input_offset + chunk_pos_offset)
+      self._image.write(data[pos:pos + size])
+      pos += size
+    self._image.flush()
+  def extents(self, offset, size):
+    """Describes how the unsparsified data in a range is stored.
+    Arguments:
+      offset: Start of the range.
+      size: Size of the range, clipped to the end of the file.
+    Returns:
+      A list of (offset, size, fill_data) tuples covering the range in
+      order. |fill_data| is None for data that has to be read and the
+      four byte pattern repeated over the extent for FILL and DONT_CARE
+      (zero) chunks.
+    """
+    size = max(0, min(size, self.image_size - offset))
+    if not self.is_sparse:
+      return [(offset, size, None)] if size else []
+    self._load_chunks()
+    ret = []
+    end = offset + size
+    chunk_idx = bisect.bisect_right(self._chunk_output_offsets, offset) - 1
+    chunks = self._chunks
+    while offset < end and chunk_idx < len(chunks):
+      chunk_type = chunks.chunk_types[chunk_idx]
+      extent_end = min(end, chunks.output_offsets[chunk_idx] +
+                       chunks.output_sizes[chunk_idx])
+      if chunk_type == ImageChunk.TYPE_FILL:
+        fill_data = chunks.fill_data(chunk_idx)
+      elif chunk_type == ImageChunk.TYPE_DONT_CARE:
+        fill_data = b'\0' * 4
+      else:
+        fill_data = None
+      ret.append((offset, extent_end - offset, fill_data))
+      offset = extent_end
+      chunk_idx += 1
+    return ret
+  @staticmethod
+  @functools.lru_cache(maxsize=16)
+  def _fill_pattern(fill_data):
+    """Returns a cached PATTERN_SIZE buffer repeating |fill_data|.
+    The cache is shared by all handlers and threads, and bounded so
+    images with many distinct FILL values don't grow it without limit.
+    """
+    return fill_data * (ImageHandler.PATTERN_SIZE // len(fill_data))
   def tell(self):
     """Returns the file cursor position for reading from unsparsified file.
     Returns:
@@ -931,9 +1428,11 @@ class ImageHandler(object):
     """
     if self._read_only:
       raise OSError('ImageHandler is in read-only mode.')
+    self.vbmeta = None
     if not self.is_sparse:
       self._image.truncate(size)
-      self._read_header()
+      self.image_size = size
+      self._file_pos = 0
       return
     if size % self.block_size != 0:
       raise ValueError('Cannot truncate to a size which is not a multiple '
@@ -942,6 +1441,7 @@ class ImageHandler(object):
       # Trivial where there's nothing to do.
       return
     if size < self.image_size:
+      self._load_chunks()
       chunk_idx = bisect.bisect_right(self._chunk_output_offsets, size) - 1
       chunk = self._chunks[chunk_idx]
       if chunk.output_offset != size:
@@ -970,46 +1470,86 @@ class ImageHandler(object):
                                       0,  # Reserved
                                       chunk_sz,
                                       total_sz))
-        chunk.output_size = num_to_keep
+        self._chunks.output_sizes[chunk_idx] = num_to_keep
       else:
         # Truncation at trunk boundary.
         truncate_at = chunk.chunk_offset
         chunk_idx_for_update = chunk_idx
       self._num_total_chunks = chunk_idx_for_update
-      self._num_total_blocks = 0
-      for i in range(0, chunk_idx_for_update):
-        self._num_total_blocks += self._chunks[i].output_size // self.block_size
+      self._num_total_blocks = sum(
+          self._chunks.output_sizes[:chunk_idx_for_update]) // self.block_size
       self._update_chunks_and_blocks()
       self._image.truncate(truncate_at)
-      # We've modified the file so re-read all data.
-      self._read_header()
+      self._image.flush()
+      # Drop the chunks past the new end instead of re-reading all data.
+      self._chunks.truncate(chunk_idx_for_update)
+      self._sparse_end = truncate_at
+      self.image_size = size
+      self._file_pos = 0
     else:
       # Truncating to grow - just add a DONT_CARE section.
       self.append_dont_care(size - self.image_size)
 class AvbDescriptor(object):
   """Class for AVB descriptor.
   See the |AvbDescriptor| C struct for more information.
+  Descriptors parsed from data only keep a memoryview of their encoding
+  until an attribute is first accessed, then all fields are decoded from
+  it. encode() returns the encoding as is until an attribute is set.
   Attributes:
     tag: The tag identifying what kind of descriptor this is.
     data: The data in the descriptor.
   """
   SIZE = 16
   FORMAT_STRING = ('!QQ')  # tag, num_bytes_following (descriptor header)
+  # The encoding of a parsed descriptor, None once it's out of date.
+  _raw = None
+  _decoded = False
   def __init__(self, data):
     """Initializes a new property descriptor.
     Arguments:
-      data: If not None, must be a bytearray().
-    Raises:
-      LookupError: If the given descriptor is malformed.
+      data: If not None, the encoded descriptor as bytes-like object.
     """
     assert struct.calcsize(self.FORMAT_STRING) == self.SIZE
     if data:
-      (self.tag, num_bytes_following) = (
-          struct.unpack(self.FORMAT_STRING, data[0:self.SIZE]))
-      self.data = data[self.SIZE:self.SIZE + num_bytes_following]
+      self._set_raw(data)
     else:
       self.tag = None
       self.data = None
+  def _set_raw(self, data):
+    """Keeps the encoding of the descriptor to decode fields from.
+    Arguments:
+      data: The encoded descriptor as bytes-like object.
+    """
+    data = memoryview(data)
+    (_, num_bytes_following) = struct.unpack('!QQ', data[0:16])
+    self.__dict__['_raw'] = data[0:16 + num_bytes_following]
+  def _decode(self, raw):
+    """Decodes the fields of the descriptor.
+    Arguments:
+      raw: The encoded descriptor as memoryview.
+    Returns:
+      A dict with the attributes of the descriptor.
+    Raises:
+      LookupError: If the given descriptor is malformed.
+    """
+    (tag, num_bytes_following) = (
+        struct.unpack(self.FORMAT_STRING, raw[0:self.SIZE]))
+    return {'tag': tag,
+            'data': raw[self.SIZE:self.SIZE + num_bytes_following].tobytes()}
+  def __getattr__(self, name):
+    # Only called for attributes which are not set, i.e. for all fields
+    # of a parsed descriptor until they are decoded.
+    if self._raw is None or self._decoded or name.startswith('__'):
+      raise AttributeError(name)
+    self.__dict__.update(self._decode(self._raw), _decoded=True)
+    return object.__getattribute__(self, name)
+  def __setattr__(self, name, value):
+    if self._raw is not None:
+      # The encoding goes out of date, decode the other fields first.
+      if not self._decoded:
+        self.__dict__.update(self._decode(self._raw), _decoded=True)
+      self.__dict__['_raw'] = None
+    object.__setattr__(self, name, value)
   def print_desc(self, o):
     """Print the descriptor.
     Arguments:
@@ -1027,6 +1567,8 @@ class AvbDescriptor(object):
     Returns:
       A bytearray() with the descriptor data.
     """
+    if self._raw is not None:
+      return bytearray(self._raw)
     num_bytes_following = len(self.data)
     nbf_with_padding = round_to_multiple(num_bytes_following, 8)
     padding_size = nbf_with_padding - num_bytes_following
@@ -1035,7 +1577,8 @@ class AvbDescriptor(object):
     ret = desc + self.data + padding
     return bytearray(ret)
   def verify(self, image_dir, image_ext, expected_chain_partitions_map,
-             image_containing_descriptor, accept_zeroed_hashtree):
+             image_containing_descriptor, accept_zeroed_hashtree,
+             context=None):
     """Verifies contents of the descriptor - used in verify_image sub-command.
     Arguments:
       image_dir: The directory of the file being verified.
@@ -1045,12 +1588,14 @@ class AvbDescriptor(object):
       image_containing_descriptor: The image the descriptor is in.
       accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
           zeroed out.
+      context: The VerifyContext to write messages to, None for sys.stdout
+          and sys.stderr.
     Returns:
       True if the descriptor verifies, False otherwise.
     """
     # Deletes unused parameters to prevent pylint warning unused-argument.
     del image_dir, image_ext, expected_chain_partitions_map
-    del image_containing_descriptor, accept_zeroed_hashtree
+    del image_containing_descriptor, accept_zeroed_hashtree, context
     # Nothing to do.
     return True
 class AvbPropertyDescriptor(AvbDescriptor):
@@ -1068,30 +1613,39 @@ class AvbPropertyDescriptor(AvbDescriptor):
   def __init__(self, data=None):
     """Initializes a new property descriptor.
     Arguments:
-      data: If not None, must be as bytes of size |SIZE|.
-    Raises:
-      LookupError: If the given descriptor is malformed.
+      data: If not None, the encoded descriptor as bytes-like object.
     """
-    super().__init__(None)
     assert struct.calcsize(self.FORMAT_STRING) == self.SIZE
     if data:
-      (tag, num_bytes_following, key_size,
-       value_size) = struct.unpack(self.FORMAT_STRING, data[0:self.SIZE])
-      expected_size = round_to_multiple(
-          self.SIZE - 16 + key_size + 1 + value_size + 1, 8)
-      if tag != self.TAG or num_bytes_following != expected_size:
-        raise LookupError('Given data does not look like a property '
-                          'descriptor.')
-      try:
-        self.key = data[self.SIZE:(self.SIZE + key_size)].decode('utf-8')
-      except UnicodeDecodeError as e:
-        raise LookupError('Key cannot be decoded as UTF-8: {}.'
-                          .format(e)) from e
-      self.value = data[(self.SIZE + key_size + 1):(self.SIZE + key_size + 1 +
-                                                    value_size)]
+      self._set_raw(data)
     else:
+      super().__init__(None)
       self.key = ''
       self.value = b''
+  def _decode(self, raw):
+    """Decodes the fields of the descriptor.
+    Arguments:
+      raw: The encoded descriptor as memoryview.
+    Returns:
+      A dict with the attributes of the descriptor.
+    Raises:
+      LookupError: If the given descriptor is malformed.
+    """
+    (tag, num_bytes_following, key_size,
+     value_size) = struct.unpack(self.FORMAT_STRING, raw[0:self.SIZE])
+    expected_size = round_to_multiple(
+        self.SIZE - 16 + key_size + 1 + value_size + 1, 8)
+    if tag != self.TAG or num_bytes_following != expected_size:
+      raise LookupError('Given data does not look like a property '
+                        'descriptor.')
+    try:
+      key = str(raw[self.SIZE:(self.SIZE + key_size)], 'utf-8')
+    except UnicodeDecodeError as e:
+      raise LookupError('Key cannot be decoded as UTF-8: {}.'
+                        .format(e)) from e
+    value = raw[(self.SIZE + key_size + 1):(self.SIZE + key_size + 1 +
+                                            value_size)].tobytes()
+    return {'key': key, 'value': value}
   def print_desc(self, o):
     """Print the descriptor.
     Arguments:
@@ -1112,6 +1666,8 @@ class AvbPropertyDescriptor(AvbDescriptor):
     Returns:
       The descriptor data as bytes.
     """
+    if self._raw is not None:
+      return self._raw.tobytes()
     key_encoded = self.key.encode('utf-8')
     num_bytes_following = (
         self.SIZE + len(key_encoded) + len(self.value) + 2 - 16)
@@ -1123,7 +1679,8 @@ class AvbPropertyDescriptor(AvbDescriptor):
            padding_size * b'\0')
     return ret
   def verify(self, image_dir, image_ext, expected_chain_partitions_map,
-             image_containing_descriptor, accept_zeroed_hashtree):
+             image_containing_descriptor, accept_zeroed_hashtree,
+             context=None):
     """Verifies contents of the descriptor - used in verify_image sub-command.
     Arguments:
       image_dir: The directory of the file being verified.
@@ -1133,6 +1690,8 @@ class AvbPropertyDescriptor(AvbDescriptor):
       image_containing_descriptor: The image the descriptor is in.
       accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
           zeroed out.
+      context: The VerifyContext to write messages to, None for sys.stdout
+          and sys.stderr.
     Returns:
       True if the descriptor verifies, False otherwise.
     """
@@ -1181,42 +1740,13 @@ class AvbHashtreeDescriptor(AvbDescriptor):
   def __init__(self, data=None):
     """Initializes a new hashtree descriptor.
     Arguments:
-      data: If not None, must be bytes of size |SIZE|.
-    Raises:
-      LookupError: If the given descriptor is malformed.
+      data: If not None, the encoded descriptor as bytes-like object.
     """
-    super().__init__(None)
     assert struct.calcsize(self.FORMAT_STRING) == self.SIZE
     if data:
-      (tag, num_bytes_following, self.dm_verity_version, self.image_size,
-       self.tree_offset, self.tree_size, self.data_block_size,
-       self.hash_block_size, self.fec_num_roots, self.fec_offset, self.fec_size,
-       self.hash_algorithm, partition_name_len, salt_len,
-       root_digest_len, self.flags, _) = struct.unpack(self.FORMAT_STRING,
-                                                       data[0:self.SIZE])
-      expected_size = round_to_multiple(
-          self.SIZE - 16 + partition_name_len + salt_len + root_digest_len, 8)
-      if tag != self.TAG or num_bytes_following != expected_size:
-        raise LookupError('Given data does not look like a hashtree '
-                          'descriptor.')
-      # Nuke NUL-bytes at the end.
-      self.hash_algorithm = self.hash_algorithm.rstrip(b'\0').decode('ascii')
-      o = 0
-      try:
-        self.partition_name = data[
-            (self.SIZE + o):(self.SIZE + o + partition_name_len)
-        ].decode('utf-8')
-      except UnicodeDecodeError as e:
-        raise LookupError('Partition name cannot be decoded as UTF-8: {}.'
-                          .format(e)) from e
-      o += partition_name_len
-      self.salt = data[(self.SIZE + o):(self.SIZE + o + salt_len)]
-      o += salt_len
-      self.root_digest = data[(self.SIZE + o):(self.SIZE + o + root_digest_len)]
-      if root_digest_len != self._hashtree_digest_size():
-        if root_digest_len != 0:
-          raise LookupError('root_digest_len doesn\'t match hash algorithm')
+      self._set_raw(data)
     else:
+      super().__init__(None)
       self.dm_verity_version = 0
       self.image_size = 0
       self.tree_offset = 0
@@ -1231,6 +1761,57 @@ class AvbHashtreeDescriptor(AvbDescriptor):
       self.salt = b''
       self.root_digest = b''
       self.flags = 0
+  def _decode(self, raw):
+    """Decodes the fields of the descriptor.
+    Arguments:
+      raw: The encoded descriptor as memoryview.
+    Returns:
+      A dict with the attributes of the descriptor.
+    Raises:
+      LookupError: If the given descriptor is malformed.
+    """
+    (tag, num_bytes_following, dm_verity_version, image_size, tree_offset,
+     tree_size, data_block_size, hash_block_size, fec_num_roots, fec_offset,
+     fec_size, hash_algorithm, partition_name_len, salt_len,
+     root_digest_len, flags, _) = struct.unpack(self.FORMAT_STRING,
+                                                raw[0:self.SIZE])
+    expected_size = round_to_multiple(
+        self.SIZE - 16 + partition_name_len + salt_len + root_digest_len, 8)
+    if tag != self.TAG or num_bytes_following != expected_size:
+      raise LookupError('Given data does not look like a hashtree '
+                        'descriptor.')
+    # Nuke NUL-bytes at the end.
+    hash_algorithm = hash_algorithm.rstrip(b'\0').decode('ascii')
+    o = self.SIZE
+    try:
+      partition_name = str(raw[o:(o + partition_name_len)], 'utf-8')
+    except UnicodeDecodeError as e:
+      raise LookupError('Partition name cannot be decoded as UTF-8: {}.'
+                        .format(e)) from e
+    o += partition_name_len
+    salt = raw[o:(o + salt_len)].tobytes()
+    o += salt_len
+    root_digest = raw[o:(o + root_digest_len)].tobytes()
+    if root_digest_len != len(create_avb_hashtree_hasher(hash_algorithm,
+                                                         b'').digest()):
+      if root_digest_len != 0:
+        raise LookupError('root_digest_len doesn\'t match hash algorithm')
+    return {
+        'dm_verity_version': dm_verity_version,
+        'image_size': image_size,
+        'tree_offset': tree_offset,
+        'tree_size': tree_size,
+        'data_block_size': data_block_size,
+        'hash_block_size': hash_block_size,
+        'fec_num_roots': fec_num_roots,
+        'fec_offset': fec_offset,
+        'fec_size': fec_size,
+        'hash_algorithm': hash_algorithm,
+        'partition_name': partition_name,
+        'salt': salt,
+        'root_digest': root_digest,
+        'flags': flags,
+    }
   def _hashtree_digest_size(self):
     return len(create_avb_hashtree_hasher(self.hash_algorithm, b'').digest())
   def print_desc(self, o):
@@ -1260,6 +1841,8 @@ class AvbHashtreeDescriptor(AvbDescriptor):
     Returns:
       The descriptor data as bytes.
     """
+    if self._raw is not None:
+      return self._raw.tobytes()
     hash_algorithm_encoded = self.hash_algorithm.encode('ascii')
     partition_name_encoded = self.partition_name.encode('utf-8')
     num_bytes_following = (self.SIZE + len(partition_name_encoded)
@@ -1277,7 +1860,8 @@ class AvbHashtreeDescriptor(AvbDescriptor):
            padding_size * b'\0')
     return ret
   def verify(self, image_dir, image_ext, expected_chain_partitions_map,
-             image_containing_descriptor, accept_zeroed_hashtree):
+             image_containing_descriptor, accept_zeroed_hashtree,
+             context=None):
     """Verifies contents of the descriptor - used in verify_image sub-command.
     Arguments:
       image_dir: The directory of the file being verified.
@@ -1287,9 +1871,12 @@ class AvbHashtreeDescriptor(AvbDescriptor):
       image_containing_descriptor: The image the descriptor is in.
       accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
           zeroed out.
+      context: The VerifyContext to write messages to, None for sys.stdout
+          and sys.stderr.
     Returns:
       True if the descriptor verifies, False otherwise.
     """
+    context = _verify_context(context)
     if not self.partition_name:
       image_filename = image_containing_descriptor.filename
       image = image_containing_descriptor
@@ -1297,19 +1884,11 @@ class AvbHashtreeDescriptor(AvbDescriptor):
       image_filename = os.path.join(image_dir, self.partition_name + image_ext)
       image = ImageHandler(image_filename, read_only=True)
     # Generate the hashtree and checks that it matches what's in the file.
-    digest_size = self._hashtree_digest_size()
-    digest_padding = round_to_pow2(digest_size) - digest_size
-    (hash_level_offsets, tree_size) = calc_hash_level_offsets(
-        self.image_size, self.data_block_size, digest_size + digest_padding)
-    root_digest, hash_tree = generate_hash_tree(image, self.image_size,
-                                                self.data_block_size,
-                                                self.hash_algorithm, self.salt,
-                                                digest_padding,
-                                                hash_level_offsets,
-                                                tree_size)
+    root_digest, hash_tree = self._generate_hash_tree(
+        image, context.num_threads, context.stats)
     # The root digest must match unless it is not embedded in the descriptor.
     if self.root_digest and root_digest != self.root_digest:
-      sys.stderr.write('hashtree of {} does not match descriptor\n'.
+      context.err.write('hashtree of {} does not match descriptor\n'.
                        format(image_filename))
       return False
     # ... also check that the on-disk hashtree matches
@@ -1319,20 +1898,121 @@ class AvbHashtreeDescriptor(AvbDescriptor):
     if is_zeroed and accept_zeroed_hashtree:
       print('{}: skipping verification since hashtree is zeroed and '
             '--accept_zeroed_hashtree was given'
-            .format(self.partition_name))
+            .format(self.partition_name), file=context.out)
     else:
       if hash_tree != hash_tree_ondisk:
-        sys.stderr.write('hashtree of {} contains invalid data\n'.
-                         format(image_filename))
+        context.err.write('hashtree of {} contains invalid data\n'.
+                          format(image_filename))
         return False
       print('{}: Successfully verified {} hashtree of {} for image of {} bytes'
             .format(self.partition_name, self.hash_algorithm, image.filename,
-                    self.image_size))
-    # TODO(zeuthen): we could also verify that the FEC stored in the image is
-    # correct but this a) currently requires the 'fec' binary; and b) takes a
-    # long time; and c) is not strictly needed for verification purposes as
-    # we've already verified the root hash.
+                    self.image_size), file=context.out)
+    # The FEC data is only checked with --check_fec, see check_fec(). It is
+    # not strictly needed for verification purposes as we've already
+    # verified the root hash.
     return True
+  def _generate_hash_tree(self, image, num_threads=None, stats=None):
+    """Generates the hashtree of the data in |image|.
+    Arguments:
+      image: An ImageHandler for the image.
+      num_threads: Number of hashing threads, None for the CPU count.
+      stats: None or a VerifyStats to add the time and bytes read to.
+    Returns:
+      A tuple (root_digest, hash_tree) as returned by generate_hash_tree().
+    """
+    digest_size = self._hashtree_digest_size()
+    digest_padding = round_to_pow2(digest_size) - digest_size
+    (hash_level_offsets, tree_size) = calc_hash_level_offsets(
+        self.image_size, self.data_block_size, digest_size + digest_padding)
+    return generate_hash_tree(image, self.image_size, self.data_block_size,
+                              self.hash_algorithm, self.salt, digest_padding,
+                              hash_level_offsets, tree_size, num_threads,
+                              stats=stats)
+  def check_fec(self, image_dir, image_ext, image_containing_descriptor,
+                accept_zeroed_hashtree, repair, context=None):
+    """Checks the FEC data - used in verify_image sub-command.
+    Arguments:
+      image_dir: The directory of the file being verified.
+      image_ext: The extension of the file being verified (e.g. '.img').
+      image_containing_descriptor: The image the descriptor is in.
+      accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
+          zeroed out.
+      repair: If True, correct the errors FEC data can correct in place.
+      context: The VerifyContext to write messages to, None for sys.stdout
+          and sys.stderr.
+    Returns:
+      True if the FEC data checks out or the image was repaired, False
+      otherwise.
+    """
+    context = _verify_context(context)
+    if not self.partition_name:
+      image_filename = image_containing_descriptor.filename
+      image = image_containing_descriptor
+    else:
+      image_filename = os.path.join(image_dir, self.partition_name + image_ext)
+      image = ImageHandler(image_filename, read_only=not repair)
+    if self.fec_num_roots == 0:
+      print('{}: No FEC data to check'.format(self.partition_name),
+            file=context.out)
+      return True
+    image.seek(self.fec_offset)
+    fec_data = image.read(self.fec_size)
+    if fec_data[0:8] == b'ZeRoHaSH' and accept_zeroed_hashtree:
+      print('{}: skipping FEC check since FEC data is zeroed and '
+            '--accept_zeroed_hashtree was given'
+            .format(self.partition_name), file=context.out)
+      return True
+    # The FEC data covers everything in front of it.
+    try:
+      fixes = check_fec_data(image, self.fec_offset, fec_data,
+                             self.fec_num_roots, context.num_threads)
+    except ValueError as e:
+      context.err.write('FEC data of {} cannot be used: {}\n'.
+                        format(image_filename, e))
+      return False
+    if not fixes:
+      print('{}: Successfully verified FEC data of {} for {} bytes'
+            .format(self.partition_name, image.filename, self.fec_offset),
+            file=context.out)
+      return True
+    if not repair:
+      context.err.write('{} has {} corrupted bytes, use --repair to correct '
+                        'them\n'.format(image_filename, len(fixes)))
+      return False
+    # Codewords with more errors than FEC can correct may decode to the
+    # wrong codeword, so the repair is only kept if the hashtree matches
+    # afterwards.
+    originals = []
+    for offset, _ in fixes:
+      image.seek(offset)
+      originals.append((offset, image.read(1)[0]))
+    self._write_fixes(image, fixes)
+    root_digest, hash_tree = self._generate_hash_tree(
+        image, context.num_threads, context.stats)
+    image.seek(self.tree_offset)
+    if ((self.root_digest and root_digest != self.root_digest)
+        or hash_tree != image.read(self.tree_size)):
+      self._write_fixes(image, originals)
+      context.err.write('FEC data of {} did not repair the hashtree, changes '
+                        'reverted\n'.format(image_filename))
+      return False
+    print('{}: Repaired {} corrupted bytes in {} using FEC data'
+          .format(self.partition_name, len(fixes), image.filename),
+          file=context.out)
+    return True
+  def _write_fixes(self, image, fixes):
+    """Writes (offset, value) pairs sorted by offset to |image|.
+    Runs of consecutive bytes, e.g. a corrupted block, are written in one go.
+    Arguments:
+      image: A writable ImageHandler.
+      fixes: The sorted list of (offset, value) pairs.
+    """
+    start = 0
+    for i in range(1, len(fixes) + 1):
+      if i == len(fixes) or fixes[i][0] != fixes[i - 1][0] + 1:
+        image.write_at(fixes[start][0],
+                       bytes(value for _, value in fixes[start:i]))
+        start = i
 class AvbHashDescriptor(AvbDescriptor):
   """A class for hash descriptors.
   See the |AvbHashDescriptor| C struct for more information.
@@ -1358,45 +2038,59 @@ class AvbHashDescriptor(AvbDescriptor):
   def __init__(self, data=None):
     """Initializes a new hash descriptor.
     Arguments:
-      data: If not None, must be bytes of size |SIZE|.
-    Raises:
-      LookupError: If the given descriptor is malformed.
+      data: If not None, the encoded descriptor as bytes-like object.
     """
-    super().__init__(None)
     assert struct.calcsize(self.FORMAT_STRING) == self.SIZE
     if data:
-      (tag, num_bytes_following, self.image_size, self.hash_algorithm,
-       partition_name_len, salt_len,
-       digest_len, self.flags, _) = struct.unpack(self.FORMAT_STRING,
-                                                  data[0:self.SIZE])
-      expected_size = round_to_multiple(
-          self.SIZE - 16 + partition_name_len + salt_len + digest_len, 8)
-      if tag != self.TAG or num_bytes_following != expected_size:
-        raise LookupError('Given data does not look like a hash descriptor.')
-      # Nuke NUL-bytes at the end.
-      self.hash_algorithm = self.hash_algorithm.rstrip(b'\0').decode('ascii')
-      o = 0
-      try:
-        self.partition_name = data[
-            (self.SIZE + o):(self.SIZE + o + partition_name_len)
-        ].decode('utf-8')
-      except UnicodeDecodeError as e:
-        raise LookupError('Partition name cannot be decoded as UTF-8: {}.'
-                          .format(e)) from e
-      o += partition_name_len
-      self.salt = data[(self.SIZE + o):(self.SIZE + o + salt_len)]
-      o += salt_len
-      self.digest = data[(self.SIZE + o):(self.SIZE + o + digest_len)]
-      if digest_len != len(hashlib.new(self.hash_algorithm).digest()):
-        if digest_len != 0:
-          raise LookupError('digest_len doesn\'t match hash algorithm')
+      self._set_raw(data)
     else:
+      super().__init__(None)
       self.image_size = 0
       self.hash_algorithm = ''
       self.partition_name = ''
       self.salt = b''
       self.digest = b''
       self.flags = 0
+  def _decode(self, raw):
+    """Decodes the fields of the descriptor.
+    Arguments:
+      raw: The encoded descriptor as memoryview.
+    Returns:
+      A dict with the attributes of the descriptor.
+    Raises:
+      LookupError: If the given descriptor is malformed.
+    """
+    (tag, num_bytes_following, image_size, hash_algorithm,
+     partition_name_len, salt_len,
+     digest_len, flags, _) = struct.unpack(self.FORMAT_STRING,
+                                           raw[0:self.SIZE])
+    expected_size = round_to_multiple(
+        self.SIZE - 16 + partition_name_len + salt_len + digest_len, 8)
+    if tag != self.TAG or num_bytes_following != expected_size:
+      raise LookupError('Given data does not look like a hash descriptor.')
+    # Nuke NUL-bytes at the end.
+    hash_algorithm = hash_algorithm.rstrip(b'\0').decode('ascii')
+    o = self.SIZE
+    try:
+      partition_name = str(raw[o:(o + partition_name_len)], 'utf-8')
+    except UnicodeDecodeError as e:
+      raise LookupError('Partition name cannot be decoded as UTF-8: {}.'
+                        .format(e)) from e
+    o += partition_name_len
+    salt = raw[o:(o + salt_len)].tobytes()
+    o += salt_len
+    digest = raw[o:(o + digest_len)].tobytes()
+    if digest_len != hashlib.new(hash_algorithm).digest_size:
+      if digest_len != 0:
+        raise LookupError('digest_len doesn\'t match hash algorithm')
+    return {
+        'image_size': image_size,
+        'hash_algorithm': hash_algorithm,
+        'partition_name': partition_name,
+        'salt': salt,
+        'digest': digest,
+        'flags': flags,
+    }
   def print_desc(self, o):
     """Print the descriptor.
     Arguments:
@@ -1414,6 +2108,8 @@ class AvbHashDescriptor(AvbDescriptor):
     Returns:
       The descriptor data as bytes.
     """
+    if self._raw is not None:
+      return self._raw.tobytes()
     hash_algorithm_encoded = self.hash_algorithm.encode('ascii')
     partition_name_encoded = self.partition_name.encode('utf-8')
     num_bytes_following = (self.SIZE + len(partition_name_encoded) +
@@ -1428,7 +2124,8 @@ class AvbHashDescriptor(AvbDescriptor):
            padding_size * b'\0')
     return ret
   def verify(self, image_dir, image_ext, expected_chain_partitions_map,
-             image_containing_descriptor, accept_zeroed_hashtree):
+             image_containing_descriptor, accept_zeroed_hashtree,
+             context=None):
     """Verifies contents of the descriptor - used in verify_image sub-command.
     Arguments:
       image_dir: The directory of the file being verified.
@@ -1438,28 +2135,30 @@ class AvbHashDescriptor(AvbDescriptor):
       image_containing_descriptor: The image the descriptor is in.
       accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
           zeroed out.
+      context: The VerifyContext to write messages to, None for sys.stdout
+          and sys.stderr.
     Returns:
       True if the descriptor verifies, False otherwise.
     """
+    context = _verify_context(context)
     if not self.partition_name:
       image_filename = image_containing_descriptor.filename
       image = image_containing_descriptor
     else:
       image_filename = os.path.join(image_dir, self.partition_name + image_ext)
       image = ImageHandler(image_filename, read_only=True)
-    data = image.read(self.image_size)
     ha = hashlib.new(self.hash_algorithm)
     ha.update(self.salt)
-    ha.update(data)
+    update_hash_from_image(ha, image, self.image_size, stats=context.stats)
     digest = ha.digest()
     # The digest must match unless there is no digest in the descriptor.
     if self.digest and digest != self.digest:
-      sys.stderr.write('{} digest of {} does not match digest in descriptor\n'.
-                       format(self.hash_algorithm, image_filename))
+      context.err.write('{} digest of {} does not match digest in descriptor\n'
+                        .format(self.hash_algorithm, image_filename))
       return False
     print('{}: Successfully verified {} hash of {} for image of {} bytes'
           .format(self.partition_name, self.hash_algorithm, image.filename,
-                  self.image_size))
+                  self.image_size), file=context.out)
     return True
 class AvbKernelCmdlineDescriptor(AvbDescriptor):
   """A class for kernel command-line descriptors.
@@ -1478,30 +2177,39 @@ class AvbKernelCmdlineDescriptor(AvbDescriptor):
   def __init__(self, data=None):
     """Initializes a new kernel cmdline descriptor.
     Arguments:
-      data: If not None, must be bytes of size |SIZE|.
-    Raises:
-      LookupError: If the given descriptor is malformed.
+      data: If not None, the encoded descriptor as bytes-like object.
     """
-    super().__init__(None)
     assert struct.calcsize(self.FORMAT_STRING) == self.SIZE
     if data:
-      (tag, num_bytes_following, self.flags, kernel_cmdline_length) = (
-          struct.unpack(self.FORMAT_STRING, data[0:self.SIZE]))
-      expected_size = round_to_multiple(self.SIZE - 16 + kernel_cmdline_length,
-                                        8)
-      if tag != self.TAG or num_bytes_following != expected_size:
-        raise LookupError('Given data does not look like a kernel cmdline '
-                          'descriptor.')
-      # Nuke NUL-bytes at the end.
-      try:
-        self.kernel_cmdline = data[
-            self.SIZE:(self.SIZE + kernel_cmdline_length)].decode('utf-8')
-      except UnicodeDecodeError as e:
-        raise LookupError('Kernel command-line cannot be decoded as UTF-8: {}.'
-                          .format(e)) from e
+      self._set_raw(data)
     else:
+      super().__init__(None)
       self.flags = 0
       self.kernel_cmdline = ''
+  def _decode(self, raw):
+    """Decodes the fields of the descriptor.
+    Arguments:
+      raw: The encoded descriptor as memoryview.
+    Returns:
+      A dict with the attributes of the descriptor.
+    Raises:
+      LookupError: If the given descriptor is malformed.
+    """
+    (tag, num_bytes_following, flags, kernel_cmdline_length) = (
+        struct.unpack(self.FORMAT_STRING, raw[0:self.SIZE]))
+    expected_size = round_to_multiple(self.SIZE - 16 + kernel_cmdline_length,
+                                      8)
+    if tag != self.TAG or num_bytes_following != expected_size:
+      raise LookupError('Given data does not look like a kernel cmdline '
+                        'descriptor.')
+    # Nuke NUL-bytes at the end.
+    try:
+      kernel_cmdline = str(raw[self.SIZE:(self.SIZE + kernel_cmdline_length)],
+                           'utf-8')
+    except UnicodeDecodeError as e:
+      raise LookupError('Kernel command-line cannot be decoded as UTF-8: {}.'
+                        .format(e)) from e
+    return {'flags': flags, 'kernel_cmdline': kernel_cmdline}
   def print_desc(self, o):
     """Print the descriptor.
     Arguments:
@@ -1515,6 +2223,8 @@ class AvbKernelCmdlineDescriptor(AvbDescriptor):
     Returns:
       The descriptor data as bytes.
     """
+    if self._raw is not None:
+      return self._raw.tobytes()
     kernel_cmd_encoded = self.kernel_cmdline.encode('utf-8')
     num_bytes_following = (self.SIZE + len(kernel_cmd_encoded) - 16)
     nbf_with_padding = round_to_multiple(num_bytes_following, 8)
@@ -1524,7 +2234,8 @@ class AvbKernelCmdlineDescriptor(AvbDescriptor):
     ret = desc + kernel_cmd_encoded + padding_size * b'\0'
     return ret
   def verify(self, image_dir, image_ext, expected_chain_partitions_map,
-             image_containing_descriptor, accept_zeroed_hashtree):
+             image_containing_descriptor, accept_zeroed_hashtree,
+             context=None):
     """Verifies contents of the descriptor - used in verify_image sub-command.
     Arguments:
       image_dir: The directory of the file being verified.
@@ -1534,6 +2245,8 @@ class AvbKernelCmdlineDescriptor(AvbDescriptor):
       image_containing_descriptor: The image the descriptor is in.
       accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
           zeroed out.
+      context: The VerifyContext to write messages to, None for sys.stdout
+          and sys.stderr.
     Returns:
       True if the descriptor verifies, False otherwise.
     """
@@ -1560,37 +2273,49 @@ class AvbChainPartitionDescriptor(AvbDescriptor):
   def __init__(self, data=None):
     """Initializes a new chain partition descriptor.
     Arguments:
-      data: If not None, must be a bytearray of size |SIZE|.
-    Raises:
-      LookupError: If the given descriptor is malformed.
+      data: If not None, the encoded descriptor as bytes-like object.
     """
-    AvbDescriptor.__init__(self, None)
     assert struct.calcsize(self.FORMAT_STRING) == self.SIZE
     if data:
-      (tag, num_bytes_following, self.rollback_index_location,
-       partition_name_len,
-       public_key_len, self.flags, _) = struct.unpack(self.FORMAT_STRING,
-                                                      data[0:self.SIZE])
-      expected_size = round_to_multiple(
-          self.SIZE - 16 + partition_name_len + public_key_len, 8)
-      if tag != self.TAG or num_bytes_following != expected_size:
-        raise LookupError('Given data does not look like a chain partition '
-                          'descriptor.')
-      o = 0
-      try:
-        self.partition_name = data[
-            (self.SIZE + o):(self.SIZE + o + partition_name_len)
-        ].decode('utf-8')
-      except UnicodeDecodeError as e:
-        raise LookupError('Partition name cannot be decoded as UTF-8: {}.'
-                          .format(e)) from e
-      o += partition_name_len
-      self.public_key = data[(self.SIZE + o):(self.SIZE + o + public_key_len)]
+      self._set_raw(data)
     else:
+      AvbDescriptor.__init__(self, None)
       self.rollback_index_location = 0
       self.partition_name = ''
       self.public_key = b''
       self.flags = 0
+  def _decode(self, raw):
+    """Decodes the fields of the descriptor.
+    Arguments:
+      raw: The encoded descriptor as memoryview.
+    Returns:
+      A dict with the attributes of the descriptor.
+    Raises:
+      LookupError: If the given descriptor is malformed.
+    """
+    (tag, num_bytes_following, rollback_index_location,
+     partition_name_len,
+     public_key_len, flags, _) = struct.unpack(self.FORMAT_STRING,
+                                               raw[0:self.SIZE])
+    expected_size = round_to_multiple(
+        self.SIZE - 16 + partition_name_len + public_key_len, 8)
+    if tag != self.TAG or num_bytes_following != expected_size:
+      raise LookupError('Given data does not look like a chain partition '
+                        'descriptor.')
+    o = self.SIZE
+    try:
+      partition_name = str(raw[o:(o + partition_name_len)], 'utf-8')
+    except UnicodeDecodeError as e:
+      raise LookupError('Partition name cannot be decoded as UTF-8: {}.'
+                        .format(e)) from e
+    o += partition_name_len
+    public_key = raw[o:(o + public_key_len)].tobytes()
+    return {
+        'rollback_index_location': rollback_index_location,
+        'partition_name': partition_name,
+        'public_key': public_key,
+        'flags': flags,
+    }
   def print_desc(self, o):
     """Print the descriptor.
     Arguments:
@@ -1609,6 +2334,8 @@ class AvbChainPartitionDescriptor(AvbDescriptor):
     Returns:
       The descriptor data as bytes.
     """
+    if self._raw is not None:
+      return self._raw.tobytes()
     partition_name_encoded = self.partition_name.encode('utf-8')
     num_bytes_following = (
         self.SIZE + len(partition_name_encoded) + len(self.public_key) - 16)
@@ -1621,7 +2348,8 @@ class AvbChainPartitionDescriptor(AvbDescriptor):
     ret = desc + partition_name_encoded + self.public_key + padding_size * b'\0'
     return ret
   def verify(self, image_dir, image_ext, expected_chain_partitions_map,
-             image_containing_descriptor, accept_zeroed_hashtree):
+             image_containing_descriptor, accept_zeroed_hashtree,
+             context=None):
     """Verifies contents of the descriptor - used in verify_image sub-command.
     Arguments:
       image_dir: The directory of the file being verified.
@@ -1631,31 +2359,34 @@ class AvbChainPartitionDescriptor(AvbDescriptor):
       image_containing_descriptor: The image the descriptor is in.
       accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
           zeroed out.
+      context: The VerifyContext to write messages to, None for sys.stdout
+          and sys.stderr.
     Returns:
       True if the descriptor verifies, False otherwise.
     """
+    context = _verify_context(context)
     value = expected_chain_partitions_map.get(self.partition_name)
     if not value:
-      sys.stderr.write('No expected chain partition for partition {}. Use '
-                       '--expected_chain_partition to specify expected '
-                       'contents or --follow_chain_partitions.\n'.
-                       format(self.partition_name))
+      context.err.write('No expected chain partition for partition {}. Use '
+                        '--expected_chain_partition to specify expected '
+                        'contents or --follow_chain_partitions.\n'.
+                        format(self.partition_name))
       return False
     rollback_index_location, pk_blob = value
     if self.rollback_index_location != rollback_index_location:
-      sys.stderr.write('Expected rollback_index_location {} does not '
-                       'match {} in descriptor for partition {}\n'.
-                       format(rollback_index_location,
-                              self.rollback_index_location,
-                              self.partition_name))
+      context.err.write('Expected rollback_index_location {} does not '
+                        'match {} in descriptor for partition {}\n'.
+                        format(rollback_index_location,
+                               self.rollback_index_location,
+                               self.partition_name))
       return False
     if self.public_key != pk_blob:
-      sys.stderr.write('Expected public key blob does not match public '
-                       'key blob in descriptor for partition {}\n'.
-                       format(self.partition_name))
+      context.err.write('Expected public key blob does not match public '
+                        'key blob in descriptor for partition {}\n'.
+                        format(self.partition_name))
       return False
     print('{}: Successfully verified chain partition descriptor matches '
-          'expected data'.format(self.partition_name))
+          'expected data'.format(self.partition_name), file=context.out)
     return True
 DESCRIPTOR_CLASSES = [
     AvbPropertyDescriptor, AvbHashtreeDescriptor, AvbHashDescriptor,
@@ -1663,12 +2394,16 @@ DESCRIPTOR_CLASSES = [
 ]
 def parse_descriptors(data):
   """Parses a blob of data into descriptors.
+  The descriptors refer to |data| instead of copying their encoding and
+  their fields are only decoded when accessed, so LookupError for a
+  malformed descriptor is raised then.
   Arguments:
-    data: Encoded descriptors as bytes.
+    data: Encoded descriptors as bytes-like object.
   Returns:
     A list of instances of objects derived from AvbDescriptor. For
     unknown descriptors, the class AvbDescriptor is used.
   """
+  data = memoryview(data)
   o = 0
   ret = []
   while o < len(data):
@@ -1868,6 +2603,273 @@ class AvbVBMetaHeader(object):
                        self.public_key_metadata_size, self.descriptors_offset,
                        self.descriptors_size, self.rollback_index, self.flags,
                        self.rollback_index_location, release_string_encoded)
+class ImageVBMeta(object):
+  """The vbmeta struct of an image, as found by locate_vbmeta().
+  Attributes:
+    footer: An AvbFooter or None if the image has no footer.
+    header: The AvbVBMetaHeader.
+    offset: Offset of the vbmeta struct in the image.
+    blob: The vbmeta struct with its authentication and auxiliary blocks.
+  """
+  def __init__(self, footer, offset, blob):
+    """Initializes the vbmeta struct.
+    Arguments:
+      footer: An AvbFooter or None.
+      offset: Offset of the vbmeta struct in the image.
+      blob: The vbmeta struct, at least the header.
+    Raises:
+      AvbError: If |blob| is not a vbmeta struct.
+    """
+    self.footer = footer
+    self.offset = offset
+    self.header = AvbVBMetaHeader(blob[0:AvbVBMetaHeader.SIZE])
+    self.blob = blob
+  @property
+  def size(self):
+    """Size of the vbmeta struct according to its header."""
+    return (AvbVBMetaHeader.SIZE + self.header.authentication_data_block_size
+            + self.header.auxiliary_data_block_size)
+  def descriptors(self):
+    """Parses the descriptors.
+    Returns:
+      A list of AvbDescriptor-derived instances, new ones on each call.
+    """
+    start = (AvbVBMetaHeader.SIZE
+             + self.header.authentication_data_block_size
+             + self.header.descriptors_offset)
+    return parse_descriptors(self.blob[start:start
+                                       + self.header.descriptors_size])
+def _locate_sparse_vbmeta(image):
+  """Finds the vbmeta struct from the last chunks of a sparse image.
+  avbtool writes the footer block of a sparse image as the last RAW chunk
+  and the vbmeta struct as a RAW chunk of its own before it, with at most
+  a DONT_CARE chunk in between. Such images are read from the end without
+  building the chunk table.
+  Arguments:
+    image: A sparse ImageHandler.
+  Returns:
+    An ImageVBMeta or None if the chunks aren't laid out like that.
+  """
+  block_size = image.block_size
+  chunk = image.find_chunk_before(None, ImageChunk.TYPE_RAW, block_size)
+  if chunk is None:
+    return None
+  try:
+    footer = AvbFooter(chunk[1][-AvbFooter.SIZE:])
+  except (LookupError, struct.error):
+    return None
+  vbmeta_size = round_to_multiple(footer.vbmeta_size, block_size)
+  gap = image.image_size - block_size - footer.vbmeta_offset - vbmeta_size
+  if gap < 0 or footer.vbmeta_offset % block_size:
+    return None
+  chunk_pos = chunk[0]
+  if gap:
+    chunk = image.find_chunk_before(chunk_pos, ImageChunk.TYPE_DONT_CARE, gap)
+    if chunk is None:
+      return None
+    chunk_pos = chunk[0]
+  chunk = image.find_chunk_before(chunk_pos, ImageChunk.TYPE_RAW, vbmeta_size)
+  if chunk is None:
+    return None
+  try:
+    vbmeta = ImageVBMeta(footer, footer.vbmeta_offset, chunk[1])
+  except (AvbError, struct.error):
+    return None
+  if vbmeta.size > len(chunk[1]):
+    return None
+  vbmeta.blob = chunk[1][0:vbmeta.size]
+  return vbmeta
+def locate_vbmeta(image):
+  """Finds the vbmeta struct of an image.
+  The image can either be a vbmeta image or an image with a footer. The
+  footer, header and the rest of the vbmeta struct are read once and
+  cached in |image| until it is modified.
+  Arguments:
+    image: An ImageHandler.
+  Returns:
+    An ImageVBMeta.
+  Raises:
+    AvbError: If there is no vbmeta struct where expected.
+  """
+  if image.vbmeta is not None:
+    return image.vbmeta
+  vbmeta = _locate_sparse_vbmeta(image) if image.is_sparse else None
+  if vbmeta is None:
+    footer = None
+    image.seek(image.image_size - AvbFooter.SIZE)
+    try:
+      footer = AvbFooter(image.read(AvbFooter.SIZE))
+    except (LookupError, struct.error):
+      pass
+    offset = 0
+    if footer:
+      offset = footer.vbmeta_offset
+    image.seek(offset)
+    vbmeta = ImageVBMeta(footer, offset, image.read(AvbVBMetaHeader.SIZE))
+    vbmeta.blob += image.read(vbmeta.size - AvbVBMetaHeader.SIZE)
+  image.vbmeta = vbmeta
+  return vbmeta
+# |func| is called with a VerifyContext and returns None or a dict of
+# results for reports.
+VerifyTask = collections.namedtuple('VerifyTask', 'image name stage func')
+VerifyResult = collections.namedtuple('VerifyResult',
+                                      'task details error events stats')
+class VerifyStats(object):
+  """Counters of the work done by a verification task.
+  Attributes:
+    elapsed: Wall time of the task in seconds.
+    io_time: Seconds spent reading images.
+    hash_time: Seconds spent hashing.
+    rsa_time: Seconds spent on RSA operations.
+    bytes_hashed: Number of bytes of image data read and hashed.
+  """
+  __slots__ = ('elapsed', 'io_time', 'hash_time', 'rsa_time', 'bytes_hashed')
+  def __init__(self):
+    self.elapsed = 0.0
+    self.io_time = 0.0
+    self.hash_time = 0.0
+    self.rsa_time = 0.0
+    self.bytes_hashed = 0
+class _VerifyStream(object):
+  """File-like object recording what is written to it as events."""
+  def __init__(self, events, name):
+    """Initializes the stream.
+    Arguments:
+      events: The list to append (name, text) pairs to.
+      name: Name of the stream, 'stdout' or 'stderr'.
+    """
+    self._events = events
+    self._name = name
+  def write(self, text):
+    self._events.append((self._name, text))
+    return len(text)
+  def flush(self):
+    pass
+class VerifyContext(object):
+  """Where a verification task writes its messages and counts its work.
+  Tasks run at the same time, so rather than printing they write to the
+  |out| and |err| streams of their own context and run_verify_tasks()
+  replays the output in order.
+  Attributes:
+    out: File-like object for progress messages.
+    err: File-like object for error messages.
+    events: The (stream name, text) pairs written to |out| and |err|, or
+      None if they are written through.
+    num_threads: Number of threads the task may hash with, None for the
+      CPU count.
+    stats: The VerifyStats of the task.
+  """
+  def __init__(self, out=None, err=None, num_threads=None):
+    """Initializes the context.
+    Arguments:
+      out: Stream to write progress messages to, None to record them.
+      err: Stream to write error messages to, None to record them.
+      num_threads: Number of threads the task may hash with.
+    """
+    self.events = None
+    if out is None or err is None:
+      self.events = []
+    self.out = _VerifyStream(self.events, 'stdout') if out is None else out
+    self.err = _VerifyStream(self.events, 'stderr') if err is None else err
+    self.num_threads = num_threads
+    self.stats = VerifyStats()
+def _verify_context(context):
+  """Returns |context| or one writing to sys.stdout and sys.stderr."""
+  if context is None:
+    return VerifyContext(sys.stdout, sys.stderr)
+  return context
+def _run_verify_task(task, num_threads=None):
+  """Runs a VerifyTask, recording what it prints and the work it does.
+  Arguments:
+    task: The VerifyTask to run.
+    num_threads: Number of threads the task may hash with.
+  Returns:
+    A VerifyResult with the dict of details the task returned, the
+    exception it raised or None, the (stream name, text) pairs it printed
+    and its VerifyStats.
+  """
+  context = VerifyContext(num_threads=num_threads)
+  start = time.perf_counter()
+  details = None
+  error = None
+  try:
+    details = task.func(context)
+  except Exception as e:  # pylint: disable=broad-except
+    error = e
+  context.stats.elapsed = time.perf_counter() - start
+  return VerifyResult(task, details or {}, error, context.events,
+                      context.stats)
+def run_verify_tasks(tasks, num_threads=None, results=None):
+  """Runs verification tasks, several at a time, as if run in order.
+  Each task writes to a VerifyContext of its own. What they wrote is
+  replayed to sys.stdout and sys.stderr in the order of |tasks| so the
+  output is the same as when running them one by one, and the exception
+  of the first task that fails is re-raised after its output. Tasks
+  running side by side hash on one thread each, a task running alone may
+  use the CPU count.
+  If |results| is given, nothing is printed or raised. All tasks are run
+  and their VerifyResult appended to |results| in the order of |tasks|.
+  Arguments:
+    tasks: A list of VerifyTask.
+    num_threads: Number of tasks to run at a time, None for the CPU count.
+    results: None or a list to collect the results in.
+  Raises:
+    Exception: The exception raised by the first failing task.
+  """
+  if num_threads is None:
+    num_threads = os.cpu_count() or 1
+  executor = None
+  if num_threads > 1 and len(tasks) > 1:
+    executor = concurrent.futures.ThreadPoolExecutor(num_threads)
+  try:
+    mapped = None
+    if executor is not None:
+      try:
+        mapped = executor.map(
+            functools.partial(_run_verify_task, num_threads=1), tasks)
+      except RuntimeError:
+        # Threads can't be started, e.g. on WebAssembly builds.
+        executor.shutdown()
+        executor = None
+    if mapped is None:
+      mapped = map(_run_verify_task, tasks)
+    for result in mapped:
+      if results is not None:
+        results.append(result)
+        continue
+      for name, text in result.events:
+        (sys.stdout if name == 'stdout' else sys.stderr).write(text)
+      if result.error is not None:
+        raise result.error
+  finally:
+    if executor is not None:
+      executor.shutdown(cancel_futures=True)
+def _verify_result_json(result):
+  """Converts a VerifyResult to the dict reported by verify_image.
+  Arguments:
+    result: A VerifyResult.
+  Returns:
+    A dict which can be serialized to JSON.
+  """
+  stats = result.stats
+  entry = {
+      'image': result.task.image,
+      'name': result.task.name,
+      'stage': result.task.stage,
+      'ok': result.error is None,
+      'error': None if result.error is None else str(result.error),
+      'messages': [line for _, text in result.events
+                   for line in text.splitlines() if line],
+      'elapsed_s': stats.elapsed,
+      'io_s': stats.io_time,
+      'hash_s': stats.hash_time,
+      'rsa_s': stats.rsa_time,
+      'bytes_hashed': stats.bytes_hashed,
+      'throughput_bytes_per_s': (stats.bytes_hashed / stats.elapsed
+                                 if stats.elapsed else 0.0),
+  }
+  entry.update(result.details)
+  return entry
 class Avb(object):
   """Business logic for avbtool command-line tool."""
   # Keep in sync with avb_ab_flow.h.
@@ -2142,8 +3144,15 @@ class Avb(object):
       o.write('    Product Signing Key:\n')
       print_certificate(psk)
   def verify_image(self, image_filename, key_path, expected_chain_partitions,
-                   follow_chain_partitions, accept_zeroed_hashtree):
+                   follow_chain_partitions, accept_zeroed_hashtree,
+                   check_fec=False, repair=False, num_threads=None,
+                   report=None, output=None):
     """Implements the 'verify_image' command.
+    The vbmeta structs of the image and of the chained partitions are
+    parsed first, then the checks of all partitions run at the same time.
+    With |report| set to 'json' every check is run even if some fail, and
+    the result, timings and amount of data hashed of each check are
+    written to |output| as JSON instead of printing progress.
     Arguments:
       image_filename: Image file to get information from (file object).
       key_path: None or check that embedded public key matches key at given
@@ -2154,6 +3163,13 @@ class Avb(object):
           the --expected_chain_partition option
       accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
           zeroed out.
+      check_fec: If True, also check the FEC data of hashtree descriptors.
+      repair: If True, check the FEC data and use it to correct corrupted
+          data in place before verifying the hashtree.
+      num_threads: Number of checks to run at a time, None for the CPU count.
+          Checks run one at a time when repairing.
+      report: None or 'json' to write a report of all checks.
+      output: The file to write the report to, None for stdout.
     Raises:
       AvbError: If verification of the image fails.
     """
@@ -2170,67 +3186,196 @@ class Avb(object):
           pk_blob = f.read()
         expected_chain_partitions_map[partition_name] = (
             rollback_index_location, pk_blob)
+    if report not in (None, 'json'):
+      raise AvbError('Unknown report format {}.'.format(report))
+    start = time.perf_counter()
+    tasks = []
+    self._plan_verify_image(tasks, image_filename, key_path,
+                            expected_chain_partitions_map,
+                            follow_chain_partitions, accept_zeroed_hashtree,
+                            check_fec, repair)
+    if repair:
+      num_threads = 1
+    if not report:
+      run_verify_tasks(tasks, num_threads)
+      return
+    plan_time = time.perf_counter() - start
+    results = []
+    run_verify_tasks(tasks, num_threads, results)
+    entries = [_verify_result_json(result) for result in results
+               if result.task.stage]
+    num_failed = sum(1 for entry in entries if not entry['ok'])
+    (output or sys.stdout).write(json.dumps({
+        'image': image_filename,
+        'ok': num_failed == 0,
+        'num_failed': num_failed,
+        'plan_s': plan_time,
+        'elapsed_s': time.perf_counter() - start,
+        'bytes_hashed': sum(entry['bytes_hashed'] for entry in entries),
+        'results': entries,
+    }, indent=2) + '\n')
+    if num_failed:
+      raise AvbError('{} of {} checks failed.'.format(num_failed,
+                                                      len(entries)))
+  def _plan_verify_image(self, tasks, image_filename, key_path,
+                         expected_chain_partitions_map,
+                         follow_chain_partitions, accept_zeroed_hashtree,
+                         check_fec, repair):
+    """Adds the checks of the 'verify_image' command to a list of tasks.
+    Only the vbmeta struct of the image is read here. Errors are raised
+    by the tasks so they are reported in the same place as when checking
+    one thing after another. Tasks with no stage only print and are left
+    out of reports.
+    Arguments:
+      tasks: The list of VerifyTask to add to.
+      image_filename: Image file to verify.
+      key_path: None or check that embedded public key matches key at given
+          path.
+      expected_chain_partitions_map: A map from partition name to the
+          tuple (rollback_index_location, key_blob).
+      follow_chain_partitions: If True, also verify chained partitions.
+      accept_zeroed_hashtree: If True, don't fail if hashtree or FEC data is
+          zeroed out.
+      check_fec: If True, also check the FEC data of hashtree descriptors.
+      repair: If True, correct corrupted data using FEC data.
+    """
     image_dir = os.path.dirname(image_filename)
     image_ext = os.path.splitext(image_filename)[1]
-    key_blob = None
-    if key_path:
-      print('Verifying image {} using key at {}'.format(image_filename,
-                                                        key_path))
-      key_blob = RSAPublicKey(key_path).encode()
-    else:
-      print('Verifying image {} using embedded public key'.format(
-          image_filename))
-    image = ImageHandler(image_filename, read_only=True)
-    (footer, header, descriptors, _) = self._parse_image(image)
-    offset = 0
-    if footer:
-      offset = footer.vbmeta_offset
-    image.seek(offset)
-    vbmeta_blob = image.read(header.SIZE
-                             + header.authentication_data_block_size
-                             + header.auxiliary_data_block_size)
-    alg_name, _ = lookup_algorithm_by_type(header.algorithm_type)
-    if not verify_vbmeta_signature(header, vbmeta_blob):
-      raise AvbError('Signature check failed for {} vbmeta struct {}'
-                     .format(alg_name, image_filename))
-    if key_blob:
-      # The embedded public key is in the auxiliary block at an offset.
-      key_offset = AvbVBMetaHeader.SIZE
-      key_offset += header.authentication_data_block_size
-      key_offset += header.public_key_offset
-      key_blob_in_vbmeta = vbmeta_blob[key_offset:key_offset
-                                       + header.public_key_size]
-      if key_blob != key_blob_in_vbmeta:
+    image = None
+    footer = header = descriptors = vbmeta_blob = None
+    parse_error = None
+    try:
+      image = ImageHandler(image_filename, read_only=not repair)
+      (footer, header, descriptors, _) = self._parse_image(image)
+      offset = 0
+      if footer:
+        offset = footer.vbmeta_offset
+      image.seek(offset)
+      vbmeta_blob = image.read(header.SIZE
+                               + header.authentication_data_block_size
+                               + header.auxiliary_data_block_size)
+    except Exception as e:  # pylint: disable=broad-except
+      parse_error = e
+    def verify_vbmeta(context):
+      key_blob = None
+      if key_path:
+        print('Verifying image {} using key at {}'.format(image_filename,
+                                                          key_path),
+              file=context.out)
+        key_blob = RSAPublicKey(key_path).encode()
+      else:
+        print('Verifying image {} using embedded public key'.format(
+            image_filename), file=context.out)
+      if parse_error:
+        raise parse_error
+      alg_name, _ = lookup_algorithm_by_type(header.algorithm_type)
+      details = dict(algorithm=alg_name, footer=footer is not None,
+                     rollback_index=header.rollback_index,
+                     rollback_index_location=header.rollback_index_location)
+      details['signature_valid'] = verify_vbmeta_signature(
+          header, vbmeta_blob, context.stats)
+      if key_blob:
+        # The embedded public key is in the auxiliary block at an offset.
+        key_offset = AvbVBMetaHeader.SIZE
+        key_offset += header.authentication_data_block_size
+        key_offset += header.public_key_offset
+        key_blob_in_vbmeta = vbmeta_blob[key_offset:key_offset
+                                         + header.public_key_size]
+        details['key_match'] = key_blob == key_blob_in_vbmeta
+      if not details['signature_valid']:
+        raise AvbError('Signature check failed for {} vbmeta struct {}'
+                       .format(alg_name, image_filename))
+      if not details.get('key_match', True):
         raise AvbError('Embedded public key does not match given key.')
-    if footer:
-      print('vbmeta: Successfully verified footer and {} vbmeta struct in {}'
-            .format(alg_name, image.filename))
-    else:
-      print('vbmeta: Successfully verified {} vbmeta struct in {}'
-            .format(alg_name, image.filename))
+      if footer:
+        print('vbmeta: Successfully verified footer and {} vbmeta struct in {}'
+              .format(alg_name, image.filename), file=context.out)
+      else:
+        print('vbmeta: Successfully verified {} vbmeta struct in {}'
+              .format(alg_name, image.filename), file=context.out)
+      return details
+    tasks.append(VerifyTask(image_filename, 'vbmeta', 'vbmeta',
+                            verify_vbmeta))
+    if parse_error:
+      return
+    def open_image():
+      # Tasks run at the same time, so don't share the file position.
+      return ImageHandler(image_filename, read_only=not repair)
+    def check_descriptor_fec(desc, context):
+      if not desc.check_fec(image_dir, image_ext, open_image(),
+                            accept_zeroed_hashtree, repair, context):
+        raise AvbError('Error checking FEC data.')
+      return dict(fec_num_roots=desc.fec_num_roots, fec_size=desc.fec_size)
+    def verify_descriptor(desc, context):
+      details = {}
+      desc_image = image
+      if isinstance(desc, (AvbHashDescriptor, AvbHashtreeDescriptor)):
+        details.update(hash_algorithm=desc.hash_algorithm,
+                       image_size=desc.image_size)
+        desc_image = open_image()
+      elif isinstance(desc, AvbChainPartitionDescriptor):
+        details.update(
+            rollback_index_location=desc.rollback_index_location,
+            public_key_sha1=hashlib.sha1(desc.public_key).hexdigest())
+      if not desc.verify(image_dir, image_ext, expected_chain_partitions_map,
+                         desc_image, accept_zeroed_hashtree, context):
+        raise AvbError('Error verifying descriptor.')
+      return details
+    def chain_not_expected(desc, context):
+      public_key_sha1 = hashlib.sha1(desc.public_key).hexdigest()
+      print('{}: Chained but ROLLBACK_SLOT (which is {}) '
+            'and KEY (which has sha1 {}) not specified'
+            .format(desc.partition_name, desc.rollback_index_location,
+                    public_key_sha1), file=context.out)
+      return dict(rollback_index_location=desc.rollback_index_location,
+                  public_key_sha1=public_key_sha1)
+    def separator(context):
+      print('--', file=context.out)
+    def malformed_descriptor(error, context):
+      del context  # Unused.
+      raise AvbError('Malformed descriptor: {}'.format(error)) from error
+    stages = {
+        AvbPropertyDescriptor: 'property',
+        AvbHashtreeDescriptor: 'hashtree',
+        AvbHashDescriptor: 'hash',
+        AvbKernelCmdlineDescriptor: 'kernel_cmdline',
+        AvbChainPartitionDescriptor: 'chain',
+    }
     for desc in descriptors:
+      stage = stages.get(type(desc), 'unknown')
+      try:
+        # Descriptors are decoded on first access, so this is where a
+        # malformed one shows up. Report it as a failed check.
+        name = getattr(desc, 'partition_name', None) or image_filename
+      except (LookupError, struct.error) as e:
+        tasks.append(VerifyTask(image_filename, image_filename, stage,
+                                functools.partial(malformed_descriptor, e)))
+        continue
       if (isinstance(desc, AvbChainPartitionDescriptor)
           and follow_chain_partitions
           and expected_chain_partitions_map.get(desc.partition_name) is None):
         # In this case we're processing a chain descriptor but don't have a
         # --expect_chain_partition ... however --follow_chain_partitions was
         # specified so we shouldn't error out in desc.verify().
-        print('{}: Chained but ROLLBACK_SLOT (which is {}) '
-              'and KEY (which has sha1 {}) not specified'
-              .format(desc.partition_name, desc.rollback_index_location,
-                      hashlib.sha1(desc.public_key).hexdigest()))
-      elif not desc.verify(image_dir, image_ext, expected_chain_partitions_map,
-                           image, accept_zeroed_hashtree):
-        raise AvbError('Error verifying descriptor.')
+        tasks.append(VerifyTask(image_filename, name, stage,
+                                functools.partial(chain_not_expected, desc)))
+      else:
+        if (check_fec or repair) and isinstance(desc, AvbHashtreeDescriptor):
+          tasks.append(VerifyTask(image_filename, name, 'fec',
+                                  functools.partial(check_descriptor_fec,
+                                                    desc)))
+        tasks.append(VerifyTask(image_filename, name, stage,
+                                functools.partial(verify_descriptor, desc)))
       # Honor --follow_chain_partitions - add '--' to make the output more
       # readable.
       if (isinstance(desc, AvbChainPartitionDescriptor)
           and follow_chain_partitions):
-        print('--')
+        tasks.append(VerifyTask(image_filename, name, None, separator))
         chained_image_filename = os.path.join(image_dir,
                                               desc.partition_name + image_ext)
-        self.verify_image(chained_image_filename, key_path, None, False,
-                          accept_zeroed_hashtree)
+        self._plan_verify_image(tasks, chained_image_filename, key_path, {},
+                                False, accept_zeroed_hashtree, check_fec,
+                                repair)
   def print_partition_digests(self, image_filename, output, as_json):
     """Implements the 'print_partition_digests' command.
     Arguments:
@@ -2374,24 +3519,28 @@ class Avb(object):
       AvbError: In case the image cannot be parsed.
     """
     assert isinstance(image, ImageHandler)
-    footer = None
-    image.seek(image.image_size - AvbFooter.SIZE)
+    vbmeta = locate_vbmeta(image)
+    return (vbmeta.footer, vbmeta.header, vbmeta.descriptors(),
+            image.image_size)
+  def _load_hashtree(self, image):
+    """Gets the hashtree descriptor and hashtree of an image with a footer.
+    Arguments:
+      image: An ImageHandler.
+    Returns:
+      A tuple of the AvbHashtreeDescriptor and the hashtree as bytes, or
+      None if |image| has no footer or hashtree.
+    """
     try:
-      footer = AvbFooter(image.read(AvbFooter.SIZE))
-    except (LookupError, struct.error):
-      # Nope, just seek back to the start.
-      image.seek(0)
-    vbmeta_offset = 0
-    if footer:
-      vbmeta_offset = footer.vbmeta_offset
-    image.seek(vbmeta_offset)
-    h = AvbVBMetaHeader(image.read(AvbVBMetaHeader.SIZE))
-    auth_block_offset = vbmeta_offset + AvbVBMetaHeader.SIZE
-    aux_block_offset = auth_block_offset + h.authentication_data_block_size
-    desc_start_offset = aux_block_offset + h.descriptors_offset
-    image.seek(desc_start_offset)
-    descriptors = parse_descriptors(image.read(h.descriptors_size))
-    return footer, h, descriptors, image.image_size
+      footer, _, descriptors, _ = self._parse_image(image)
+      if not footer:
+        return None
+      for desc in descriptors:
+        if isinstance(desc, AvbHashtreeDescriptor) and desc.tree_size:
+          image.seek(desc.tree_offset)
+          return desc, image.read(desc.tree_size)
+    except (AvbError, LookupError, struct.error):
+      return None
+    return None
   def _load_vbmeta_blob(self, image):
     """Gets the vbmeta struct and associated sections.
     The image can either be a vbmeta.img or an image with a footer.
@@ -2401,23 +3550,7 @@ class Avb(object):
       A blob with the vbmeta struct and other sections.
     """
     assert isinstance(image, ImageHandler)
-    footer = None
-    image.seek(image.image_size - AvbFooter.SIZE)
-    try:
-      footer = AvbFooter(image.read(AvbFooter.SIZE))
-    except (LookupError, struct.error):
-      # Nope, just seek back to the start.
-      image.seek(0)
-    vbmeta_offset = 0
-    if footer:
-      vbmeta_offset = footer.vbmeta_offset
-    image.seek(vbmeta_offset)
-    h = AvbVBMetaHeader(image.read(AvbVBMetaHeader.SIZE))
-    image.seek(vbmeta_offset)
-    data_size = AvbVBMetaHeader.SIZE
-    data_size += h.authentication_data_block_size
-    data_size += h.auxiliary_data_block_size
-    return image.read(data_size)
+    return locate_vbmeta(image).blob
   def _get_cmdline_descriptors_for_hashtree_descriptor(self, ht):
     """Generate kernel cmdline descriptors for dm-verity.
     Arguments:
@@ -2734,13 +3867,14 @@ class Avb(object):
     if public_key_metadata_path:
       with open(public_key_metadata_path, 'rb') as f:
         pkmd_blob = f.read()
-    key = None
+    rsa_key = None
     encoded_key = b''
     if alg.public_key_num_bytes > 0:
       if not key_path:
         raise AvbError('Key is required for algorithm {}'.format(
             algorithm_name))
-      encoded_key = RSAPublicKey(key_path).encode()
+      rsa_key = RSAPublicKey(key_path)
+      encoded_key = rsa_key.encode()
       if len(encoded_key) != alg.public_key_num_bytes:
         raise AvbError('Key is wrong size for algorithm {}'.format(
             algorithm_name))
@@ -2787,12 +3921,11 @@ class Avb(object):
     binary_hash = b''
     binary_signature = b''
     if algorithm_name != 'NONE':
-      ha = hashlib.new(alg.hash_name)
+      ha = alg.hash_constructor()
       ha.update(header_data_blob)
       ha.update(aux_data_blob)
       binary_hash = ha.digest()
       # Calculate the signature.
-      rsa_key = RSAPublicKey(key_path)
       data_to_sign = header_data_blob + bytes(aux_data_blob)
       binary_signature = rsa_key.sign(algorithm_name, data_to_sign,
                                       signing_helper, signing_helper_with_files)
@@ -2846,42 +3979,54 @@ class Avb(object):
     try:
       vbmeta_image_handler = ImageHandler(vbmeta_image_filename)
       vbmeta_blob = self._load_vbmeta_blob(vbmeta_image_handler)
-      # If the image isn't sparse, its size might not be a multiple of
-      # the block size. This will screw up padding later so just grow it.
-      if image.image_size % image.block_size != 0:
-        assert not image.is_sparse
-        padding_needed = image.block_size - (image.image_size%image.block_size)
-        image.truncate(image.image_size + padding_needed)
-      # The append_raw() method requires content with size being a
-      # multiple of |block_size| so add padding as needed. Also record
-      # where this is written to since we'll need to put that in the
-      # footer.
-      vbmeta_offset = image.image_size
-      padding_needed = (round_to_multiple(len(vbmeta_blob), image.block_size) -
-                        len(vbmeta_blob))
-      vbmeta_blob_with_padding = vbmeta_blob + b'\0' * padding_needed
-      # Append vbmeta blob and footer
-      image.append_raw(vbmeta_blob_with_padding)
-      vbmeta_end_offset = vbmeta_offset + len(vbmeta_blob_with_padding)
-      # Now insert a DONT_CARE chunk with enough bytes such that the
-      # final Footer block is at the end of partition_size..
-      image.append_dont_care(partition_size - vbmeta_end_offset -
-                             1 * image.block_size)
-      # Generate the Footer that tells where the VBMeta footer
-      # is. Also put enough padding in the front of the footer since
-      # we'll write out an entire block.
-      footer = AvbFooter()
-      footer.original_image_size = original_image_size
-      footer.vbmeta_offset = vbmeta_offset
-      footer.vbmeta_size = len(vbmeta_blob)
-      footer_blob = footer.encode()
-      footer_blob_with_padding = (b'\0' * (image.block_size - AvbFooter.SIZE) +
-                                  footer_blob)
-      image.append_raw(footer_blob_with_padding)
+      self._append_vbmeta_and_footer(image, vbmeta_blob, original_image_size,
+                                     partition_size)
     except Exception as e:
       # Truncate back to original size, then re-raise.
       image.truncate(original_image_size)
       raise AvbError('Appending VBMeta image failed: {}.'.format(e)) from e
+  def _append_vbmeta_and_footer(self, image, vbmeta_blob, original_image_size,
+                                partition_size):
+    """Appends a vbmeta blob and a footer pointing to it to an image.
+    The footer is placed in the last block of |partition_size|.
+    Arguments:
+      image: An ImageHandler opened for writing.
+      vbmeta_blob: The vbmeta blob as bytes.
+      original_image_size: Size of the image before any AVB data was added.
+      partition_size: Size of partition.
+    """
+    # If the image isn't sparse, its size might not be a multiple of
+    # the block size. This will screw up padding later so just grow it.
+    if image.image_size % image.block_size != 0:
+      assert not image.is_sparse
+      padding_needed = image.block_size - (image.image_size % image.block_size)
+      image.truncate(image.image_size + padding_needed)
+    # The append_raw() method requires content with size being a
+    # multiple of |block_size| so add padding as needed. Also record
+    # where this is written to since we'll need to put that in the
+    # footer.
+    vbmeta_offset = image.image_size
+    padding_needed = (round_to_multiple(len(vbmeta_blob), image.block_size) -
+                      len(vbmeta_blob))
+    vbmeta_blob_with_padding = vbmeta_blob + b'\0' * padding_needed
+    # Append vbmeta blob and footer
+    image.append_raw(vbmeta_blob_with_padding)
+    vbmeta_end_offset = vbmeta_offset + len(vbmeta_blob_with_padding)
+    # Now insert a DONT_CARE chunk with enough bytes such that the
+    # final Footer block is at the end of partition_size..
+    image.append_dont_care(partition_size - vbmeta_end_offset -
+                           1 * image.block_size)
+    # Generate the Footer that tells where the VBMeta footer
+    # is. Also put enough padding in the front of the footer since
+    # we'll write out an entire block.
+    footer = AvbFooter()
+    footer.original_image_size = original_image_size
+    footer.vbmeta_offset = vbmeta_offset
+    footer.vbmeta_size = len(vbmeta_blob)
+    footer_blob = footer.encode()
+    footer_blob_with_padding = (b'\0' * (image.block_size - AvbFooter.SIZE) +
+                                footer_blob)
+    image.append_raw(footer_blob_with_padding)
   def add_hash_footer(self, image_filename, partition_size,
                       dynamic_partition_size, partition_name,
                       hash_algorithm, salt, chain_partitions_use_ab,
@@ -2896,7 +4041,8 @@ class Avb(object):
                       release_string, append_to_release_string,
                       output_vbmeta_image, do_not_append_vbmeta_image,
                       print_required_libavb_version, use_persistent_digest,
-                      do_not_use_ab):
+                      do_not_use_ab, hash_chunk_size=HASH_CHUNK_SIZE,
+                      auto_sparsify=False):
     """Implementation of the add_hash_footer on unsparse images.
     Arguments:
       image_filename: File to add the footer to.
@@ -2932,6 +4078,9 @@ class Avb(object):
       print_required_libavb_version: True to only print required libavb version.
       use_persistent_digest: Use a persistent digest on device.
       do_not_use_ab: This partition does not use A/B.
+      hash_chunk_size: Size of the reads used to hash the image.
+      auto_sparsify: If True, store blocks of repeated patterns that get
+        appended to a sparse image as FILL chunks.
     Raises:
       AvbError: If an argument is incorrect of if adding of hash_footer failed.
     """
@@ -2967,7 +4116,8 @@ class Avb(object):
     # If we aren't appending the vbmeta footer to the input image we can
     # open it in read-only mode.
     image = ImageHandler(image_filename,
-                         read_only=do_not_append_vbmeta_image)
+                         read_only=do_not_append_vbmeta_image,
+                         auto_sparsify=auto_sparsify)
     # If there's already a footer, truncate the image to its original
     # size. This way 'avbtool add_hash_footer' is idempotent (modulo
     # salts).
@@ -3013,11 +4163,8 @@ class Avb(object):
       else:
         salt = b''
       hasher = hashlib.new(hash_algorithm, salt)
-      # TODO(zeuthen): might want to read this in chunks to avoid
-      # memory pressure, then again, this is only supposed to be used
-      # on kernel/initramfs partitions. Possible optimization.
       image.seek(0)
-      hasher.update(image.read(image.image_size))
+      update_hash_from_image(hasher, image, image.image_size, hash_chunk_size)
       digest = hasher.digest()
       h_desc = AvbHashDescriptor()
       h_desc.image_size = image.image_size
@@ -3044,39 +4191,8 @@ class Avb(object):
         output_vbmeta_image.write(vbmeta_blob)
       # Append vbmeta blob and footer, unless requested not to.
       if not do_not_append_vbmeta_image:
-        # If the image isn't sparse, its size might not be a multiple of
-        # the block size. This will screw up padding later so just grow it.
-        if image.image_size % image.block_size != 0:
-          assert not image.is_sparse
-          padding_needed = image.block_size - (
-              image.image_size % image.block_size)
-          image.truncate(image.image_size + padding_needed)
-        # The append_raw() method requires content with size being a
-        # multiple of |block_size| so add padding as needed. Also record
-        # where this is written to since we'll need to put that in the
-        # footer.
-        vbmeta_offset = image.image_size
-        padding_needed = (
-            round_to_multiple(len(vbmeta_blob), image.block_size) -
-            len(vbmeta_blob))
-        vbmeta_blob_with_padding = vbmeta_blob + b'\0' * padding_needed
-        image.append_raw(vbmeta_blob_with_padding)
-        vbmeta_end_offset = vbmeta_offset + len(vbmeta_blob_with_padding)
-        # Now insert a DONT_CARE chunk with enough bytes such that the
-        # final Footer block is at the end of partition_size..
-        image.append_dont_care(partition_size - vbmeta_end_offset -
-                               1 * image.block_size)
-        # Generate the Footer that tells where the VBMeta footer
-        # is. Also put enough padding in the front of the footer since
-        # we'll write out an entire block.
-        footer = AvbFooter()
-        footer.original_image_size = original_image_size
-        footer.vbmeta_offset = vbmeta_offset
-        footer.vbmeta_size = len(vbmeta_blob)
-        footer_blob = footer.encode()
-        footer_blob_with_padding = (
-            b'\0' * (image.block_size - AvbFooter.SIZE) + footer_blob)
-        image.append_raw(footer_blob_with_padding)
+        self._append_vbmeta_and_footer(image, vbmeta_blob, original_image_size,
+                                       partition_size)
     except Exception as e:
       # Truncate back to original size, then re-raise.
       image.truncate(original_image_size)
@@ -3098,7 +4214,9 @@ class Avb(object):
                           output_vbmeta_image, do_not_append_vbmeta_image,
                           print_required_libavb_version,
                           use_persistent_root_digest, do_not_use_ab,
-                          no_hashtree, check_at_most_once):
+                          no_hashtree, check_at_most_once,
+                          dirty_block_ranges=None, diff_image_filename=None,
+                          auto_sparsify=False):
     """Implements the 'add_hashtree_footer' command.
     See https://gitlab.com/cryptsetup/cryptsetup/wikis/DMVerity for
     more information about dm-verity and these hashes.
@@ -3143,6 +4261,13 @@ class Avb(object):
       no_hashtree: Do not append hashtree. Set size in descriptor as zero.
       check_at_most_once: Set to verify data blocks only the first time they
         are read from the data device.
+      dirty_block_ranges: If not None, update the hashtree already in the
+        image (or in |diff_image_filename|) for just these (first_block,
+        end_block) ranges instead of generating it from scratch.
+      diff_image_filename: If not None, update the existing hashtree for
+        the blocks that differ from this previously signed image.
+      auto_sparsify: If True, store blocks of repeated patterns that get
+        appended to a sparse image as FILL chunks.
     Raises:
       AvbError: If an argument is incorrect or adding the hashtree footer
           failed.
@@ -3183,7 +4308,7 @@ class Avb(object):
     if calc_max_image_size:
       print('{}'.format(max_image_size))
       return
-    image = ImageHandler(image_filename)
+    image = ImageHandler(image_filename, auto_sparsify=auto_sparsify)
     if partition_size > 0:
       if partition_size % image.block_size != 0:
         raise AvbError('Partition size of {} is not a multiple of the image '
@@ -3193,6 +4318,16 @@ class Avb(object):
       raise AvbError('File size of {} is not a multiple of the image '
                      'block size {}.'.format(image.image_size,
                                              image.block_size))
+    # For an incremental update, pick up the existing tree before the
+    # image is truncated below.
+    old_hashtree = None
+    diff_image = None
+    if diff_image_filename:
+      diff_image = ImageHandler(diff_image_filename, read_only=True)
+    if dirty_block_ranges is not None or diff_image:
+      old_hashtree = self._load_hashtree(image)
+      if not old_hashtree and diff_image:
+        old_hashtree = self._load_hashtree(diff_image)
     # If there's already a footer, truncate the image to its original
     # size. This way 'avbtool add_hashtree_footer' is idempotent
     # (modulo salts).
@@ -3229,6 +4364,9 @@ class Avb(object):
                                               partition_size))
       if salt:
         salt = binascii.unhexlify(salt)
+      elif salt is None and old_hashtree:
+        # Keep the salt of the existing tree so it can be reused.
+        salt = old_hashtree[0].salt
       elif salt is None and not use_persistent_root_digest:
         # If salt is not explicitly specified, choose a hash that's the same
         # size as the hash size. Don't populate a random salt if this
@@ -3250,20 +4388,48 @@ class Avb(object):
         image.truncate(image.image_size + padding_needed)
       # Generate the tree and add padding as needed.
       tree_offset = image.image_size
-      root_digest, hash_tree = generate_hash_tree(image, image.image_size,
+      old_desc = old_hashtree[0] if old_hashtree else None
+      if (old_desc and old_desc.image_size == image.image_size and
+          old_desc.tree_size == tree_size and
+          old_desc.data_block_size == block_size and
+          old_desc.hash_algorithm == hash_algorithm and
+          old_desc.salt == salt):
+        dirty = list(dirty_block_ranges or [])
+        if diff_image:
+          dirty.extend(diff_block_ranges(image, diff_image, image.image_size,
+                                         block_size))
+        root_digest, hash_tree = update_hash_tree(image, image.image_size,
                                                   block_size,
                                                   hash_algorithm, salt,
                                                   digest_padding,
                                                   hash_level_offsets,
-                                                  tree_size)
+                                                  old_hashtree[1], dirty)
+      else:
+        if dirty_block_ranges is not None or diff_image:
+          sys.stderr.write('No matching hashtree to update, generating a '
+                           'new one.\n')
+        # Build the tree in place, in zeros appended for it and padded
+        # to the block size.
+        image.append_zeroed_raw(round_to_multiple(tree_size,
+                                                  image.block_size))
+        root_digest, hash_tree = generate_hash_tree(image, tree_offset,
+                                                    block_size,
+                                                    hash_algorithm, salt,
+                                                    digest_padding,
+                                                    hash_level_offsets,
+                                                    tree_size,
+                                                    out_image=image,
+                                                    out_offset=tree_offset)
       # Generate HashtreeDescriptor with details about the tree we
       # just generated.
       if no_hashtree:
         tree_size = 0
         hash_tree = b''
+        # Drop the tree if it was built in place.
+        image.truncate(tree_offset)
       ht_desc = AvbHashtreeDescriptor()
       ht_desc.dm_verity_version = 1
-      ht_desc.image_size = image.image_size
+      ht_desc.image_size = tree_offset
       ht_desc.tree_offset = tree_offset
       ht_desc.tree_size = tree_size
       ht_desc.data_block_size = block_size
@@ -3277,13 +4443,16 @@ class Avb(object):
         ht_desc.root_digest = root_digest
       if check_at_most_once:
         ht_desc.flags |= AvbHashtreeDescriptor.FLAGS_CHECK_AT_MOST_ONCE
-      # Write the hash tree
-      padding_needed = (round_to_multiple(len(hash_tree), image.block_size) -
-                        len(hash_tree))
-      hash_tree_with_padding = hash_tree + b'\0' * padding_needed
-      if len(hash_tree_with_padding) > 0:
-        image.append_raw(hash_tree_with_padding)
-      len_hashtree_and_fec = len(hash_tree_with_padding)
+      # Write the hash tree, unless it was built in place.
+      if hash_tree is None:
+        len_hashtree_and_fec = image.image_size - tree_offset
+      else:
+        padding_needed = (round_to_multiple(len(hash_tree), image.block_size)
+                          - len(hash_tree))
+        hash_tree_with_padding = hash_tree + b'\0' * padding_needed
+        if len(hash_tree_with_padding) > 0:
+          image.append_raw(hash_tree_with_padding)
+        len_hashtree_and_fec = len(hash_tree_with_padding)
       # Generate FEC codes, if requested.
       if generate_fec:
         if no_hashtree:
@@ -3511,8 +4680,284 @@ def calc_hash_level_offsets(image_size, block_size, digest_size):
 # See system/extras/libfec/include/fec/io.h for these definitions.
 FEC_FOOTER_FORMAT = '<LLLLLQ32s'
 FEC_MAGIC = 0xfecfecfe
+# libfec encodes FEC_BLOCK_SIZE blocks with RS(FEC_RSM, FEC_RSM - roots)
+# over GF(2^8), see system/extras/libfec/fec_private.h.
+FEC_BLOCK_SIZE = 4096
+FEC_RSM = 255
+FEC_GF_POLY = 0x11d
+# Number of codewords each FEC encoding task works on.
+FEC_RANGE_CODEWORDS = 64 * 1024
+_fec_field = None
+_fec_tables = {}
+def _fec_rounds(image_size, num_roots):
+  """Calculates how many FEC_BLOCK_SIZE rounds of codewords libfec uses.
+  Arguments:
+    image_size: The size of the image.
+    num_roots: Number of roots.
+  Returns:
+    The number of rounds.
+  Raises:
+    ValueError: If |num_roots| is out of range.
+  """
+  if not 0 < num_roots < FEC_RSM:
+    raise ValueError('Invalid number of FEC roots: {}'.format(num_roots))
+  num_blocks = (image_size + FEC_BLOCK_SIZE - 1) // FEC_BLOCK_SIZE
+  rs_n = FEC_RSM - num_roots
+  return (num_blocks + rs_n - 1) // rs_n
+def _fec_galois_field():
+  """Builds the GF(2^8) tables libfec uses.
+  Returns:
+    A tuple (alpha_to, index_of, mul) where |alpha_to| maps a logarithm
+    to its element, |index_of| an element other than zero to its
+    logarithm and |mul| is a 256x256 numpy multiplication table.
+  """
+  global _fec_field
+  if _fec_field is None:
+    import numpy
+    alpha_to = [0] * FEC_RSM
+    index_of = [0] * (FEC_RSM + 1)
+    sr = 1
+    for i in range(FEC_RSM):
+      alpha_to[i] = sr
+      index_of[sr] = i
+      sr <<= 1
+      if sr & 0x100:
+        sr ^= FEC_GF_POLY
+    logs = numpy.array(index_of, dtype=numpy.intp)
+    mul = numpy.array(alpha_to, dtype=numpy.uint8)[
+        (logs[:, None] + logs[None, :]) % FEC_RSM]
+    mul[0, :] = 0
+    mul[:, 0] = 0
+    _fec_field = (alpha_to, index_of, mul)
+  return _fec_field
+def _fec_parity_tables(num_roots):
+  """Builds lookup tables for the Reed-Solomon encoder.
+  The code is the one libfec sets up with init_rs_char(8, 0x11d, 0, 1,
+  roots, 0): the generator polynomial has the roots alpha^0 to
+  alpha^(roots - 1).
+  Arguments:
+    num_roots: Number of roots.
+  Returns:
+    A list of |num_roots| numpy arrays, entry i maps a feedback symbol to
+    what is added to parity symbol i when shifting in a data symbol.
+  """
+  tables = _fec_tables.get(num_roots)
+  if tables is None:
+    alpha_to, _, mul = _fec_galois_field()
+    # genpoly[j] is the coefficient of x^j.
+    genpoly = [1]
+    for root in range(num_roots):
+      genpoly = [0] + genpoly
+      for j in range(len(genpoly) - 1):
+        genpoly[j] ^= int(mul[genpoly[j + 1], alpha_to[root]])
+    tables = [mul[:, genpoly[num_roots - 1 - i]].copy()
+              for i in range(num_roots)]
+    _fec_tables[num_roots] = tables
+  return tables
+def _fec_map(image, image_size, num_roots, func, args, num_threads):
+  """Runs |func| over all interleaved codewords of an image.
+  Byte i of codeword c is at image offset c + i * rounds * FEC_BLOCK_SIZE,
+  so every codeword covers blocks spread over the whole image and the
+  bytes at position i of consecutive codewords are consecutive in the
+  image.
+  Arguments:
+    image: An ImageHandler for the image.
+    image_size: Number of bytes the FEC data covers, anything past it is
+      encoded as zeroes.
+    num_roots: Number of roots.
+    func: Called as func(data, first, *args) for ranges of codewords, where
+      |data| is a numpy uint8 array with a row per data symbol and a column
+      per codeword and |first| is the index of the first codeword.
+    args: Extra arguments for |func|.
+    num_threads: Number of threads, None for the CPU count.
+  Returns:
+    The values returned by |func|, in order.
+  """
+  import numpy
+  rs_n = FEC_RSM - num_roots
+  stripe_size = _fec_rounds(image_size, num_roots) * FEC_BLOCK_SIZE
+  if num_threads is None:
+    num_threads = os.cpu_count() or 1
+  executor = None
+  if num_threads > 1 and stripe_size > FEC_RANGE_CODEWORDS:
+    executor = concurrent.futures.ThreadPoolExecutor(num_threads)
+  results = []
+  try:
+    pending = collections.deque()
+    for first in range(0, stripe_size, FEC_RANGE_CODEWORDS):
+      count = min(FEC_RANGE_CODEWORDS, stripe_size - first)
+      data = numpy.zeros((rs_n, count), dtype=numpy.uint8)
+      for i in range(rs_n):
+        offset = i * stripe_size + first
+        if offset >= image_size:
+          break
+        image.seek(offset)
+        image.readinto(memoryview(data[i])[:image_size - offset])
+      if executor is not None:
+        try:
+          future = executor.submit(func, data, first, *args)
+        except RuntimeError:
+          # Threads can't be started, e.g. on WebAssembly builds.
+          executor.shutdown()
+          executor = None
+        else:
+          pending.append(future)
+          if len(pending) > 2 * num_threads:
+            results.append(pending.popleft().result())
+          continue
+      results.extend(future.result() for future in pending)
+      pending.clear()
+      results.append(func(data, first, *args))
+    results.extend(future.result() for future in pending)
+  finally:
+    if executor is not None:
+      executor.shutdown()
+  return results
+def _fec_encode_codewords(data, first, tables, out):
+  """Computes the parity of a range of interleaved codewords.
+  Arguments:
+    data: The data symbols, see _fec_map().
+    first: Index of the first codeword.
+    tables: The lookup tables from _fec_parity_tables().
+    out: The bytearray to write the parity symbols to, codeword by
+      codeword.
+  """
+  import numpy
+  num_roots = len(tables)
+  parity = [numpy.zeros(data.shape[1], dtype=numpy.uint8)
+            for _ in range(num_roots)]
+  for row in data:
+    feedback = numpy.bitwise_xor(row, parity[0])
+    parity = ([numpy.bitwise_xor(parity[i + 1], tables[i].take(feedback))
+               for i in range(num_roots - 1)] +
+              [tables[num_roots - 1].take(feedback)])
+  encoded = numpy.stack(parity, axis=1)
+  out[first * num_roots:first * num_roots + encoded.size] = encoded.tobytes()
+def _fec_correct(codeword, syndromes):
+  """Finds the errors in a Reed-Solomon codeword.
+  Arguments:
+    codeword: The FEC_RSM symbols of the codeword, data first.
+    syndromes: The syndromes of the codeword, all but zero.
+  Returns:
+    A list of (symbol index, error value) pairs or None if the codeword
+    has more errors than can be corrected.
+  """
+  alpha_to, index_of, _ = _fec_galois_field()
+  def mul(a, b):
+    if a == 0 or b == 0:
+      return 0
+    return alpha_to[(index_of[a] + index_of[b]) % FEC_RSM]
+  def inv(a):
+    return alpha_to[(FEC_RSM - index_of[a]) % FEC_RSM]
+  def evaluate(poly, x):
+    ret = 0
+    for coef in reversed(poly):
+      ret = mul(ret, x) ^ coef
+    return ret
+  # Berlekamp-Massey for the error locator polynomial, coefficients in
+  # increasing order.
+  num_roots = len(syndromes)
+  locator = [1] + [0] * num_roots
+  prev = list(locator)
+  num_errors = 0
+  shift = 1
+  prev_discrepancy = 1
+  for k in range(num_roots):
+    discrepancy = syndromes[k]
+    for i in range(1, num_errors + 1):
+      discrepancy ^= mul(locator[i], syndromes[k - i])
+    if discrepancy == 0:
+      shift += 1
+      continue
+    coef = mul(discrepancy, inv(prev_discrepancy))
+    old = list(locator)
+    for i in range(num_roots + 1 - shift):
+      locator[i + shift] ^= mul(coef, prev[i])
+    if 2 * num_errors <= k:
+      num_errors = k + 1 - num_errors
+      prev = old
+      prev_discrepancy = discrepancy
+      shift = 1
+    else:
+      shift += 1
+  # Chien search: symbol i has error locator alpha^(FEC_RSM - 1 - i).
+  positions = [i for i in range(FEC_RSM)
+               if evaluate(locator, alpha_to[(i + 1) % FEC_RSM]) == 0]
+  if len(positions) != num_errors or 2 * num_errors > num_roots:
+    return None
+  # Forney, for a first consecutive root of alpha^0.
+  evaluator = [0] * num_roots
+  for i, lc in enumerate(locator):
+    for j, sc in enumerate(syndromes[:num_roots - i]):
+      evaluator[i + j] ^= mul(lc, sc)
+  derivative = [locator[i] if i % 2 else 0 for i in range(1, num_roots + 1)]
+  errors = []
+  corrected = list(codeword)
+  for i in positions:
+    x_inv = alpha_to[(i + 1) % FEC_RSM]
+    denominator = evaluate(derivative, x_inv)
+    if denominator == 0:
+      return None
+    error = mul(inv(x_inv), mul(evaluate(evaluator, x_inv), inv(denominator)))
+    errors.append((i, error))
+    corrected[i] ^= error
+  # Make sure the result is a codeword.
+  for j in range(num_roots):
+    if evaluate(corrected[::-1], alpha_to[j]) != 0:
+      return None
+  return errors
+def _fec_check_codewords(data, first, parity, image_size):
+  """Checks the syndromes of a range of interleaved codewords.
+  Arguments:
+    data: The data symbols, see _fec_map().
+    first: Index of the first codeword.
+    parity: The FEC data as numpy uint8 array with a row per codeword.
+    image_size: Number of bytes the FEC data covers.
+  Returns:
+    A tuple (fixes, num_uncorrectable) where |fixes| is a list of (offset,
+    value) pairs with the correct value of each corrupted byte. Offsets
+    past |image_size| are into the FEC data that follows the image.
+  """
+  import numpy
+  num_roots = parity.shape[1]
+  rs_n = FEC_RSM - num_roots
+  count = data.shape[1]
+  stripe_size = parity.shape[0]
+  alpha_to, _, mul = _fec_galois_field()
+  tables = [mul[alpha_to[j]] for j in range(num_roots)]
+  parity = parity[first:first + count].T
+  syndromes = [numpy.zeros(count, dtype=numpy.uint8)
+               for _ in range(num_roots)]
+  for row in itertools.chain(data, parity):
+    syndromes = [numpy.bitwise_xor(table.take(syndrome), row)
+                 for table, syndrome in zip(tables, syndromes)]
+  syndromes = numpy.stack(syndromes, axis=1)
+  fixes = []
+  num_uncorrectable = 0
+  for c in numpy.flatnonzero(syndromes.any(axis=1)).tolist():
+    codeword = data[:, c].tolist() + parity[:, c].tolist()
+    errors = _fec_correct(codeword, syndromes[c].tolist())
+    if errors is not None:
+      offsets = []
+      for i, _ in errors:
+        if i < rs_n:
+          offsets.append(first + c + i * stripe_size)
+        else:
+          offsets.append(image_size + (first + c) * num_roots + i - rs_n)
+      if any(i < rs_n and offset >= image_size
+             for (i, _), offset in zip(errors, offsets)):
+        # An error in the zero padding past the image.
+        errors = None
+    if errors is None:
+      num_uncorrectable += 1
+      continue
+    for (i, error), offset in zip(errors, offsets):
+      fixes.append((offset, codeword[i] ^ error))
+  return fixes, num_uncorrectable
 def calc_fec_data_size(image_size, num_roots):
   """Calculates how much space FEC data will take.
+  Like 'fec --print-fec-size' this includes the block holding the FEC
+  footer.
   Arguments:
     image_size: The size of the image.
     num_roots: Number of roots.
@@ -3520,49 +4965,145 @@ def calc_fec_data_size(image_size, num_roots):
     The number of bytes needed for FEC for an image of the given size
     and with the requested number of FEC roots.
   Raises:
-    ValueError: If output from the 'fec' tool is invalid.
+    ValueError: If |num_roots| is out of range.
   """
-  p = subprocess.Popen(
-      ['fec', '--print-fec-size', str(image_size), '--roots', str(num_roots)],
-      stdout=subprocess.PIPE,
-      stderr=subprocess.PIPE)
-  (pout, perr) = p.communicate()
-  retcode = p.wait()
-  if retcode != 0:
-    raise ValueError('Error invoking fec: {}'.format(perr))
-  return int(pout)
-def generate_fec_data(image_filename, num_roots):
+  rounds = _fec_rounds(image_size, num_roots)
+  return rounds * num_roots * FEC_BLOCK_SIZE + FEC_BLOCK_SIZE
+def generate_fec_data(image_filename, num_roots, num_threads=None):
   """Generate FEC codes for an image.
+  The output is what 'fec --encode' writes in front of its footer block:
+  the parity symbols of the interleaved codewords, one codeword after
+  another.
   Arguments:
     image_filename: The filename of the image.
     num_roots: Number of roots.
+    num_threads: Number of encoding threads, None for the CPU count.
   Returns:
     The FEC data blob as bytes.
   Raises:
-    ValueError: If calling the 'fec' tool failed or the output is invalid.
+    ValueError: If |num_roots| is out of range or numpy is missing.
   """
-  with tempfile.NamedTemporaryFile() as fec_tmpfile:
-    try:
-      subprocess.check_call(
-          ['fec', '--encode', '--roots', str(num_roots), image_filename,
-           fec_tmpfile.name],
-          stderr=open(os.devnull, 'wb'))
-    except subprocess.CalledProcessError as e:
-      raise ValueError('Execution of \'fec\' tool failed: {}.'
-                       .format(e)) from e
-    fec_data = fec_tmpfile.read()
-  footer_size = struct.calcsize(FEC_FOOTER_FORMAT)
-  footer_data = fec_data[-footer_size:]
-  (magic, _, _, num_roots, fec_size, _, _) = struct.unpack(FEC_FOOTER_FORMAT,
-                                                           footer_data)
-  if magic != FEC_MAGIC:
-    raise ValueError('Unexpected magic in FEC footer')
-  return fec_data[0:fec_size]
+  try:
+    import numpy  # pylint: disable=unused-import
+  except ImportError as e:
+    raise ValueError('Generating FEC data requires numpy.') from e
+  image = ImageHandler(image_filename, read_only=True)
+  tables = _fec_parity_tables(num_roots)
+  fec_data = bytearray(
+      _fec_rounds(image.image_size, num_roots) * FEC_BLOCK_SIZE * num_roots)
+  _fec_map(image, image.image_size, num_roots, _fec_encode_codewords,
+           (tables, fec_data), num_threads)
+  return bytes(fec_data)
+def check_fec_data(image, image_size, fec_data, num_roots, num_threads=None):
+  """Checks FEC data against an image.
+  Every codeword is checked by computing its syndromes, the ones that
+  aren't all zero are decoded to find out how to repair them.
+  Arguments:
+    image: An ImageHandler for the image.
+    image_size: Number of bytes the FEC data covers.
+    fec_data: The FEC data.
+    num_roots: Number of roots.
+    num_threads: Number of checking threads, None for the CPU count.
+  Returns:
+    A sorted list of (offset, value) pairs with the correct value of each
+    corrupted byte, empty if the image and FEC data are intact. Offsets
+    past |image_size| are into |fec_data|.
+  Raises:
+    ValueError: If numpy is missing, the size of |fec_data| is wrong or
+      there are more errors than can be corrected.
+  """
+  try:
+    import numpy
+  except ImportError as e:
+    raise ValueError('Checking FEC data requires numpy.') from e
+  stripe_size = _fec_rounds(image_size, num_roots) * FEC_BLOCK_SIZE
+  if len(fec_data) != stripe_size * num_roots:
+    raise ValueError('FEC data is {} bytes, expected {} bytes'.format(
+        len(fec_data), stripe_size * num_roots))
+  parity = numpy.frombuffer(fec_data, dtype=numpy.uint8).reshape(
+      stripe_size, num_roots)
+  fixes = []
+  num_uncorrectable = 0
+  for range_fixes, range_uncorrectable in _fec_map(
+      image, image_size, num_roots, _fec_check_codewords,
+      (parity, image_size), num_threads):
+    fixes.extend(range_fixes)
+    num_uncorrectable += range_uncorrectable
+  if num_uncorrectable:
+    raise ValueError('{} codewords have too many errors to correct'.format(
+        num_uncorrectable))
+  return sorted(fixes)
+def _hash_blocks(data, block_size, template, out, out_offset, digest_stride):
+  """Hashes every |block_size| block of |data| into |out|.
+  Arguments:
+    data: The data to hash, a multiple of |block_size| long.
+    block_size: The block size, e.g. 4096.
+    template: A hasher that has absorbed the salt, copied for each block.
+    out: The bytearray to write the digests to.
+    out_offset: Where to write the digest of the first block.
+    digest_stride: Distance between digests in |out|, i.e. the digest
+      size plus padding.
+  """
+  data = memoryview(data)
+  for pos in range(0, len(data), block_size):
+    hasher = template.copy()
+    hasher.update(data[pos:pos + block_size])
+    digest = hasher.digest()
+    out[out_offset:out_offset + len(digest)] = digest
+    out_offset += digest_stride
+def _leaf_runs(image, image_size, block_size):
+  """Splits the data blocks of an image into data and constant runs.
+  Arguments:
+    image: The image, as an ImageHandler.
+    image_size: The size of the image.
+    block_size: The block size, e.g. 4096.
+  Returns:
+    A list of (first_block, end_block, fill_data) tuples covering all
+    blocks in order. |fill_data| is None for blocks that must be read and
+    hashed, otherwise every block of the run is |fill_data| repeated.
+  """
+  num_blocks = (image_size + block_size - 1) // block_size
+  runs = []
+  def add(first, end, fill_data):
+    if first >= end:
+      return
+    if runs and runs[-1][1] == first and runs[-1][2] == fill_data:
+      runs[-1] = (runs[-1][0], end, fill_data)
+    else:
+      runs.append((first, end, fill_data))
+  next_block = 0
+  if block_size % 4 == 0:
+    for offset, size, fill_data in image.extents(0, image_size):
+      if fill_data is None:
+        continue
+      # Only blocks entirely inside the extent are constant, and only if
+      # the pattern is in phase with the block start.
+      first = (offset + block_size - 1) // block_size
+      end = (offset + size) // block_size
+      if (first * block_size - offset) % len(fill_data):
+        continue
+      add(next_block, first, None)
+      add(first, end, fill_data)
+      next_block = max(next_block, end)
+  add(next_block, num_blocks, None)
+  return runs
 def generate_hash_tree(image, image_size, block_size, hash_alg_name, salt,
-                       digest_padding, hash_level_offsets, tree_size):
+                       digest_padding, hash_level_offsets, tree_size,
+                       num_threads=None, out_image=None, out_offset=0,
+                       stats=None):
   """Generates a Merkle-tree for a file.
+  Blocks are hashed in ranges of HASHTREE_RANGE_SIZE bytes on a thread
+  pool (hashlib releases the GIL) and each range's digests are written to
+  the tree once it's done. Level 0 is read sequentially while earlier
+  ranges are being hashed. Runs of FILL and DONT_CARE blocks in sparse
+  images are not read, the digest of one such block is repeated over the
+  run.
+  With |out_image| the tree isn't built in memory: the digests go straight
+  to their final offset in |out_image| and each upper level reads the
+  level below back a range at a time, so memory use is bounded by the
+  ranges in flight instead of growing with the tree.
   Arguments:
-    image: The image, as a file.
+    image: The image, as an ImageHandler.
     image_size: The size of the image.
     block_size: The block size, e.g. 4096.
     hash_alg_name: The hash algorithm, e.g. 'sha256' or 'sha1'.
@@ -3570,52 +5111,278 @@ def generate_hash_tree(image, image_size, block_size, hash_alg_name, salt,
     digest_padding: The padding for each digest.
     hash_level_offsets: The offsets from calc_hash_level_offsets().
     tree_size: The size of the tree, in number of bytes.
+    num_threads: Number of hashing threads, None for the CPU count.
+    out_image: If not None, an ImageHandler with |tree_size| zero bytes at
+      |out_offset| to write the tree to, e.g. |image| itself after
+      append_zeroed_raw().
+    out_offset: Offset of the tree in |out_image|.
+    stats: None or a VerifyStats to add the time and bytes read to.
+  Returns:
+    A tuple where the first element is the top-level hash as bytes and the
+    second element is the hash-tree as bytes, or None if it was written to
+    |out_image|.
+  """
+  started = time.perf_counter()
+  io_time = 0.0
+  bytes_read = 0
+  def read_into(data, start, size):
+    nonlocal io_time, bytes_read
+    before = time.perf_counter()
+    image.seek(start)
+    image.readinto(memoryview(data)[:size])
+    io_time += time.perf_counter() - before
+    bytes_read += size
+  def record_stats():
+    if stats is not None:
+      stats.io_time += io_time
+      stats.hash_time += time.perf_counter() - started - io_time
+      stats.bytes_hashed += bytes_read
+  hash_ret = bytearray(tree_size) if out_image is None else None
+  def write_tree(offset, data):
+    if hash_ret is not None:
+      hash_ret[offset:offset + len(data)] = data
+    else:
+      out_image.write_at(out_offset + offset, data)
+  def read_tree(offset, size):
+    if hash_ret is not None:
+      return memoryview(hash_ret)[offset:offset + size]
+    data = bytearray(size)
+    out_image.seek(out_offset + offset)
+    out_image.readinto(data)
+    return data
+  template = create_avb_hashtree_hasher(hash_alg_name, salt)
+  # If there is only one block, returns the top-level hash directly.
+  if image_size <= block_size:
+    block = bytearray(block_size)
+    read_into(block, 0, image_size)
+    hasher = template.copy()
+    hasher.update(block)
+    record_stats()
+    return hasher.digest(), None if hash_ret is None else bytes(hash_ret)
+  if num_threads is None:
+    num_threads = os.cpu_count() or 1
+  digest_stride = template.digest_size + digest_padding
+  range_size = round_to_multiple(HASHTREE_RANGE_SIZE, block_size)
+  executor = None
+  if num_threads > 1 and image_size > range_size:
+    executor = concurrent.futures.ThreadPoolExecutor(num_threads)
+  # (future, tree offset, digests) of the ranges being hashed, in order.
+  pending = collections.deque()
+  def finish_range():
+    future, offset, digests = pending.popleft()
+    future.result()
+    write_tree(offset, digests)
+  def hash_range(data, offset):
+    nonlocal executor
+    digests = bytearray(len(data) // block_size * digest_stride)
+    args = (data, block_size, template, digests, 0, digest_stride)
+    if executor is not None:
+      try:
+        pending.append((executor.submit(_hash_blocks, *args), offset,
+                        digests))
+      except RuntimeError:
+        # Threads can't be started, e.g. on WebAssembly builds.
+        executor.shutdown()
+        executor = None
+      else:
+        # Keep a bounded number of ranges in flight.
+        if len(pending) > 2 * num_threads:
+          finish_range()
+        return
+    _hash_blocks(*args)
+    write_tree(offset, digests)
+  try:
+    # Level 0: read ranges of the image.
+    fill_digests = {}
+    for first, end, fill_data in _leaf_runs(image, image_size, block_size):
+      leaf_offset = hash_level_offsets[0] + first * digest_stride
+      if fill_data is not None:
+        entry = fill_digests.get(fill_data)
+        if entry is None:
+          hasher = template.copy()
+          hasher.update(fill_data * (block_size // len(fill_data)))
+          entry = hasher.digest() + b'\0' * digest_padding
+          fill_digests[fill_data] = entry
+        max_count = range_size // digest_stride
+        for pos in range(first, end, max_count):
+          count = min(max_count, end - pos)
+          write_tree(leaf_offset, entry * count)
+          leaf_offset += count * digest_stride
+        continue
+      for start in range(first * block_size, min(end * block_size, image_size),
+                         range_size):
+        size = min(range_size, end * block_size - start, image_size - start)
+        # The last block is zero-padded if the image ends mid-block.
+        data = bytearray(round_to_multiple(size, block_size))
+        read_into(data, start, size)
+        hash_range(data, hash_level_offsets[0] +
+                   start // block_size * digest_stride)
+    while pending:
+      finish_range()
+    # Upper levels hash the level below, which is already in the tree
+    # and padded to a multiple of |block_size|.
+    level_num = 0
+    hash_src_size = round_to_multiple(
+        (image_size + block_size - 1) // block_size * digest_stride,
+        block_size)
+    while hash_src_size > block_size:
+      level_num += 1
+      src_offset = hash_level_offsets[level_num - 1]
+      for start in range(0, hash_src_size, range_size):
+        size = min(range_size, hash_src_size - start)
+        hash_range(read_tree(src_offset + start, size),
+                   hash_level_offsets[level_num] +
+                   start // block_size * digest_stride)
+      while pending:
+        finish_range()
+      hash_src_size = round_to_multiple(
+          hash_src_size // block_size * digest_stride, block_size)
+  finally:
+    if executor is not None:
+      executor.shutdown()
+  top = hash_level_offsets[level_num]
+  hasher = template.copy()
+  hasher.update(read_tree(top, hash_src_size))
+  record_stats()
+  return hasher.digest(), None if hash_ret is None else bytes(hash_ret)
+def merge_block_ranges(ranges):
+  """Sorts and merges overlapping or adjacent block ranges.
+  Arguments:
+    ranges: Iterable of (first_block, end_block) tuples, |end_block|
+      being exclusive.
+  Returns:
+    A sorted list of disjoint (first_block, end_block) tuples.
+  """
+  merged = []
+  for start, end in sorted(ranges):
+    if start >= end:
+      continue
+    if merged and start <= merged[-1][1]:
+      merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+    else:
+      merged.append((start, end))
+  return merged
+def parse_block_ranges(string):
+  """Parses block ranges of the form '10-20,35' (inclusive).
+  Arguments:
+    string: Comma separated block numbers or FIRST-LAST ranges.
+  Returns:
+    A list of (first_block, end_block) tuples, |end_block| exclusive.
+  Raises:
+    AvbError: If |string| is malformed.
+  """
+  ranges = []
+  for token in string.split(','):
+    token = token.strip()
+    if not token:
+      continue
+    first, _, last = token.partition('-')
+    try:
+      first = parse_number(first)
+      last = parse_number(last) if last else first
+    except ValueError as e:
+      raise AvbError('Malformed block range "{}".'.format(token)) from e
+    if last < first:
+      raise AvbError('Malformed block range "{}".'.format(token))
+    ranges.append((first, last + 1))
+  return merge_block_ranges(ranges)
+def diff_block_ranges(image, other_image, image_size, block_size,
+                      chunk_size=HASH_CHUNK_SIZE):
+  """Finds the blocks that differ between two images.
+  Arguments:
+    image: An ImageHandler.
+    other_image: An ImageHandler for the image to compare against.
+    image_size: Number of bytes of |image| to compare.
+    block_size: The block size, e.g. 4096.
+    chunk_size: Amount of data read from each image at a time.
+  Returns:
+    A sorted list of (first_block, end_block) tuples, |end_block| exclusive.
+  """
+  chunk_size = round_to_multiple(chunk_size, block_size)
+  buf = memoryview(bytearray(chunk_size))
+  other_buf = memoryview(bytearray(chunk_size))
+  ranges = []
+  for start in range(0, image_size, chunk_size):
+    size = min(chunk_size, image_size - start)
+    image.seek(start)
+    num_read = image.readinto(buf[:size])
+    other_image.seek(start)
+    other_num_read = other_image.readinto(other_buf[:size])
+    # Data missing from the other image counts as changed.
+    other_buf[other_num_read:size] = bytes(size - other_num_read)
+    if num_read == other_num_read == size and buf[:size] == other_buf[:size]:
+      continue
+    for pos in range(0, size, block_size):
+      if buf[pos:pos + block_size] != other_buf[pos:pos + block_size]:
+        block = (start + pos) // block_size
+        ranges.append((block, block + 1))
+  return merge_block_ranges(ranges)
+def update_hash_tree(image, image_size, block_size, hash_alg_name, salt,
+                     digest_padding, hash_level_offsets, hash_tree,
+                     dirty_ranges):
+  """Updates an existing Merkle-tree for changed blocks of a file.
+  Only the leaves for |dirty_ranges| and their ancestors are rehashed,
+  the rest of |hash_tree| is kept as it is. The tree must have been
+  generated for the same size, block size, algorithm and salt.
+  Arguments:
+    image: The image, as an ImageHandler.
+    image_size: The size of the image.
+    block_size: The block size, e.g. 4096.
+    hash_alg_name: The hash algorithm, e.g. 'sha256' or 'sha1'.
+    salt: The salt to use.
+    digest_padding: The padding for each digest.
+    hash_level_offsets: The offsets from calc_hash_level_offsets().
+    hash_tree: The existing hash-tree as bytes.
+    dirty_ranges: List of (first_block, end_block) tuples of changed data
+      blocks, |end_block| exclusive.
   Returns:
     A tuple where the first element is the top-level hash as bytes and the
     second element is the hash-tree as bytes.
   """
-  hash_ret = bytearray(tree_size)
-  hash_src_offset = 0
+  if image_size <= block_size:
+    return generate_hash_tree(image, image_size, block_size, hash_alg_name,
+                              salt, digest_padding, hash_level_offsets,
+                              len(hash_tree))
+  hash_ret = bytearray(hash_tree)
+  template = create_avb_hashtree_hasher(hash_alg_name, salt)
+  digest_stride = template.digest_size + digest_padding
+  range_blocks = max(1, HASHTREE_RANGE_SIZE // block_size)
+  num_blocks = (image_size + block_size - 1) // block_size
+  dirty = merge_block_ranges((max(0, start), min(end, num_blocks))
+                             for start, end in dirty_ranges)
   hash_src_size = image_size
   level_num = 0
-  # If there is only one block, returns the top-level hash directly.
-  if hash_src_size == block_size:
-    hasher = create_avb_hashtree_hasher(hash_alg_name, salt)
-    image.seek(0)
-    hasher.update(image.read(block_size))
-    return hasher.digest(), bytes(hash_ret)
   while hash_src_size > block_size:
-    level_output_list = []
-    remaining = hash_src_size
-    while remaining > 0:
-      hasher = create_avb_hashtree_hasher(hash_alg_name, salt)
-      # Only read from the file for the first level - for subsequent
-      # levels, access the array we're building.
-      if level_num == 0:
-        image.seek(hash_src_offset + hash_src_size - remaining)
-        data = image.read(min(remaining, block_size))
-      else:
-        offset = hash_level_offsets[level_num - 1] + hash_src_size - remaining
-        data = hash_ret[offset:offset + block_size]
-      hasher.update(data)
-      remaining -= len(data)
-      if len(data) < block_size:
-        hasher.update(b'\0' * (block_size - len(data)))
-      level_output_list.append(hasher.digest())
-      if digest_padding > 0:
-        level_output_list.append(b'\0' * digest_padding)
-    level_output = b''.join(level_output_list)
-    padding_needed = (round_to_multiple(
-        len(level_output), block_size) - len(level_output))
-    level_output += b'\0' * padding_needed
-    # Copy level-output into resulting tree.
-    offset = hash_level_offsets[level_num]
-    hash_ret[offset:offset + len(level_output)] = level_output
-    # Continue on to the next level.
-    hash_src_size = len(level_output)
+    out_offset = hash_level_offsets[level_num]
+    if level_num > 0:
+      src_offset = hash_level_offsets[level_num - 1]
+      level = memoryview(hash_ret)[src_offset:src_offset + hash_src_size]
+    for start, end in dirty:
+      for first in range(start, end, range_blocks):
+        last = min(end, first + range_blocks)
+        if level_num == 0:
+          size = min(last * block_size, image_size) - first * block_size
+          data = bytearray((last - first) * block_size)
+          image.seek(first * block_size)
+          image.readinto(memoryview(data)[:size])
+        else:
+          data = level[first * block_size:last * block_size]
+        _hash_blocks(data, block_size, template, hash_ret,
+                     out_offset + first * digest_stride, digest_stride)
+    if level_num > 0:
+      level.release()
+    # The parents are the blocks of this level holding the new digests.
+    dirty = merge_block_ranges(
+        (start * digest_stride // block_size,
+         ((end * digest_stride) - 1) // block_size + 1)
+        for start, end in dirty)
+    hash_src_size = round_to_multiple(
+        (hash_src_size + block_size - 1) // block_size * digest_stride,
+        block_size)
     level_num += 1
-  hasher = create_avb_hashtree_hasher(hash_alg_name, salt)
-  hasher.update(level_output)
+  top = hash_level_offsets[level_num - 1]
+  hasher = template.copy()
+  hasher.update(hash_ret[top:top + hash_src_size])
   return hasher.digest(), bytes(hash_ret)
 class AvbTool(object):
   """Object for avbtool command-line tool."""
@@ -3727,6 +5494,12 @@ class AvbTool(object):
                                  'A/B suffix is present. This must not be used '
                                  'for vbmeta or chained partitions.',
                             action='store_true')
+    sub_parser.add_argument('--auto_sparsify',
+                            help='When the image is an Android sparse image, '
+                                 'store appended blocks which repeat a four '
+                                 'byte pattern, e.g. zero padding, as FILL '
+                                 'chunks.',
+                            action='store_true')
   def _fixup_common_args(self, args):
     """Common fixups needed by subcommands.
     Arguments:
@@ -3904,6 +5677,15 @@ class AvbTool(object):
     sub_parser.add_argument('--check_at_most_once',
                             action='store_true',
                             help='Set to verify data block only once')
+    sub_parser.add_argument('--dirty_blocks',
+                            help=('Only rehash these data blocks, e.g. '
+                                  '"10-20,35", reusing the existing hashtree'),
+                            type=parse_block_ranges)
+    sub_parser.add_argument('--diff_image',
+                            help=('Only rehash data blocks that differ from '
+                                  'this previously signed image, reusing '
+                                  'the existing hashtree'),
+                            type=argparse.FileType('rb'))
     self._add_common_args(sub_parser)
     self._add_common_footer_args(sub_parser)
     sub_parser.set_defaults(func=self.add_hashtree_footer)
@@ -3992,6 +5774,21 @@ class AvbTool(object):
         '--accept_zeroed_hashtree',
         help=('Accept images where the hashtree or FEC data is zeroed out'),
         action='store_true')
+    sub_parser.add_argument('--check_fec',
+                            help='Also check the FEC data of hashtrees',
+                            action='store_true')
+    sub_parser.add_argument('--repair',
+                            help=('Correct corrupted data in place using FEC '
+                                  'data, implies --check_fec'),
+                            action='store_true')
+    sub_parser.add_argument('--report',
+                            help=('Run all checks and write their results and '
+                                  'timings in the given format'),
+                            choices=['json'])
+    sub_parser.add_argument('--output',
+                            help='Write the report to file',
+                            type=argparse.FileType('wt'),
+                            default=sys.stdout)
     sub_parser.set_defaults(func=self.verify_image)
     sub_parser = subparsers.add_parser(
         'print_partition_digests',
@@ -4244,7 +6041,8 @@ class AvbTool(object):
                              args.do_not_append_vbmeta_image,
                              args.print_required_libavb_version,
                              args.use_persistent_digest,
-                             args.do_not_use_ab)
+                             args.do_not_use_ab,
+                             auto_sparsify=args.auto_sparsify)
   def add_hashtree_footer(self, args):
     """Implements the 'add_hashtree_footer' sub-command."""
     args = self._fixup_common_args(args)
@@ -4292,7 +6090,10 @@ Please use '--hash_algorithm sha256'.
         args.use_persistent_digest,
         args.do_not_use_ab,
         args.no_hashtree,
-        args.check_at_most_once)
+        args.check_at_most_once,
+        args.dirty_blocks,
+        args.diff_image.name if args.diff_image else None,
+        args.auto_sparsify)
   def erase_footer(self, args):
     """Implements the 'erase_footer' sub-command."""
     self.avb.erase_footer(args.image.name, args.keep_hashtree)
@@ -4317,7 +6118,9 @@ Please use '--hash_algorithm sha256'.
     self.avb.verify_image(args.image.name, args.key,
                           args.expected_chain_partition,
                           args.follow_chain_partitions,
-                          args.accept_zeroed_hashtree)
+                          args.accept_zeroed_hashtree, args.check_fec,
+                          args.repair, report=args.report,
+                          output=args.output)
   def print_partition_digests(self, args):
     """Implements the 'print_partition_digests' sub-command."""
     self.avb.print_partition_digests(args.image.name, args.output, args.json)
@@ -0,0 +1,43 @@
+import os
+import sys
+import time
+
+import avbtool
+
+BLOCK_SIZE = 4096
+
+
+def per_block_hasher(data: memoryview, alg: str, salt: bytes):
+    for pos in range(0, len(data), BLOCK_SIZE):
+        hasher = avbtool.create_avb_hashtree_hasher(alg, salt)
+        hasher.update(data[pos : pos + BLOCK_SIZE])
+        hasher.digest()
+
+
+def template_copy(data: memoryview, alg: str, salt: bytes):
+    template = avbtool.create_avb_hashtree_hasher(alg, salt)
+    for pos in range(0, len(data), BLOCK_SIZE):
+        hasher = template.copy()
+        hasher.update(data[pos : pos + BLOCK_SIZE])
+        hasher.digest()
+
+
+def blocks_per_second(fn, data: memoryview, alg: str, salt: bytes, rounds: int = 3) -> float:
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(data, alg, salt)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(data) // BLOCK_SIZE / best
+
+
+if __name__ == "__main__":
+    size_mib = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    data = memoryview(os.urandom(size_mib * 1024 * 1024))
+    salt = os.urandom(32)
+
+    for alg in ("sha1", "sha256", "blake2b-256"):
+        old = blocks_per_second(per_block_hasher, data, alg, salt)
+        new = blocks_per_second(template_copy, data, alg, salt)
+        print(f"{alg:12} new hasher {old:12.0f} blocks/s, template copy {new:12.0f} blocks/s ({new / old:.2f}x)")
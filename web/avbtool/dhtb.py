@@ -0,0 +1,141 @@
+import hashlib
+import os
+import os.path as op
+import struct
+import tempfile
+from collections import namedtuple
+from io import SEEK_SET
+from os import unlink
+
+
+DHTB_MAGIC = b"\x44\x48\x54\x42\x01\x00\x00\x00"
+# magic, sha256 of the payload, fill, payload size
+DHTB_HEADER = struct.Struct("<8s32s8sI")
+DHTB_BLOCK_SIZE = 0x200
+DHTB_TRAILER_OFFSET = 1048576 - DHTB_BLOCK_SIZE
+PAD_CHUNK_SIZE = 1024 * 1024
+
+# prefix: header block goes in front of the data instead of at 1MiB - 512.
+# patches: (offset from the start of the header block, bytes) pairs.
+DhtbLayout = namedtuple("DhtbLayout", "prefix size fill patches")
+
+LAYOUTS = {
+    8: DhtbLayout(True, 0x3000, b"\x00" * 8, ()),
+    9: DhtbLayout(False, 0x4000, b"\x00" * 8, ()),
+    10: DhtbLayout(False, 0x5000, b"\x00" * 8, ()),
+    11: DhtbLayout(False, 0x5000, b"\x00" * 8, ((0x3D, b"\x50"),)),
+    13: DhtbLayout(
+        False,
+        0x5000,
+        b"\xCC" * 4 + b"\xAA" * 4,
+        ((0x4D, b"\x50"), (0x50, b"\x60\x52")),
+    ),
+}
+
+
+def _pwrite(f, data: bytes, offset: int):
+    """Positioned write, falls back to seek/write where os.pwrite is missing."""
+    if hasattr(os, "pwrite"):
+        f.flush()
+        os.pwrite(f.fileno(), data, offset)
+    else:
+        f.seek(offset, SEEK_SET)
+        f.write(data)
+
+
+def _stream(f, dst=None, hasher=None):
+    """Read |f| in PAD_CHUNK_SIZE pieces, feeding |hasher| and copying to |dst|."""
+    buf = bytearray(PAD_CHUNK_SIZE)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        if hasher is not None:
+            hasher.update(view[:n])
+        if dst is not None:
+            dst.write(view[:n])
+
+
+def sha256_file(path: str) -> bytes:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        _stream(f, hasher=sha)
+    return sha.digest()
+
+
+def render(layout: DhtbLayout, sha: bytes) -> bytes:
+    """Build the whole 0x200 bytes header block for |layout|."""
+    block = bytearray(DHTB_BLOCK_SIZE)
+    DHTB_HEADER.pack_into(block, 0, DHTB_MAGIC, sha, layout.fill, layout.size)
+    for offset, data in layout.patches:
+        block[offset : offset + len(data)] = data
+    return bytes(block)
+
+
+def emit(src: str, dst: str, layout: DhtbLayout, sha: bytes = None) -> bytes:
+    """Write |src| padded with |layout| to |dst| and return the payload sha256.
+
+    |src| and |dst| may be the same file. If |sha| is known already the
+    payload is not hashed again.
+    """
+    hasher = hashlib.sha256() if sha is None else None
+    if layout.prefix:
+        fd, tmp = tempfile.mkstemp(prefix=".pad-", dir=op.dirname(op.abspath(dst)))
+        try:
+            with open(src, "rb") as s, os.fdopen(fd, "wb") as d:
+                d.write(bytes(DHTB_BLOCK_SIZE))
+                _stream(s, d, hasher)
+                sha = sha or hasher.digest()
+                _pwrite(d, render(layout, sha), 0)
+                d.flush()
+                os.fsync(d.fileno())
+            os.replace(tmp, dst)
+        except BaseException:
+            if op.exists(tmp):
+                unlink(tmp)
+            raise
+        return sha
+
+    if not (op.exists(dst) and op.samefile(src, dst)):
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            _stream(s, d, hasher)
+    elif hasher is not None:
+        with open(src, "rb") as s:
+            _stream(s, hasher=hasher)
+    sha = sha or hasher.digest()
+    with open(dst, "rb+") as f:
+        f.truncate(DHTB_TRAILER_OFFSET + DHTB_BLOCK_SIZE)
+        _pwrite(f, render(layout, sha), DHTB_TRAILER_OFFSET)
+    return sha
+
+
+def pad(path: str, android_ver: int) -> bytes:
+    """Pad |path| in place with the layout registered for |android_ver|."""
+    return emit(path, path, LAYOUTS[android_ver])
+
+
+def pad_many(src: str, outputs: dict) -> bytes:
+    """Pad |src| for several targets, |outputs| maps android version to path.
+
+    The payload is hashed once and shared by every layout.
+    """
+    sha = sha256_file(src)
+    # Write |src| itself last so the other targets still read the payload.
+    for android_ver, dst in sorted(
+        outputs.items(), key=lambda i: op.exists(i[1]) and op.samefile(src, i[1])
+    ):
+        emit(src, dst, LAYOUTS[android_ver], sha)
+    return sha
+
+
+def pack(payload, layout: DhtbLayout) -> bytes:
+    """In-memory emit(), returns |payload| padded with |layout| as bytes."""
+    block = render(layout, hashlib.sha256(payload).digest())
+    if layout.prefix:
+        return block + bytes(payload)
+    out = bytearray(DHTB_TRAILER_OFFSET + DHTB_BLOCK_SIZE)
+    data = memoryview(payload)[:DHTB_TRAILER_OFFSET]
+    out[: len(data)] = data
+    out[DHTB_TRAILER_OFFSET:] = block
+    return bytes(out)
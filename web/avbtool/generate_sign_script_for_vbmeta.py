@@ -1,4 +1,7 @@
 import struct
+from collections import namedtuple
+
+import avbtool
 
 AVB_MAGIC_LEN = 4
 AVB_RELEASE_STRING_SIZE = 48
@@ -127,6 +130,11 @@ def reverse_uint32(x: int) -> int:
     return result
 
 
+def key_prefix(algorithm_name: str, key_bits: int) -> str:
+    """Prefix of the key file names, e.g. "rsa4096_", empty for NONE."""
+    return "" if algorithm_name == "NONE" else f"rsa{key_bits}_"
+
+
 def generate(meta_path: str) -> None:
     with open(meta_path, "rb") as file, open("sign_vbmeta.sh", "w") as fo:
         buffer = file.read()
@@ -136,13 +144,13 @@ def generate(meta_path: str) -> None:
             ptr += 0x200
 
         vbheader = AvbVBMetaImageHeader(buffer[ptr : ptr + len(AvbVBMetaImageHeader)])
-        algorithm_type = reverse_uint32(vbheader.algorithm_type)
-        rsa = 256 * (1 if algorithm_type < 4 else 2)
-        algorithm = 1024 * pow(
-            2, algorithm_type if algorithm_type < 3 else algorithm_type - 3
+        algorithm_name, alg = avbtool.lookup_algorithm_by_type(
+            reverse_uint32(vbheader.algorithm_type)
         )
+        prefix = key_prefix(algorithm_name, alg.key_num_bits)
+        key_arg = "" if algorithm_name == "NONE" else f"--key {prefix}vbmeta.pem "
         print(
-            f"python avbtool make_vbmeta_image --key rsa{algorithm}_vbmeta.pem --algorithm SHA{rsa}_RSA{algorithm} \\",
+            f"python avbtool make_vbmeta_image {key_arg}--algorithm {algorithm_name} \\",
             file=fo,
         )
 
@@ -172,7 +180,7 @@ def generate(meta_path: str) -> None:
             public_key_len = reverse_uint32(chainheader.public_key_len)
 
             name = buffer[off : off + partition_name_len]
-            key_path = f"rsa{algorithm}_{name.decode()}_pub.bin"
+            key_path = f"{prefix}{name.decode()}_pub.bin"
             print(f"extract {key_path}")
 
             with open(key_path, "wb") as key_file:
@@ -214,115 +222,115 @@ def generate(meta_path: str) -> None:
         print(f"padding_size: {padding}")
 
 
-def generate_args(meta_path: str) -> tuple:
-    args = []
-
-    with open(meta_path, "rb") as file:
-        buffer = file.read()
-
-        ptr = 0
-        if struct.unpack("<I", buffer[0:4])[0] == 0x42544844:
-            ptr += 0x200
-
-        vbheader = AvbVBMetaImageHeader(buffer[ptr : ptr + len(AvbVBMetaImageHeader)])
-        algorithm_type = reverse_uint32(vbheader.algorithm_type)
-        rsa = 256 * (1 if algorithm_type < 4 else 2)
-        algorithm = 1024 * pow(
-            2, algorithm_type if algorithm_type < 3 else algorithm_type - 3
-        )
-        # print(
-        #    f"python avbtool make_vbmeta_image --key rsa{algorithm}_vbmeta.pem --algorithm SHA{rsa}_RSA{algorithm} \\",
-        #    file=fo,
-        # )
-        args.extend(
-            (
-                "avbtool",  # dummy command skip argparse
-                "make_vbmeta_image",
-                "--key",
-                f"rsa{algorithm}_vbmeta.pem",
-                "--algorithm",
-                f"SHA{rsa}_RSA{algorithm}",
+VbmetaInfo = namedtuple("VbmetaInfo", "algorithm_name key_bits chains padding_size")
+ChainPartition = namedtuple("ChainPartition", "name rollback_index_location public_key")
+
+
+def parse_vbmeta(buffer) -> VbmetaInfo:
+    """Parse the algorithm, chain partitions and DHTB padding of a vbmeta image.
+
+    |buffer| may be bytes, bytearray or memoryview.
+    """
+    ptr = 0
+    if struct.unpack("<I", buffer[0:4])[0] == 0x42544844:
+        ptr += 0x200
+
+    vbheader = AvbVBMetaImageHeader(buffer[ptr : ptr + len(AvbVBMetaImageHeader)])
+    algorithm_name, alg = avbtool.lookup_algorithm_by_type(
+        reverse_uint32(vbheader.algorithm_type)
+    )
+
+    chains = []
+    aux = (
+        ptr
+        + len(AvbVBMetaImageHeader)
+        + reverse_uint64(vbheader.authentication_data_block_size)
+    )
+    # Unsigned images have no public key behind the descriptors to stop at.
+    descriptors_end = (
+        aux
+        + reverse_uint64(vbheader.descriptors_offset)
+        + reverse_uint64(vbheader.descriptors_size)
+    )
+    off = aux + len(AvbChainPartitionDescriptor)
+    chainheader = AvbChainPartitionDescriptor(
+        buffer[off - len(AvbChainPartitionDescriptor) : off]
+    )
+    tag = reverse_uint64(chainheader.tag)
+    while True:
+        rollback_index_location = reverse_uint32(chainheader.rollback_index_location)
+        partition_name_len = reverse_uint32(chainheader.partition_name_len)
+        public_key_len = reverse_uint32(chainheader.public_key_len)
+
+        key_off = off + partition_name_len
+        chains.append(
+            ChainPartition(
+                bytes(buffer[off:key_off]).decode(),
+                rollback_index_location,
+                bytes(buffer[key_off : key_off + public_key_len]),
             )
         )
 
+        off += (
+            len(AvbChainPartitionDescriptor) + partition_name_len + public_key_len + 7
+        ) & 0xFFFFFFF8
+        if off > descriptors_end:
+            break
         chainheader = AvbChainPartitionDescriptor(
-            buffer[
-                ptr
-                + len(AvbVBMetaImageHeader)
-                + reverse_uint64(vbheader.authentication_data_block_size) : ptr
-                + len(AvbVBMetaImageHeader)
-                + reverse_uint64(vbheader.authentication_data_block_size)
-                + len(AvbChainPartitionDescriptor)
-            ]
+            buffer[off - len(AvbChainPartitionDescriptor) : off]
         )
-        tag = reverse_uint64(chainheader.tag)
+        if tag != reverse_uint64(chainheader.tag):
+            break
+
+    padding = 0x1000
+    if struct.unpack("<I", buffer[0:4])[0] == 0x42544844:
+        padding = struct.unpack("<I", buffer[0x30 : 0x30 + 4])[0]
+    elif (
+        len(buffer) >= 0xFFE34
+        and struct.unpack("<I", buffer[0xFFE00 : 0xFFE00 + 4])[0] == 0x42544844
+    ):
+        padding = struct.unpack("<I", buffer[0xFFE30 : 0xFFE30 + 4])[0]
+    else:
+        print('Warning: "DHTB" header not found.')
 
-        off = (
-            ptr
-            + len(AvbVBMetaImageHeader)
-            + reverse_uint64(vbheader.authentication_data_block_size)
-            + len(AvbChainPartitionDescriptor)
-        )
-        while True:
-            rollback_index_location = reverse_uint32(
-                chainheader.rollback_index_location
-            )
-            partition_name_len = reverse_uint32(chainheader.partition_name_len)
-            public_key_len = reverse_uint32(chainheader.public_key_len)
+    return VbmetaInfo(algorithm_name, alg.key_num_bits, chains, padding)
 
-            name = buffer[off : off + partition_name_len]
-            key_path = f"rsa{algorithm}_{name.decode()}_pub.bin"
-            print(f"extract {key_path}")
 
-            with open(key_path, "wb") as key_file:
-                key_file.write(
-                    buffer[
-                        off
-                        + partition_name_len : off
-                        + partition_name_len
-                        + public_key_len
-                    ]
-                )
+def generate_args(meta_path: str) -> tuple:
+    with open(meta_path, "rb") as file:
+        info = parse_vbmeta(file.read())
 
-            # print(
-            #    f"--chain_partition {name.decode()}:{rollback_index_location}:keys/{key_path} \\",
-            #    file=fo,
-            # )
-            args.extend(
-                (
-                    "--chain_partition",
-                    f"{name.decode()}:{rollback_index_location}:{key_path}",
-                )
-            )
+    prefix = key_prefix(info.algorithm_name, info.key_bits)
+    args = [
+        "avbtool",  # dummy command skip argparse
+        "make_vbmeta_image",
+    ]
+    # Unsigned vbmeta images are made without a key.
+    if info.algorithm_name != "NONE":
+        args.extend(("--key", f"{prefix}vbmeta.pem"))
+    args.extend(("--algorithm", info.algorithm_name))
 
-            off += (
-                len(AvbChainPartitionDescriptor)
-                + partition_name_len
-                + public_key_len
-                + 7
-            ) & 0xFFFFFFF8
-            chainheader = AvbChainPartitionDescriptor(
-                buffer[off - len(AvbChainPartitionDescriptor) : off]
-            )
-            if tag != reverse_uint64(chainheader.tag):
-                break
+    for chain in info.chains:
+        key_path = f"{prefix}{chain.name}_pub.bin"
+        print(f"extract {key_path}")
 
-        padding = 0x1000
-        if struct.unpack("<I", buffer[0:4])[0] == 0x42544844:
-            padding = struct.unpack("<I", buffer[0x30 : 0x30 + 4])[0]
-        elif struct.unpack("<I", buffer[0xFFE00 : 0xFFE00 + 4])[0] == 0x42544844:
-            padding = struct.unpack("<I", buffer[0xFFE30 : 0xFFE30 + 4])[0]
-        else:
-            print('Warning: "DHTB" header not found.')
+        with open(key_path, "wb") as key_file:
+            key_file.write(chain.public_key)
 
-        # print(f"--padding_size {padding} --output vbmeta-sign-custom.img", file=fo)
         args.extend(
-            ("--padding_size", f"{padding}", "--output", "vbmeta-sign-custom.img")
+            (
+                "--chain_partition",
+                f"{chain.name}:{chain.rollback_index_location}:{key_path}",
+            )
         )
 
-        print(f"padding_size: {padding}")
+    args.extend(
+        ("--padding_size", f"{info.padding_size}", "--output", "vbmeta-sign-custom.img")
+    )
+
+    print(f"padding_size: {info.padding_size}")
 
-        return args
+    return args
 
 
 if __name__ == "__main__":
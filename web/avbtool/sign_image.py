@@ -1,8 +1,11 @@
 import struct
 import avbtool
+import dhtb
 import generate_sign_script_for_vbmeta
 import hashlib
-from io import SEEK_SET
+from io import SEEK_END, SEEK_SET
+import mmap
+import os
 import os.path as op
 from os import unlink
 from shutil import copyfile
@@ -10,102 +13,22 @@ import zipfile
 
 
 class vbmeta_pad:
-    valid_android_ver = [8, 9, 10, 11, 13]
+    valid_android_ver = sorted(dhtb.LAYOUTS)
     valid_pad_size = [12288, 16384, 20480]
 
-    def pad_8_12288(file: str):
-        with open(file, "rb+") as f:
-            b = f.read()
-            f.truncate(0), f.seek(0, SEEK_SET)
-            sha = hashlib.sha256(b).digest()
-            f.write(
-                b"\x44\x48\x54\x42\x01\x00\x00\x00"
-                + sha
-                + b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x30\x00\x00"
-            )
-            f.seek(512, SEEK_SET)
-            f.write(b)
-
-    def pad_9_16384(file: str):
-        with open(file, "rb+") as f:
-            b = f.read()
-            f.truncate(0), f.seek(0, SEEK_SET)
-            sha = hashlib.sha256(b).digest()
-            f.write(b)
-            f.seek(1048576 - 512, SEEK_SET)
-            f.write(
-                b"\x44\x48\x54\x42\x01\x00\x00\x00"
-                + sha
-                + b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x40\x00\x00"
-            )
-            f.truncate(1048576)
-
-    def pad_10_20480(file: str):
-        with open(file, "rb+") as f:
-            b = f.read()
-            f.truncate(0), f.seek(0, SEEK_SET)
-            sha = hashlib.sha256(b).digest()
-            f.write(b)
-            f.seek(1048576 - 512, SEEK_SET)
-            f.write(
-                b"\x44\x48\x54\x42\x01\x00\x00\x00"
-                + sha
-                + b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x50\x00\x00"
-            )
-            f.truncate(1048576)
-
-    def pad_11_20480(file: str):
-        with open(file, "rb+") as f:
-            b = f.read()
-            f.truncate(0), f.seek(0, SEEK_SET)
-            sha = hashlib.sha256(b).digest()
-            f.write(b)
-            f.seek(1048576 - 512, SEEK_SET)
-            f.write(
-                b"\x44\x48\x54\x42\x01\x00\x00\x00"
-                + sha
-                + b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x50\x00\x00"
-            )
-            f.seek(0xFFE3D, SEEK_SET)
-            f.write(b"\x50")
-            f.truncate(1048576)
-
-    def pad_13_20480(file: str):
-        with open(file, "rb+") as f:
-            b = f.read()
-            f.truncate(0), f.seek(0, SEEK_SET)
-            sha = hashlib.sha256(b).digest()
-            f.write(b)
-            f.seek(1048576 - 512, SEEK_SET)
-            f.write(
-                b"\x44\x48\x54\x42\x01\x00\x00\x00"
-                + sha
-                + b"\xCC\xCC\xCC\xCC\xAA\xAA\xAA\xAA\x00\x50\x00\x00"
-            )
-            f.seek(0xFFE4D)
-            f.write(b"\x50")
-            f.seek(0xFFE50)
-            f.write(b"\x60\x52")
-            f.truncate(1048576)
-
     def pad(vbmeta_path: str, android_ver: int, pad_size: int):
         assert android_ver in vbmeta_pad.valid_android_ver, "Invalid android version"
         assert (
             pad_size in vbmeta_pad.valid_pad_size
         ), f"Invalid padding size: {pad_size}"
 
-        if android_ver == 8:
-            return vbmeta_pad.pad_8_12288(vbmeta_path)
-        elif android_ver == 9:
-            return vbmeta_pad.pad_9_16384(vbmeta_path)
-        elif android_ver ==  10:
-            return vbmeta_pad.pad_10_20480(vbmeta_path)
-        elif android_ver == 11:
-            return vbmeta_pad.pad_11_20480(vbmeta_path)
-        elif android_ver ==  13:
-            return vbmeta_pad.pad_13_20480(vbmeta_path)
-        else:
-            raise Exception("Invalid android version")
+        layout = dhtb.LAYOUTS[android_ver]
+        if layout.size != pad_size:
+            print(
+                f"Warning: android {android_ver} layout uses padding size "
+                f"{layout.size}, vbmeta has {pad_size}."
+            )
+        return dhtb.emit(vbmeta_path, vbmeta_path, layout)
 
 
 BOOT_MAGIC = b"ANDROID!"
@@ -158,26 +81,231 @@ class boot_img_hdr(metaclass=boot_img_hdr_meta):
         return size
 
 
-def dump_raw_image(image_path: str = "boot.img"):
+def _extract(f, src: int, size: int, hasher=None):
+    """Move |size| bytes at |src| to the start of |f| without a full buffer.
+
+    The moved bytes are fed to |hasher| on the way, if given.
+    """
+    try:
+        with mmap.mmap(f.fileno(), src + size) as m:
+            if src:
+                m.move(0, src, size)
+                m.flush()
+            if hasher is not None:
+                view = memoryview(m)
+                try:
+                    hasher.update(view[:size])
+                finally:
+                    view.release()
+        return
+    except (OSError, ValueError):
+        pass  # no usable mmap (e.g. some wasm builds), copy in chunks instead
+
+    buf = bytearray(dhtb.PAD_CHUNK_SIZE)
+    pos = 0
+    while pos < size:
+        f.seek(src + pos, SEEK_SET)
+        n = f.readinto(memoryview(buf)[: min(len(buf), size - pos)])
+        if not n:
+            break
+        if hasher is not None:
+            hasher.update(memoryview(buf)[:n])
+        if src:
+            f.seek(pos, SEEK_SET)
+            f.write(memoryview(buf)[:n])
+        pos += n
+
+
+def _find_raw_image(head, image_size: int) -> tuple:
+    """Locate the raw boot image, returns (offset, size).
+
+    |head| holds at least the first 0x200 + len(boot_img_hdr) bytes of an
+    image of |image_size| bytes.
+    """
+    offset = 0
+    if struct.unpack("<I", head[0:4])[0] == 0x42544844:
+        offset += 0x200
+
+    hdr = boot_img_hdr(head[offset : offset + len(boot_img_hdr)])
+    if hdr.magic != BOOT_MAGIC:
+        raise Exception("Input image is not a boot image")
+
+    return offset, min(hdr.calc_boot_size(), image_size - offset)
+
+
+def dump_raw_image(image_path: str = "boot.img", hasher=None) -> int:
+    """Strip the DHTB prefix and trailing data in place.
+
+    If |hasher| is given it is updated with the raw image while it is being
+    extracted. Returns the raw boot image size, i.e. the original image size
+    for the hash footer.
+    """
     with open(image_path, "rb+") as f:
-        offset = 0
-        if struct.unpack("<I", f.read(4))[0] == 0x42544844:
-            offset += 0x200
+        head = f.read(0x200 + len(boot_img_hdr))
+        f.seek(0, SEEK_END)
+        offset, boot_size = _find_raw_image(head, f.tell())
 
-        f.seek(offset, SEEK_SET)
-        hdr = boot_img_hdr(f.read(len(boot_img_hdr)))
-        if hdr.magic != BOOT_MAGIC:
-            raise Exception("Input image is not a boot image")
+        print("Dump boot image at offset: %d, size: %d" % (offset, boot_size))
+        if offset or hasher is not None:
+            _extract(f, offset, boot_size, hasher)
+        f.truncate(boot_size)
+        return boot_size
 
-        boot_size = hdr.calc_boot_size()
 
-        print("Dump boot image at offset: %d, size: %d" % (offset, boot_size))
-        f.seek(offset, SEEK_SET)
-        boot_raw = f.read(boot_size)
+def _check_partition_size(image_size: int, partition_size: int, block_size: int):
+    max_image_size = (
+        partition_size - avbtool.Avb.MAX_VBMETA_SIZE - avbtool.Avb.MAX_FOOTER_SIZE
+    )
+    if max_image_size < 0:
+        raise avbtool.AvbError(f"Parition size of {partition_size} is too small.")
+    if partition_size % block_size != 0:
+        raise avbtool.AvbError(
+            f"Partition size of {partition_size} is not a multiple of the image "
+            f"block size {block_size}."
+        )
+    if image_size > max_image_size:
+        raise avbtool.AvbError(
+            f"Image size of {image_size} exceeds maximum image size "
+            f"of {max_image_size} in order to fit in a partition size of "
+            f"{partition_size}."
+        )
+
+
+def _hash_footer_vbmeta(
+    avb, partition_name, image_size, salt, digest, key, algorithm_name, hash_algorithm
+) -> bytes:
+    """Build the vbmeta blob holding the hash descriptor of a boot image.
+
+    |key| is a path to, or the bytes of, the PEM signing key.
+    """
+    h_desc = avbtool.AvbHashDescriptor()
+    h_desc.image_size = image_size
+    h_desc.hash_algorithm = hash_algorithm
+    h_desc.partition_name = partition_name
+    h_desc.salt = salt
+    h_desc.digest = digest
+    return avb._generate_vbmeta_blob(
+        algorithm_name, key, None, [h_desc], None, None, 0, 0, 0,
+        None, None, None, None, None, None, None, None, None, None, 0,
+    )  # fmt: skip
+
+
+def sign_boot_image(
+    image_path: str = "boot.img",
+    partition_name: str = "boot",
+    partition_size: int = 36700160,
+    key_path: str = "rsa4096_vbmeta.pem",
+    algorithm_name: str = "SHA256_RSA4096",
+    hash_algorithm: str = "sha256",
+):
+    """Dump |image_path| and add a hash footer to it with one pass over the data.
+
+    Equivalent to dump_raw_image() followed by 'avbtool add_hash_footer', but
+    the descriptor digest is computed while the raw image is extracted.
+    """
+    hasher = hashlib.new(hash_algorithm)
+    salt = os.urandom(hasher.digest_size)
+    hasher.update(salt)
+    original_image_size = dump_raw_image(image_path, hasher)
+
+    avb = avbtool.Avb()
+    image = avbtool.ImageHandler(image_path)
+    try:
+        _check_partition_size(original_image_size, partition_size, image.block_size)
+        vbmeta_blob = _hash_footer_vbmeta(
+            avb,
+            partition_name,
+            original_image_size,
+            salt,
+            hasher.digest(),
+            key_path,
+            algorithm_name,
+            hash_algorithm,
+        )
+        avb._append_vbmeta_and_footer(
+            image, vbmeta_blob, original_image_size, partition_size
+        )
+    except Exception as e:
+        image.truncate(original_image_size)
+        raise avbtool.AvbError(f"Adding hash_footer failed: {e}.") from e
+
+
+def _chain_vbmeta(avb, info, key, public_keys: dict) -> bytes:
+    """Build the new vbmeta blob for a parsed stock vbmeta, padded as |info| says.
+
+    |public_keys| maps partition names to keys replacing the stock chain key.
+    """
+    descriptors = []
+    for chain in info.chains:
+        desc = avbtool.AvbChainPartitionDescriptor()
+        desc.partition_name = chain.name
+        desc.rollback_index_location = chain.rollback_index_location
+        desc.public_key = bytes(public_keys.get(chain.name, chain.public_key))
+        descriptors.append(desc)
+    vbmeta_blob = avb._generate_vbmeta_blob(
+        info.algorithm_name, key, None, descriptors, None, None, 0, 0, 0,
+        None, None, None, None, None, None, None, None, None, None, 0,
+    )  # fmt: skip
+    padded_size = avbtool.round_to_multiple(len(vbmeta_blob), info.padding_size)
+    return vbmeta_blob + b"\0" * (padded_size - len(vbmeta_blob))
+
+
+def sign_image_buffers(
+    boot,
+    vbmeta,
+    key,
+    image_type: str = "boot",
+    android_version: int = 8,
+    partition_size: int = 36700160,
+    public_key=None,
+    block_size: int = 4096,
+) -> tuple:
+    """In-memory sign_image(), returns the signed (boot, vbmeta) images as bytes.
+
+    |boot|, |vbmeta| and the PEM |key| may be any bytes-like object. If
+    |public_key| is given it replaces the chain partition key of
+    |image_type| in the new vbmeta, like rsa4096_custom_pub.bin does.
+    Nothing is read from or written to the working directory.
+    """
+    boot = memoryview(boot)
+    offset, boot_size = _find_raw_image(boot, len(boot))
+    raw = boot[offset : offset + boot_size]
+    _check_partition_size(boot_size, partition_size, block_size)
+
+    avb = avbtool.Avb()
+    hash_algorithm = "sha256"
+    hasher = hashlib.new(hash_algorithm)
+    salt = os.urandom(hasher.digest_size)
+    hasher.update(salt)
+    hasher.update(raw)
+    footer_vbmeta = _hash_footer_vbmeta(
+        avb,
+        image_type,
+        boot_size,
+        salt,
+        hasher.digest(),
+        key,
+        "SHA256_RSA4096",
+        hash_algorithm,
+    )
 
-        f.truncate(0)
-        f.seek(0, SEEK_SET)
-        f.write(boot_raw)
+    # Same layout avbtool add_hash_footer gives a non-sparse image.
+    signed_boot = bytearray(partition_size)
+    signed_boot[:boot_size] = raw
+    vbmeta_offset = avbtool.round_to_multiple(boot_size, block_size)
+    signed_boot[vbmeta_offset : vbmeta_offset + len(footer_vbmeta)] = footer_vbmeta
+    footer = avbtool.AvbFooter()
+    footer.original_image_size = boot_size
+    footer.vbmeta_offset = vbmeta_offset
+    footer.vbmeta_size = len(footer_vbmeta)
+    signed_boot[-avbtool.AvbFooter.SIZE :] = footer.encode()
+
+    public_keys = {} if public_key is None else {image_type: public_key}
+    info = generate_sign_script_for_vbmeta.parse_vbmeta(memoryview(vbmeta))
+    vbmeta_blob = _chain_vbmeta(avb, info, key, public_keys)
+
+    assert android_version in vbmeta_pad.valid_android_ver, "Invalid android version"
+    return bytes(signed_boot), dhtb.pack(vbmeta_blob, dhtb.LAYOUTS[android_version])
 
 
 def sign_image(
@@ -189,9 +317,11 @@ def sign_image(
 ):
     output = "vbmeta-sign-custom.img"
 
+    # Dump, hash and sign boot/recovery image
+    print(f"Sign {image_type} image...")
+    sign_boot_image(sign_image_path, image_type, input_size)
+
     # Generate sign args
-    print("Dumping...")
-    dump_raw_image(sign_image_path)
     sign_args = generate_sign_script_for_vbmeta.generate_args(image_path)
 
     if op.exists(f"rsa4096_{image_type}_pub.bin"):
@@ -216,23 +346,86 @@ def sign_image(
     else:
         return False  # Failed
 
-    # Sign boot/recovery image
-    sign_boot_args = (
-        "avbtool",  # dummy arg
-        "add_hash_footer",
-        "--image",
-        sign_image_path,
-        "--partition_name",
-        image_type,
-        "--partition_size",
-        f"{input_size}",
-        "--key",
-        "rsa4096_vbmeta.pem",
-        "--algorithm",
-        "SHA256_RSA4096",
-    )
-    print(f"Sign {image_type} image...")
-    avbtool.AvbTool().run(sign_boot_args)
+    print("Done!")
+
+
+def _sign_batch_image(job: tuple) -> str:
+    image_path, image_type, partition_size, key = job
+    sign_boot_image(image_path, image_type, partition_size, key)
+    return image_path
+
+
+def _preload_key(key):
+    """Pool initializer, parses the PEM |key| into avbtool's key cache."""
+    avbtool.RSA_KEY_CACHE.get(key)
+
+
+def sign_batch(manifest_path: str, jobs: int = None):
+    """Sign many boot/recovery images against one vbmeta.
+
+    The manifest is a json object like:
+
+        {
+            "vbmeta": "vbmeta.img",
+            "android_ver": 9,
+            "key": "rsa4096_vbmeta.pem",
+            "public_key": "rsa4096_custom_pub.bin",
+            "output": "vbmeta-sign-custom.img",
+            "images": [
+                {"image": "boot.img", "type": "boot", "size": 36700160},
+                {"image": "recovery.img", "type": "recovery",
+                 "size": 41943040, "output": "recovery-sign.img"}
+            ]
+        }
+
+    Only "vbmeta" and "images" are required, the other keys default to the
+    same files sign_image() uses. An image without "output" is signed in
+    place. The vbmeta is parsed once, the images are then signed in |jobs|
+    worker processes which each parse the key once when they start.
+    """
+    import json
+    from concurrent.futures import ProcessPoolExecutor
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    base = op.dirname(op.abspath(manifest_path))
+    path = lambda p: op.join(base, p)
+
+    with open(path(manifest.get("key", "rsa4096_vbmeta.pem")), "rb") as f:
+        key = f.read()
+    public_key = None
+    public_key_path = path(manifest.get("public_key", "rsa4096_custom_pub.bin"))
+    if op.exists(public_key_path):
+        with open(public_key_path, "rb") as f:
+            public_key = f.read()
+    with open(path(manifest["vbmeta"]), "rb") as f:
+        info = generate_sign_script_for_vbmeta.parse_vbmeta(f.read())
+
+    batch = []
+    public_keys = {}
+    for entry in manifest["images"]:
+        image_path = path(entry["image"])
+        if "output" in entry:
+            copyfile(image_path, path(entry["output"]))
+            image_path = path(entry["output"])
+        image_type = entry.get("type", "boot")
+        batch.append((image_path, image_type, entry.get("size", 36700160), key))
+        if public_key is not None:
+            public_keys[image_type] = public_key
+
+    print(f"Sign {len(batch)} images...")
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=_preload_key, initargs=(key,)
+    ) as executor:
+        for image_path in executor.map(_sign_batch_image, batch):
+            print(f"Signed {image_path}")
+
+    print("Signing...")
+    android_ver = manifest.get("android_ver", 8)
+    assert android_ver in vbmeta_pad.valid_android_ver, "Invalid android version"
+    vbmeta_blob = _chain_vbmeta(avbtool.Avb(), info, key, public_keys)
+    with open(path(manifest.get("output", "vbmeta-sign-custom.img")), "wb") as f:
+        f.write(dhtb.pack(vbmeta_blob, dhtb.LAYOUTS[android_ver]))
     print("Done!")
 
 
@@ -288,7 +481,27 @@ if __name__ == "__main__":
         help="output signed image size",
     )
 
+    parser.add_argument(
+        "--batch",
+        default=None,
+        type=str,
+        dest="batch",
+        help="json manifest of images to sign against one vbmeta",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=None,
+        type=int,
+        dest="jobs",
+        help="worker processes for --batch, defaults to the cpu count",
+    )
+
     args = parser.parse_args()
 
+    if args.batch:
+        sign_batch(args.batch, args.jobs)
+        raise SystemExit(0)
+
     sign_image(args.vbmeta, args.type, args.android_ver, args.image, args.size)
     pack_zip("vbmeta-sign-custom.img", "boot.img")
@@ -0,0 +1,155 @@
+import hashlib
+import io
+import json
+
+import pytest
+
+import avbtool
+
+
+def property_descriptor():
+    desc = avbtool.AvbPropertyDescriptor()
+    desc.key = "com.android.build.system.fingerprint"
+    desc.value = b"vendor/device:13/TP1A/1:user/release-keys"
+    return desc
+
+
+def hash_descriptor():
+    desc = avbtool.AvbHashDescriptor()
+    desc.image_size = 3000000
+    desc.hash_algorithm = "sha256"
+    desc.partition_name = "boot"
+    desc.salt = bytes(range(32))
+    desc.digest = hashlib.sha256(b"boot").digest()
+    return desc
+
+
+def hashtree_descriptor():
+    desc = avbtool.AvbHashtreeDescriptor()
+    desc.dm_verity_version = 1
+    desc.image_size = 9003008
+    desc.tree_offset = 9003008
+    desc.tree_size = 73728
+    desc.data_block_size = 4096
+    desc.hash_block_size = 4096
+    desc.fec_num_roots = 2
+    desc.fec_offset = 9076736
+    desc.fec_size = 77824
+    desc.hash_algorithm = "sha1"
+    desc.partition_name = "system"
+    desc.salt = b"\x5a" * 20
+    desc.root_digest = hashlib.sha1(b"system").digest()
+    return desc
+
+
+def kernel_cmdline_descriptor():
+    desc = avbtool.AvbKernelCmdlineDescriptor()
+    desc.flags = (
+        avbtool.AvbKernelCmdlineDescriptor.FLAGS_USE_ONLY_IF_HASHTREE_NOT_DISABLED
+    )
+    desc.kernel_cmdline = "dm=1 vroot none ro 1,0 17584 verity 1"
+    return desc
+
+
+def chain_partition_descriptor():
+    desc = avbtool.AvbChainPartitionDescriptor()
+    desc.rollback_index_location = 2
+    desc.partition_name = "vendor"
+    desc.public_key = bytes(range(256)) * 2 + b"\x01\x02\x03"
+    return desc
+
+
+def unknown_descriptor():
+    desc = avbtool.AvbDescriptor(None)
+    desc.tag = 42
+    desc.data = b"opaque descriptor data!!"  # No padding needed.
+    return desc
+
+
+FACTORIES = [
+    property_descriptor,
+    hash_descriptor,
+    hashtree_descriptor,
+    kernel_cmdline_descriptor,
+    chain_partition_descriptor,
+    unknown_descriptor,
+]
+
+
+def encode_all(descriptors):
+    return b"".join(bytes(desc.encode()) for desc in descriptors)
+
+
+def test_parsed_descriptors_reencode_identically():
+    blob = encode_all(factory() for factory in FACTORIES)
+    parsed = avbtool.parse_descriptors(blob)
+    assert [type(desc) for desc in parsed] == [
+        type(factory()) for factory in FACTORIES
+    ]
+    # Before any field is decoded, and again after all of them are.
+    assert encode_all(parsed) == blob
+    for desc, factory in zip(parsed, FACTORIES):
+        assert vars(desc).keys() >= {"_raw"}
+        # Built subclasses also carry the tag=None, data=None of the base.
+        fields = {
+            name: value
+            for name, value in vars(factory()).items()
+            if not name.startswith("_") and value is not None
+        }
+        for name, value in fields.items():
+            assert getattr(desc, name) == value, name
+    assert encode_all(parsed) == blob
+
+
+def test_parsed_descriptors_keep_unknown_bytes():
+    # Reserved bytes are not decoded; an untouched descriptor keeps them.
+    encoded = bytearray(hash_descriptor().encode())
+    encoded[avbtool.AvbHashDescriptor.SIZE - 1] = 0xAA
+    (desc,) = avbtool.parse_descriptors(bytes(encoded))
+    assert desc.partition_name == "boot"
+    assert desc.encode() == encoded
+
+
+@pytest.mark.parametrize("factory", FACTORIES[1:])
+def test_setting_field_reencodes_from_fields(factory):
+    (desc,) = avbtool.parse_descriptors(bytes(factory().encode()))
+    expected = factory()
+    if type(desc) is avbtool.AvbDescriptor:
+        desc.data = expected.data = b"changed"
+    else:
+        desc.flags = expected.flags = 2
+    assert desc.encode() == expected.encode()
+
+
+def test_malformed_descriptor_raises_on_access():
+    encoded = bytearray(chain_partition_descriptor().encode())
+    encoded[avbtool.AvbChainPartitionDescriptor.SIZE] = 0xFF
+    (desc,) = avbtool.parse_descriptors(bytes(encoded))
+    assert desc.encode() == encoded
+    with pytest.raises(LookupError):
+        desc.partition_name
+
+
+def test_verify_image_reports_malformed_descriptor(tmp_path):
+    descriptors = [property_descriptor(), kernel_cmdline_descriptor()]
+    vbmeta = avbtool.Avb()._generate_vbmeta_blob(
+        "NONE", None, None, descriptors, None, None, 0, 0, 0, None, None,
+        None, None, None, None, None, None, None, None, 0,
+    )  # fmt: skip
+    # Breaks the UTF-8 of the kernel command-line only.
+    vbmeta = bytearray(vbmeta)
+    vbmeta[vbmeta.index(b"dm=1")] = 0xFF
+    path = tmp_path / "vbmeta.img"
+    path.write_bytes(vbmeta)
+
+    output = io.StringIO()
+    with pytest.raises(avbtool.AvbError, match="1 of 3 checks failed"):
+        avbtool.Avb().verify_image(
+            str(path), None, None, False, False, report="json", output=output
+        )
+    report = json.loads(output.getvalue())
+    failed = [entry for entry in report["results"] if not entry["ok"]]
+    assert [(entry["stage"], entry["name"]) for entry in failed] == [
+        ("kernel_cmdline", str(path))
+    ]
+    assert "Malformed descriptor" in failed[0]["error"]
@@ -0,0 +1,144 @@
+import random
+
+import pytest
+
+import avbtool
+
+pytest.importorskip("numpy")
+
+BLOCK_SIZE = 4096
+
+
+def encode(tmp_path, data, num_roots):
+    path = tmp_path / "image.img"
+    path.write_bytes(data)
+    fec_data = avbtool.generate_fec_data(str(path), num_roots)
+    # calc_fec_data_size() also counts the block holding the FEC footer.
+    assert len(fec_data) == avbtool.calc_fec_data_size(
+        len(data), num_roots
+    ) - avbtool.FEC_BLOCK_SIZE
+    return fec_data
+
+
+def check(tmp_path, data, fec_data, num_roots, num_threads=1):
+    path = tmp_path / "check.img"
+    path.write_bytes(bytes(data) + fec_data)
+    image = avbtool.ImageHandler(str(path), read_only=True)
+    return avbtool.check_fec_data(image, len(data), fec_data, num_roots, num_threads)
+
+
+def libfec_parity(data, num_roots, num_codewords):
+    """Parity of the first codewords, a straight port of libfec's
+    init_rs_char(8, 0x11d, 0, 1, roots, 0) and encode_rs_char() with the
+    interleaving of 'fec --encode'."""
+    nn = 255
+    alpha_to, index_of = [0] * 256, [0] * 256
+    index_of[0], sr = nn, 1
+    for i in range(nn):
+        index_of[sr], alpha_to[i] = i, sr
+        sr <<= 1
+        if sr & 0x100:
+            sr ^= 0x11D
+    genpoly = [1] + [0] * num_roots
+    for i in range(num_roots):
+        genpoly[i + 1] = 1
+        for j in range(i, 0, -1):
+            if genpoly[j]:
+                genpoly[j] = genpoly[j - 1] ^ alpha_to[(index_of[genpoly[j]] + i) % nn]
+            else:
+                genpoly[j] = genpoly[j - 1]
+        genpoly[0] = alpha_to[(index_of[genpoly[0]] + i) % nn]
+    genpoly = [index_of[g] for g in genpoly]
+
+    rs_n = nn - num_roots
+    stripe = avbtool._fec_rounds(len(data), num_roots) * BLOCK_SIZE
+    out = bytearray()
+    for codeword in range(num_codewords):
+        parity = [0] * num_roots
+        for j in range(rs_n):
+            pos = codeword * rs_n + j
+            offset = pos // rs_n + (pos % rs_n) * stripe
+            feedback = index_of[(data[offset] if offset < len(data) else 0) ^ parity[0]]
+            if feedback != nn:
+                for k in range(1, num_roots):
+                    parity[k] ^= alpha_to[(feedback + genpoly[num_roots - k]) % nn]
+            parity = parity[1:] + [
+                alpha_to[(feedback + genpoly[0]) % nn] if feedback != nn else 0
+            ]
+        out += bytes(parity)
+    return bytes(out)
+
+
+@pytest.mark.parametrize("num_roots, image_size", [(2, BLOCK_SIZE * 300), (24, 5000)])
+def test_parity_matches_libfec(tmp_path, num_roots, image_size):
+    data = random.Random(num_roots).randbytes(image_size)
+    fec_data = encode(tmp_path, data, num_roots)
+    assert fec_data[: 64 * num_roots] == libfec_parity(data, num_roots, 64)
+
+
+def apply(data, fixes):
+    fixed = bytearray(data)
+    for offset, value in fixes:
+        fixed[offset] = value
+    return fixed
+
+
+@pytest.mark.parametrize("num_roots", [2, 8])
+def test_intact_image_has_no_fixes(tmp_path, num_roots):
+    data = random.Random(num_roots).randbytes(BLOCK_SIZE * 100)
+    fec_data = encode(tmp_path, data, num_roots)
+    assert check(tmp_path, data, fec_data, num_roots) == []
+
+
+@pytest.mark.parametrize(
+    "num_roots, image_size, corrupt_blocks, num_threads",
+    [
+        (2, BLOCK_SIZE * 100, [37], 1),
+        (2, BLOCK_SIZE * 600, [3, 590], 3),
+        (8, BLOCK_SIZE * 300, [1, 2, 50, 299], 1),
+    ],
+)
+def test_corrupted_blocks_round_trip(
+    tmp_path, num_roots, image_size, corrupt_blocks, num_threads
+):
+    rng = random.Random(image_size)
+    data = rng.randbytes(image_size)
+    fec_data = encode(tmp_path, data, num_roots)
+    bad = bytearray(data)
+    for block in corrupt_blocks:
+        bad[block * BLOCK_SIZE : (block + 1) * BLOCK_SIZE] = rng.randbytes(BLOCK_SIZE)
+    fixes = check(tmp_path, bad, fec_data, num_roots, num_threads)
+    assert fixes
+    assert apply(bad, fixes) == data
+
+
+def test_corrupted_partial_last_block(tmp_path):
+    data = random.Random(1).randbytes(BLOCK_SIZE * 100 + 10)
+    fec_data = encode(tmp_path, data, 2)
+    bad = bytearray(data)
+    bad[-10:] = bytes(b ^ 0xFF for b in bad[-10:])
+    assert apply(bad, check(tmp_path, bad, fec_data, 2)) == data
+
+
+def test_corrupted_fec_data_is_reported(tmp_path):
+    data = random.Random(2).randbytes(BLOCK_SIZE * 100)
+    fec_data = encode(tmp_path, data, 2)
+    bad_fec = bytearray(fec_data)
+    for offset in (5, 8, 11):
+        bad_fec[offset] ^= 0xFF
+    fixes = check(tmp_path, data, bytes(bad_fec), 2)
+    assert apply(bytes(data) + bytes(bad_fec), fixes) == bytes(data) + fec_data
+
+
+def test_too_many_errors_raise(tmp_path):
+    image_size = BLOCK_SIZE * 100
+    rng = random.Random(3)
+    data = rng.randbytes(image_size)
+    fec_data = encode(tmp_path, data, 2)
+    bad = bytearray(data)
+    # Two corrupted blocks a stripe apart hit the same codewords twice.
+    stripe = avbtool._fec_rounds(image_size, 2) * BLOCK_SIZE
+    for offset in (0, stripe):
+        bad[offset : offset + BLOCK_SIZE] = rng.randbytes(BLOCK_SIZE)
+    with pytest.raises(ValueError):
+        check(tmp_path, bad, fec_data, 2)
@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+import avbtool
+import generate_sign_script_for_vbmeta
+
+KEY_PATH = os.path.join(os.path.dirname(avbtool.__file__), "rsa4096_vbmeta.pem")
+
+
+def make_vbmeta(tmp_path, algorithm_name, key_path=None):
+    public_key = tmp_path / "chain_pub.bin"
+    avbtool.AvbTool().run(
+        ["avbtool", "extract_public_key", "--key", KEY_PATH,
+         "--output", str(public_key)]
+    )  # fmt: skip
+    args = ["avbtool", "make_vbmeta_image", "--algorithm", algorithm_name]
+    if key_path:
+        args.extend(("--key", key_path))
+    for location, name in enumerate(["boot", "recovery"], 1):
+        args.extend(("--chain_partition", f"{name}:{location}:{public_key}"))
+    # Padded like vbmeta partitions, which generate() reads past the
+    # descriptors of.
+    args.extend(("--padding_size", str(1024 * 1024)))
+    args.extend(("--output", str(tmp_path / "vbmeta.img")))
+    avbtool.AvbTool().run(args)
+    return public_key.read_bytes()
+
+
+def test_none_vbmeta_args_have_no_key(tmp_path, monkeypatch):
+    public_key = make_vbmeta(tmp_path, "NONE")
+    monkeypatch.chdir(tmp_path)
+    args = generate_sign_script_for_vbmeta.generate_args("vbmeta.img")
+
+    assert "--key" not in args
+    assert args[args.index("--algorithm") + 1] == "NONE"
+    for name in ["boot", "recovery"]:
+        assert (tmp_path / f"{name}_pub.bin").read_bytes() == public_key
+    assert not list(tmp_path.glob("rsa0_*"))
+
+    # The arguments make an unsigned vbmeta with the same chain partitions.
+    avbtool.AvbTool().run(args)
+    info = generate_sign_script_for_vbmeta.parse_vbmeta(
+        (tmp_path / "vbmeta-sign-custom.img").read_bytes()
+    )
+    assert info.algorithm_name == "NONE"
+    assert [(chain.name, chain.rollback_index_location) for chain in info.chains] == [
+        ("boot", 1),
+        ("recovery", 2),
+    ]
+
+
+def test_none_vbmeta_script_has_no_key(tmp_path, monkeypatch):
+    make_vbmeta(tmp_path, "NONE")
+    monkeypatch.chdir(tmp_path)
+    generate_sign_script_for_vbmeta.generate("vbmeta.img")
+
+    script = (tmp_path / "sign_vbmeta.sh").read_text()
+    assert "--key" not in script
+    assert "rsa0" not in script
+    assert "--chain_partition boot:1:keys/boot_pub.bin" in script
+
+
+@pytest.mark.parametrize("algorithm_name", ["SHA256_RSA4096", "SHA512_RSA4096"])
+def test_rsa_vbmeta_args_use_key_of_its_size(tmp_path, monkeypatch, algorithm_name):
+    make_vbmeta(tmp_path, algorithm_name, KEY_PATH)
+    monkeypatch.chdir(tmp_path)
+    args = generate_sign_script_for_vbmeta.generate_args("vbmeta.img")
+
+    assert args[args.index("--key") + 1] == "rsa4096_vbmeta.pem"
+    assert args[args.index("--algorithm") + 1] == algorithm_name
+    assert (tmp_path / "rsa4096_boot_pub.bin").exists()
@@ -0,0 +1,115 @@
+import random
+import struct
+
+import pytest
+
+import avbtool
+
+BLOCK_SIZE = 4096
+
+
+def tree_params(image_size, hash_alg_name):
+    digest_size = len(avbtool.create_avb_hashtree_hasher(hash_alg_name, b"").digest())
+    digest_padding = avbtool.round_to_pow2(digest_size) - digest_size
+    hash_level_offsets, tree_size = avbtool.calc_hash_level_offsets(
+        image_size, BLOCK_SIZE, digest_size + digest_padding
+    )
+    return digest_padding, hash_level_offsets, tree_size
+
+
+@pytest.mark.parametrize("hash_alg_name", ["sha1", "sha256"])
+@pytest.mark.parametrize(
+    "image_size", [BLOCK_SIZE * 2, BLOCK_SIZE * 129, BLOCK_SIZE * 3000 + 100]
+)
+def test_update_hash_tree_equals_full_regeneration(tmp_path, hash_alg_name, image_size):
+    rng = random.Random(image_size)
+    data = bytearray(rng.randbytes(image_size))
+    path = tmp_path / "image.img"
+    path.write_bytes(data)
+    salt = b"salt"
+    digest_padding, hash_level_offsets, tree_size = tree_params(image_size, hash_alg_name)
+    _, old_tree = avbtool.generate_hash_tree(
+        avbtool.ImageHandler(str(path), read_only=True), image_size, BLOCK_SIZE,
+        hash_alg_name, salt, digest_padding, hash_level_offsets, tree_size,
+    )  # fmt: skip
+
+    num_blocks = (image_size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    dirty_ranges = []
+    for _ in range(4):
+        first = rng.randrange(num_blocks)
+        end = min(num_blocks, first + rng.randint(1, 300))
+        for block in range(first, end):
+            offset = min(image_size - 1, block * BLOCK_SIZE + rng.randrange(BLOCK_SIZE))
+            data[offset] ^= 0xFF
+        dirty_ranges.append((first, end))
+    path.write_bytes(data)
+
+    image = avbtool.ImageHandler(str(path), read_only=True)
+    expected = avbtool.generate_hash_tree(
+        image, image_size, BLOCK_SIZE, hash_alg_name, salt, digest_padding,
+        hash_level_offsets, tree_size,
+    )  # fmt: skip
+    updated = avbtool.update_hash_tree(
+        image, image_size, BLOCK_SIZE, hash_alg_name, salt, digest_padding,
+        hash_level_offsets, old_tree, dirty_ranges,
+    )  # fmt: skip
+    assert updated == expected
+
+
+def test_update_hash_tree_without_changes_keeps_tree(tmp_path):
+    image_size = BLOCK_SIZE * 64
+    path = tmp_path / "image.img"
+    path.write_bytes(random.Random(0).randbytes(image_size))
+    digest_padding, hash_level_offsets, tree_size = tree_params(image_size, "sha256")
+    image = avbtool.ImageHandler(str(path), read_only=True)
+    expected = avbtool.generate_hash_tree(
+        image, image_size, BLOCK_SIZE, "sha256", b"", digest_padding,
+        hash_level_offsets, tree_size,
+    )  # fmt: skip
+    updated = avbtool.update_hash_tree(
+        image, image_size, BLOCK_SIZE, "sha256", b"", digest_padding,
+        hash_level_offsets, expected[1], [],
+    )  # fmt: skip
+    assert updated == expected
+
+
+def empty_sparse_image(path):
+    header = avbtool.ImageHandler.HEADER_FORMAT
+    path.write_bytes(
+        struct.pack(
+            header, avbtool.ImageHandler.MAGIC, 1, 0, struct.calcsize(header),
+            struct.calcsize(avbtool.ImageChunk.FORMAT), BLOCK_SIZE, 0, 0, 0,
+        )  # fmt: skip
+    )
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+@pytest.mark.parametrize("image_size", [BLOCK_SIZE, BLOCK_SIZE * 3000])
+def test_tree_built_in_image_equals_tree_in_memory(tmp_path, sparse, image_size):
+    rng = random.Random(image_size)
+    path = tmp_path / "image.img"
+    if sparse:
+        empty_sparse_image(path)
+        image = avbtool.ImageHandler(str(path))
+        image.append_raw(rng.randbytes(image_size // 2 // BLOCK_SIZE * BLOCK_SIZE))
+        image.append_fill(b"\x01\x02\x03\x04", image_size - image.image_size)
+    else:
+        path.write_bytes(rng.randbytes(image_size))
+        image = avbtool.ImageHandler(str(path))
+    digest_padding, hash_level_offsets, tree_size = tree_params(image_size, "sha256")
+    root_digest, hash_tree = avbtool.generate_hash_tree(
+        image, image_size, BLOCK_SIZE, "sha256", b"salt", digest_padding,
+        hash_level_offsets, tree_size,
+    )  # fmt: skip
+
+    padded_tree_size = avbtool.round_to_multiple(tree_size, BLOCK_SIZE)
+    image.append_zeroed_raw(padded_tree_size)
+    assert image.image_size == image_size + padded_tree_size
+    in_place = avbtool.generate_hash_tree(
+        image, image_size, BLOCK_SIZE, "sha256", b"salt", digest_padding,
+        hash_level_offsets, tree_size, out_image=image, out_offset=image_size,
+    )  # fmt: skip
+    assert in_place == (root_digest, None)
+    reopened = avbtool.ImageHandler(str(path), read_only=True)
+    reopened.seek(image_size)
+    assert reopened.read(padded_tree_size) == hash_tree.ljust(padded_tree_size, b"\0")
@@ -0,0 +1,56 @@
+import hashlib
+import os
+
+import Crypto.PublicKey.RSA
+import pytest
+
+import avbtool
+
+KEY_PATH = os.path.join(os.path.dirname(avbtool.__file__), "rsa4096_vbmeta.pem")
+
+
+@pytest.fixture(scope="module")
+def rsa2048_pem():
+    return Crypto.PublicKey.RSA.generate(2048).export_key()
+
+
+def plain_signature(key, algorithm_name, data):
+    alg = avbtool.ALGORITHMS[algorithm_name]
+    message = alg.padding + alg.hash_constructor(data).digest()
+    signature = pow(int.from_bytes(message, "big"), key.key.d, key.modulus)
+    return signature.to_bytes(alg.signature_num_bytes, "big")
+
+
+@pytest.mark.parametrize("algorithm_name", ["SHA256_RSA4096", "SHA512_RSA4096"])
+def test_crt_signature_equals_plain_pow(algorithm_name):
+    key = avbtool.RSAPublicKey(KEY_PATH)
+    assert key._cached.crt is not None
+    data = os.urandom(1000)
+    assert key.sign(algorithm_name, data) == plain_signature(key, algorithm_name, data)
+
+
+@pytest.mark.parametrize("algorithm_name", ["SHA256_RSA2048", "SHA512_RSA2048"])
+def test_crt_signature_equals_plain_pow_pem_bytes(rsa2048_pem, algorithm_name):
+    key = avbtool.RSAPublicKey(rsa2048_pem)
+    data = os.urandom(1000)
+    assert key.sign(algorithm_name, data) == plain_signature(key, algorithm_name, data)
+
+
+def test_public_only_key_cannot_sign(rsa2048_pem):
+    public_pem = Crypto.PublicKey.RSA.import_key(rsa2048_pem).public_key().export_key()
+    key = avbtool.RSAPublicKey(public_pem)
+    with pytest.raises(avbtool.AvbError, match="no private exponent"):
+        key.sign("SHA256_RSA2048", b"data")
+
+
+def test_signed_vbmeta_verifies():
+    vbmeta = avbtool.Avb()._generate_vbmeta_blob(
+        "SHA256_RSA4096", KEY_PATH, None, [], None, None, 0, 0, 0,
+        None, None, None, None, None, None, None, None, None, None, 0,
+    )  # fmt: skip
+    header = avbtool.AvbVBMetaHeader(vbmeta[: avbtool.AvbVBMetaHeader.SIZE])
+    assert avbtool.verify_vbmeta_signature(header, vbmeta)
+
+    tampered = bytearray(vbmeta)
+    tampered[-1] ^= 1
+    assert not avbtool.verify_vbmeta_signature(header, tampered)
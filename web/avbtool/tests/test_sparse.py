@@ -0,0 +1,150 @@
+import random
+import struct
+
+import pytest
+
+import avbtool
+
+BLOCK_SIZE = 4096
+
+
+def write_sparse_image(path, chunks):
+    """Writes a sparse image from a list of (chunk_type, num_blocks, data)."""
+    total_blocks = sum(num_blocks for _, num_blocks, _ in chunks)
+    with open(path, "wb") as f:
+        f.write(
+            struct.pack(
+                avbtool.ImageHandler.HEADER_FORMAT,
+                avbtool.ImageHandler.MAGIC, 1, 0,
+                struct.calcsize(avbtool.ImageHandler.HEADER_FORMAT),
+                struct.calcsize(avbtool.ImageChunk.FORMAT),
+                BLOCK_SIZE, total_blocks, len(chunks), 0,
+            )  # fmt: skip
+        )
+        for chunk_type, num_blocks, data in chunks:
+            header_size = struct.calcsize(avbtool.ImageChunk.FORMAT)
+            f.write(
+                struct.pack(
+                    avbtool.ImageChunk.FORMAT, chunk_type, 0, num_blocks,
+                    header_size + (len(data) if data else 0),
+                )  # fmt: skip
+            )
+            if data:
+                f.write(data)
+
+
+def random_chunks(rng, num_chunks):
+    chunk_types = [
+        avbtool.ImageChunk.TYPE_RAW,
+        avbtool.ImageChunk.TYPE_FILL,
+        avbtool.ImageChunk.TYPE_DONT_CARE,
+    ]
+    chunks = []
+    for _ in range(num_chunks):
+        chunk_type = rng.choice(chunk_types)
+        num_blocks = rng.randint(1, 8)
+        if chunk_type == avbtool.ImageChunk.TYPE_RAW:
+            data = rng.randbytes(num_blocks * BLOCK_SIZE)
+        elif chunk_type == avbtool.ImageChunk.TYPE_FILL:
+            data = rng.randbytes(4)
+        else:
+            data = None
+        chunks.append((chunk_type, num_blocks, data))
+    return chunks
+
+
+def chunk_state(image):
+    """The parsed state of |image| that must not depend on how it was built."""
+    image._load_chunks()
+    return (
+        image.image_size,
+        image._num_total_chunks,
+        image._num_total_blocks,
+        image._sparse_end,
+        list(image._chunk_output_offsets),
+        [
+            (c.chunk_type, c.chunk_offset, c.output_offset, c.output_size,
+             c.input_offset, c.fill_data)
+            for c in image._chunks
+        ],
+    )  # fmt: skip
+
+
+def contents(image):
+    image.seek(0)
+    return image.read(image.image_size)
+
+
+@pytest.mark.parametrize("auto_sparsify", [False, True])
+@pytest.mark.parametrize("seed", range(3))
+def test_append_and_truncate_equal_fresh_parse(tmp_path, seed, auto_sparsify):
+    rng = random.Random(seed)
+    path = str(tmp_path / "sparse.img")
+    write_sparse_image(path, random_chunks(rng, 20))
+    image = avbtool.ImageHandler(path)
+    assert image.is_sparse
+    image.auto_sparsify = auto_sparsify
+
+    for _ in range(60):
+        op = rng.choice(["raw", "zeros", "fill", "dont_care", "truncate", "read"])
+        if op == "raw":
+            image.append_raw(rng.randbytes(BLOCK_SIZE * rng.randint(1, 3)))
+        elif op == "zeros":
+            image.append_raw(
+                rng.randbytes(BLOCK_SIZE) + bytes(BLOCK_SIZE * rng.randint(1, 3))
+            )
+        elif op == "fill":
+            image.append_fill(rng.randbytes(4), BLOCK_SIZE * rng.randint(1, 3))
+        elif op == "dont_care":
+            image.append_dont_care(BLOCK_SIZE * rng.randint(1, 3))
+        elif op == "truncate":
+            new_size = image.image_size + BLOCK_SIZE * rng.randint(-6, 2)
+            image.truncate(max(BLOCK_SIZE, new_size))
+        else:
+            contents(image)
+
+        fresh = avbtool.ImageHandler(path, read_only=True)
+        assert chunk_state(image) == chunk_state(fresh), op
+        assert contents(image) == contents(fresh), op
+
+
+def test_auto_sparsify_keeps_contents(tmp_path):
+    rng = random.Random(0)
+    path = str(tmp_path / "sparse.img")
+    write_sparse_image(path, [(avbtool.ImageChunk.TYPE_DONT_CARE, 1, None)])
+    blocks = [
+        rng.randbytes(BLOCK_SIZE),
+        bytes(BLOCK_SIZE),
+        b"\xde\xad\xbe\xef" * (BLOCK_SIZE // 4),
+        b"\xde\xad\xbe\xef" * (BLOCK_SIZE // 4 - 1) + b"\xde\xad\xbe\xee",
+    ]
+    # Long enough to span several segments of _block_runs().
+    data = b"".join(rng.choice(blocks) for _ in range(700))
+
+    plain = avbtool.ImageHandler(path)
+    plain.append_raw(data)
+    expected = contents(plain)
+
+    write_sparse_image(path, [(avbtool.ImageChunk.TYPE_DONT_CARE, 1, None)])
+    sparsified = avbtool.ImageHandler(path)
+    sparsified.auto_sparsify = True
+    sparsified.append_raw(data)
+    assert contents(sparsified) == expected
+    fresh = avbtool.ImageHandler(path, read_only=True)
+    assert chunk_state(sparsified) == chunk_state(fresh)
+    assert contents(fresh) == expected
+    chunk_types = [chunk[0] for chunk in chunk_state(fresh)[-1]]
+    assert avbtool.ImageChunk.TYPE_FILL in chunk_types
+
+
+def test_fill_pattern_cache_is_bounded(tmp_path):
+    rng = random.Random(0)
+    path = str(tmp_path / "sparse.img")
+    fills = [rng.randbytes(4) for _ in range(100)]
+    write_sparse_image(
+        path, [(avbtool.ImageChunk.TYPE_FILL, 1, fill) for fill in fills]
+    )
+    image = avbtool.ImageHandler(path, read_only=True)
+    assert contents(image) == b"".join(fill * (BLOCK_SIZE // 4) for fill in fills)
+    cache_info = avbtool.ImageHandler._fill_pattern.cache_info()
+    assert cache_info.currsize <= cache_info.maxsize
@@ -50,7 +50,7 @@ self.onmessage = async (event) => {
 
 
     try {
-        const module_file = ['./avbtool.py', './generate_sign_script_for_vbmeta.py', './sign_image.py'];
+        const module_file = ['./avbtool.py', './dhtb.py', './generate_sign_script_for_vbmeta.py', './sign_image.py'];
         const resource_file = ['./rsa4096_custom_pub.bin', './rsa4096_vbmeta.pem']
         const all_file = module_file.concat(resource_file);
         const web_workdir = "/home/web_user/"